@@ -4,6 +4,7 @@ A module to create and share a few logging instances
 
 import logging
 import os
+import threading
 
 '''
 Hacky method of importing the settings module that is currently
@@ -34,12 +35,39 @@ def create_logger(filename,
     logger.addHandler(fh)
     return logger
 
-database_log = create_logger('database', root_path=settings.ROOT_LOG_DIR)
-email_log = create_logger('email', root_path=settings.ROOT_LOG_DIR)
-debug_log = create_logger('debug', root_path=settings.ROOT_LOG_DIR)
-info_log = create_logger('info', root_path=settings.ROOT_LOG_DIR)
-error_log = create_logger('error', root_path=settings.ROOT_LOG_DIR)
-suspicious_log = create_logger('suspicious', root_path=settings.ROOT_LOG_DIR)
+# stops two threads adding a handler each to the same logger.
+_LOCK = threading.Lock()
+
+class LazyLogger(object):
+    '''
+    Stands in for a logger created with :func:`create_logger`, the
+    settings are only read and the log file only opened the first time
+    the logger is used. This keeps importing this module cheap for
+    processes which never log.
+    '''
+    def __init__(self, filename):
+        self._filename = filename
+        self._logger = None
+
+    def _get_logger(self):
+        '''Creates the logger on first use.'''
+        if self._logger is None:
+            with _LOCK:
+                if self._logger is None:
+                    self._logger = create_logger(
+                        self._filename, root_path=settings.ROOT_LOG_DIR
+                        )
+        return self._logger
+
+    def __getattr__(self, name):
+        return getattr(self._get_logger(), name)
+
+database_log = LazyLogger('database')
+email_log = LazyLogger('email')
+debug_log = LazyLogger('debug')
+info_log = LazyLogger('info')
+error_log = LazyLogger('error')
+suspicious_log = LazyLogger('suspicious')
 
 if __name__ == '__main__':
     # test the logs
@@ -0,0 +1,219 @@
+'''Request metrics middleware.
+
+Records, for every view (and every ajax `form_type` dispatched through
+:func:`timetracker.views.ajax`), a latency histogram along with the number
+of SQL queries made and the time spent in them, and how often each lazy
+context value (see :mod:`timetracker.utils.context`) was calculated for
+it. The aggregated values are rendered in the Prometheus text format by
+:func:`render_metrics`.
+
+To keep the cost of recording low enough to leave on permanently each
+thread writes into its own set of counters. A lock is only taken the first
+time a thread records anything, and when the counters are rendered. The
+counters of threads which have ended are then folded into a base set, so
+servers which start a thread per request don't keep a set for each of
+them. Queries are only counted and timed, see
+:class:`timetracker.utils.querylog.QueryCounter`.
+'''
+
+import time
+import threading
+
+from timetracker.utils.querylog import QueryCounter
+
+# upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Series(object):
+    '''The counters for a single view label.'''
+    __slots__ = ('buckets', 'count', 'total', 'queries', 'query_time',
+                 'context')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.context = {}
+
+    def observe(self, seconds, queries, query_time, context=()):
+        '''Adds a single request to the series.'''
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[idx] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.queries += queries
+        self.query_time += query_time
+        for name in context:
+            self.context[name] = self.context.get(name, 0) + 1
+
+    def merge(self, other):
+        '''Adds the values of another series into this one.'''
+        for idx, value in enumerate(other.buckets):
+            self.buckets[idx] += value
+        self.count += other.count
+        self.total += other.total
+        self.queries += other.queries
+        self.query_time += other.query_time
+        for name, value in other.context.items():
+            self.context[name] = self.context.get(name, 0) + value
+
+
+class MetricsRegistry(object):
+    '''Thread-sharded store of :class:`Series` keyed by view label.'''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._base = {}
+
+    def _fold(self):
+        '''Merges the shards of the threads which have ended into the
+        base series. Must be called with the lock held.'''
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for label, series in shard.items():
+                self._base.setdefault(label, Series()).merge(series)
+        self._shards = live
+
+    def _shard(self):
+        '''Returns the dict of series belonging to the current thread.'''
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def observe(self, label, seconds, queries=0, query_time=0.0,
+                context=()):
+        '''Records a single request for `label`.
+
+        `context` is the names of the context values which the request
+        calculated.'''
+        shard = self._shard()
+        series = shard.get(label)
+        if series is None:
+            series = shard[label] = Series()
+        series.observe(seconds, queries, query_time, context)
+
+    def collect(self):
+        '''Returns a dict of label to :class:`Series` merged over all
+        threads.'''
+        merged = {}
+        with self._lock:
+            self._fold()
+            shards = [shard for _, shard in self._shards]
+            for label, series in self._base.items():
+                merged.setdefault(label, Series()).merge(series)
+        for shard in shards:
+            for label, series in shard.items():
+                merged.setdefault(label, Series()).merge(series)
+        return merged
+
+    def reset(self):
+        '''Drops every recorded value.'''
+        with self._lock:
+            self._base.clear()
+            for _, shard in self._shards:
+                shard.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def view_label(request, view_func, view_kwargs):
+    '''Generates the label which a request is recorded under.
+
+    The label is the dotted path of the view, views which are mapped more
+    than once with a different template get the template appended and the
+    ajax view is split up per `form_type`.'''
+    label = '%s.%s' % (view_func.__module__, view_func.__name__)
+    if view_kwargs.get("template"):
+        label += ':%s' % view_kwargs["template"]
+    if view_func.__name__ == 'ajax':
+        form_type = request.POST.get('form_type') \
+            or request.GET.get('form_type')
+        label += ':%s' % (form_type or 'none')
+    return label
+
+
+def _escape(value):
+    '''Escapes a label value for the Prometheus text format.'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(registry=REGISTRY):
+    '''Renders the registry in the Prometheus text exposition format.'''
+    series = sorted(registry.collect().items())
+    out = []
+    to_out = out.append
+    to_out('# HELP timetracker_request_seconds Request latency per view.')
+    to_out('# TYPE timetracker_request_seconds histogram')
+    for label, values in series:
+        view = _escape(label)
+        cumulative = 0
+        for bound, value in zip(BUCKETS, values.buckets):
+            cumulative += value
+            to_out('timetracker_request_seconds_bucket{view="%s",le="%s"} %d'
+                   % (view, bound, cumulative))
+        to_out('timetracker_request_seconds_bucket{view="%s",le="+Inf"} %d'
+               % (view, values.count))
+        to_out('timetracker_request_seconds_sum{view="%s"} %f'
+               % (view, values.total))
+        to_out('timetracker_request_seconds_count{view="%s"} %d'
+               % (view, values.count))
+    to_out('# HELP timetracker_sql_queries_total SQL queries made per view.')
+    to_out('# TYPE timetracker_sql_queries_total counter')
+    for label, values in series:
+        to_out('timetracker_sql_queries_total{view="%s"} %d'
+               % (_escape(label), values.queries))
+    to_out('# HELP timetracker_sql_seconds_total Time spent in SQL per view.')
+    to_out('# TYPE timetracker_sql_seconds_total counter')
+    for label, values in series:
+        to_out('timetracker_sql_seconds_total{view="%s"} %f'
+               % (_escape(label), values.query_time))
+    to_out('# HELP timetracker_context_evaluations_total Lazy context values '
+           'calculated per view.')
+    to_out('# TYPE timetracker_context_evaluations_total counter')
+    for label, values in series:
+        for name, value in sorted(values.context.items()):
+            to_out('timetracker_context_evaluations_total{view="%s",value="%s"}'
+                   ' %d' % (_escape(label), _escape(name), value))
+    return '\n'.join(out) + '\n'
+
+
+class MetricsMiddleware(object):
+    '''Times every request which resolves to a view and records it in the
+    :data:`REGISTRY`.'''
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        '''Starts the timers once we know which view will be called.'''
+        request._metrics_label = view_label(request, view_func, view_kwargs)
+        request._metrics_queries = QueryCounter()
+        request._metrics_queries.start()
+        request._metrics_start = time.time()
+        return None
+
+    def process_response(self, request, response):
+        '''Records the request.'''
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.time() - start
+        queries = request._metrics_queries
+        queries.stop()
+        REGISTRY.observe(request._metrics_label, elapsed,
+                         queries.count, queries.time,
+                         getattr(request, '_context_evaluated', ()))
+        return response
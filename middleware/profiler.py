@@ -0,0 +1,43 @@
+'''Profiling middleware.
+
+An administrator can profile a single request by adding `profile` to the
+query string, i.e. `/holiday_planning/?profile` or `?profile=mem`. The
+view is then run under :func:`timetracker.utils.profiling.profile_call`
+and the files are written to the profile directory. Where memory profiling
+isn't available the request is profiled by cpu instead.
+'''
+
+from timetracker.tracker.models import Tbluser
+from timetracker.middleware.metrics import view_label
+from timetracker.utils.profiling import (profile_call, memory_profiling,
+                                         PROFILE_MODES)
+from timetracker.loggers import info_log, suspicious_log
+
+
+class ProfilerMiddleware(object):
+    '''Profiles the view of requests made by administrators which carry
+    the `profile` flag.'''
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        '''Runs the view under the profiler if requested.'''
+        if 'profile' not in request.GET:
+            return None
+        try:
+            user = Tbluser.objects.get(id=request.session.get("user_id"))
+        except Tbluser.DoesNotExist:
+            return None
+        if not user.sup_tl_or_admin():
+            suspicious_log.info("Non-admin user requesting a profile")
+            return None
+
+        mode = request.GET.get('profile') or 'cpu'
+        if mode not in PROFILE_MODES or \
+                (mode == 'mem' and not memory_profiling()):
+            mode = 'cpu'
+        response, files = profile_call(
+            view_label(request, view_func, view_kwargs), mode,
+            view_func, request, *view_args, **view_kwargs
+            )
+        info_log.info("Profiled %s for %s: %s" % (
+                request.path, user.user_id, ', '.join(files)))
+        return response
@@ -0,0 +1,71 @@
+'''Replica middleware.
+
+GET requests to the read-only pages are run under
+:func:`timetracker.utils.replica.use_replica`. A user who has just written
+something is pinned to the default database for `REPLICA_STICKY_SECONDS`
+so that they always see their own changes even when the replica lags
+behind.
+
+The middleware must come after the SessionMiddleware.
+'''
+
+import time
+from fnmatch import fnmatch
+
+from django.conf import settings
+
+from timetracker.middleware.metrics import view_label
+from timetracker.utils import replica
+
+# the views, as labelled for the metrics, which only read.
+READ_ONLY_VIEWS = (
+    'timetracker.reporting.views.*',
+    'timetracker.views.yearview',
+    'timetracker.views.overtime',
+    'timetracker.views.view_with_holiday_list:team_planning.html',
+    )
+
+SESSION_KEY = 'replica_pinned_until'
+
+
+def read_only(request, view_func, view_kwargs):
+    '''Whether the request is for a read-only page.'''
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    label = view_label(request, view_func, view_kwargs)
+    patterns = getattr(settings, 'REPLICA_VIEWS', READ_ONLY_VIEWS)
+    return any(fnmatch(label, pattern) for pattern in patterns)
+
+
+class ReplicaMiddleware(object):
+    '''Sends the reads of read-only pages to the replica.'''
+
+    def process_request(self, request):
+        '''Makes sure nothing is left over from a previous request.'''
+        replica.reset()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        '''Switches to the replica for read-only pages unless the user is
+        pinned to the default database.'''
+        if not replica.replica_alias():
+            return None
+        if request.session.get(SESSION_KEY, 0) > time.time():
+            return None
+        if read_only(request, view_func, view_kwargs):
+            request._replica = replica.use_replica()
+            request._replica.__enter__()
+        return None
+
+    def process_response(self, request, response):
+        '''Switches back and pins users who have written.'''
+        context = getattr(request, '_replica', None)
+        if context is not None:
+            del request._replica
+            context.__exit__(None, None, None)
+        if request.method == 'POST' and replica.replica_alias() \
+                and hasattr(request, 'session') \
+                and request.session.get('user_id'):
+            request.session[SESSION_KEY] = time.time() + getattr(
+                settings, 'REPLICA_STICKY_SECONDS', 10)
+        return response
@@ -0,0 +1,242 @@
+'''
+Reports which are calculated in the background.
+
+Rather than downloading a report straight from its url, which can take
+longer than the web server allows for a big span of control, the
+reporting page submits the url as a job with :func:`submit_report_job`.
+The `report_worker` management command calculates the pending jobs by
+calling the report's view as the user who asked for it and writes the
+CSV into REPORT_JOB_DIR. The page polls :func:`report_job_status` until
+the job is done and then downloads it from :func:`download_report_job`.
+If no worker has picked the job up after REPORT_JOB_WAIT seconds the page
+downloads the report straight from its url instead.
+
+A job's key is made from the url, the employees in the span of control
+of whoever asked for it and the :class:`DataVersion` stamp of the data
+the report reads, so asking for the same report over the same data again
+gives back the job which is already running, or finished, rather than
+calculating it twice. Results are deleted REPORT_JOB_EXPIRY seconds after
+they're finished.
+'''
+
+import os
+import hashlib
+import datetime
+
+from django.core.urlresolvers import resolve, Resolver404
+from django.http import HttpRequest, HttpResponse, Http404
+
+from timetracker.reporting import views
+from timetracker.reporting.models import (ReportJob, report_job_expiry,
+                                          report_job_wait)
+from timetracker.tracker.models import Tbluser, DataVersion
+from timetracker.tracker.models import Tblauthorization as tblauth
+from timetracker.utils import policies
+from timetracker.utils.decorators import admin_check, json_response
+from timetracker.loggers import error_log
+
+# the reports which can be run as jobs and the stamps of the data which
+# they read.
+REPORTS = {
+    views.download_all_holiday_data: views.user_stamps,
+    views.yearmonthhol: views.period_stamps,
+    views.ot_by_month: views.period_stamps,
+    views.ot_by_year: views.period_stamps,
+    views.holidays_for_yearmonth: views.period_stamps,
+    views.balance_by_range: views.range_stamps,
+}
+
+
+def span_key(user):
+    '''Hash of the employees in the span of control of `user`.'''
+    try:
+        ids = sorted(employee.id for employee in user.get_subordinates())
+    except tblauth.DoesNotExist:
+        ids = []
+    return hashlib.md5(repr(ids)).hexdigest()
+
+
+def resolve_report(path):
+    '''The view and arguments of a report url.
+
+    :raises: :class:`ValueError` if the url isn't a report.'''
+    try:
+        view, args, kwargs = resolve(path)
+    except Resolver404:
+        raise ValueError("%s isn't a report." % path)
+    if view not in REPORTS:
+        raise ValueError("%s isn't a report." % path)
+    return view, args, kwargs
+
+
+def submit(user, path):
+    '''Submits the report at `path` as a job for `user`, unless the same
+    report over the same employees, data and policies already has one.
+
+    :returns: A tuple of the job and whether it was created.'''
+    view, args, kwargs = resolve_report(path)
+    query = REPORTS[view](None, *args, **kwargs)
+    stamp = DataVersion.stamp(query) if query is not None else None
+    span = span_key(user)
+    key = hashlib.md5(repr((path, span, stamp,
+                            policies.version()))).hexdigest()
+    return ReportJob.get_or_submit(key, path, user, span)
+
+
+def run(job):
+    '''Calculates a claimed job and writes its result.'''
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = job.path
+    request.session = {'user_id': job.user_id}
+    try:
+        view, args, kwargs = resolve_report(job.path)
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200:
+            raise ValueError("The report answered %d." % response.status_code)
+    except Http404:
+        job.finish(error="The report isn't available.")
+        return job
+    except Exception as error:
+        error_log.error("Report job %s failed: %s" % (job.key, error))
+        job.finish(error=str(error))
+        return job
+
+    # the result only appears once it has been written completely.
+    partial = job.result_path + '.part'
+    with open(partial, 'wb') as result:
+        for chunk in response:
+            result.write(chunk)
+    os.rename(partial, job.result_path)
+    disposition = response.get('Content-Disposition', '')
+    job.finish(filename=disposition.partition('filename=')[2] or
+               '%s.csv' % job.key)
+    return job
+
+
+def run_pending(limit=None):
+    '''Claims and calculates the pending jobs, oldest first.
+
+    Several workers can run at once, each job is only claimed by one.
+
+    :returns: The jobs which were run.'''
+    done = []
+    for job in ReportJob.objects.filter(status='PENDING').order_by('created'):
+        if limit is not None and len(done) >= limit:
+            break
+        if job.claim():
+            done.append(run(job))
+    return done
+
+
+def cleanup(now=None):
+    '''Deletes the expired jobs and their results, and fails the jobs
+    whose worker stopped before finishing them.
+
+    :returns: The number of jobs which were deleted.'''
+    now = now or datetime.datetime.now()
+    ReportJob.objects.filter(
+        status='RUNNING', started__lte=now - report_job_expiry()
+        ).update(status='FAILED', finished=now, expires=now,
+                 error="The worker stopped.")
+    expired = list(ReportJob.objects.filter(expires__lte=now))
+    for job in expired:
+        for path in (job.result_path, job.result_path + '.part'):
+            if os.path.exists(path):
+                os.remove(path)
+    ReportJob.objects.filter(id__in=[job.id for job in expired]).delete()
+    return len(expired)
+
+
+def job_data(job, now=None):
+    '''What the reporting page is told about a job.'''
+    data = {
+        'key': job.key,
+        'status': job.status,
+        'error': job.error,
+    }
+    now = now or datetime.datetime.now()
+    if job.status == 'DONE':
+        data['download'] = '/reporting/jobs/%s/' % job.key
+    elif job.status == 'PENDING' and job.created <= now - report_job_wait() \
+            or job.status == 'RUNNING' and \
+            job.started <= now - report_job_expiry():
+        # no worker is running, or the one which was stopped, so the
+        # report is downloaded directly.
+        data['fallback'] = job.path
+    return data
+
+
+def visible_job(user, key):
+    '''The job with `key` if `user` may see it, which they may if it
+    covers the same employees as their span of control.'''
+    try:
+        job = ReportJob.objects.get(key=key)
+    except ReportJob.DoesNotExist:
+        return None
+    if job.span != span_key(user) or job.is_expired():
+        return None
+    return job
+
+
+@admin_check
+@json_response
+def submit_report_job(request):
+    """
+    Function which submits the report at the url in the `path` of the
+    request as a job.
+    """
+
+    json_data = {
+        'success': False,
+        'error': '',
+    }
+
+    user = Tbluser.objects.get(id=request.session.get('user_id'))
+    try:
+        job, _ = submit(user, request.POST.get('path', ''))
+    except ValueError as error:
+        json_data['error'] = str(error)
+        return json_data
+    json_data.update(job_data(job))
+    json_data['success'] = True
+    return json_data
+
+
+@admin_check
+@json_response
+def report_job_status(request):
+    """
+    Function which returns the status of the job with the `key` in the
+    request.
+    """
+
+    json_data = {
+        'success': False,
+        'error': '',
+    }
+
+    user = Tbluser.objects.get(id=request.session.get('user_id'))
+    job = visible_job(user, request.GET.get('key', ''))
+    if job is None:
+        json_data['error'] = 'No such report.'
+        return json_data
+    json_data.update(job_data(job))
+    json_data['success'] = True
+    return json_data
+
+
+@admin_check
+def download_report_job(request, key=None):
+    '''Endpoint which sends the result of a finished report job.
+
+    :param key: The key of the job.'''
+    user = Tbluser.objects.get(id=request.session.get('user_id'))
+    job = visible_job(user, key)
+    if job is None or job.status != 'DONE' or \
+            not os.path.exists(job.result_path):
+        raise Http404
+    response = HttpResponse(open(job.result_path, 'rb'),
+                            mimetype="text/csv")
+    response['Content-Disposition'] = 'attachment;filename=%s' % job.filename
+    return response
@@ -1,3 +1,144 @@
-from django.db import models
+'''
+Models of the reporting app.
+'''
 
-# Create your models here.
+import os
+import datetime
+
+from django.conf import settings
+from django.db import models, IntegrityError, transaction
+
+from timetracker.tracker.models import Tbluser
+
+
+def report_job_dir():
+    '''Returns the directory the results of the report jobs are written
+    to, creating it if necessary.'''
+    path = getattr(settings, 'REPORT_JOB_DIR', None) \
+        or os.path.join(settings.ROOT_LOG_DIR, 'reports')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def report_job_expiry():
+    '''How long the result of a report job is kept.'''
+    return datetime.timedelta(
+        seconds=getattr(settings, 'REPORT_JOB_EXPIRY', 3600))
+
+
+def report_job_wait():
+    '''How long a report job may wait for a worker before the reporting
+    page gives up on it.'''
+    return datetime.timedelta(
+        seconds=getattr(settings, 'REPORT_JOB_WAIT', 30))
+
+
+class ReportJob(models.Model):
+
+    '''A report which is calculated by the `report_worker` command rather
+    than in the request which asked for it.
+
+    Jobs are identified by a key made from the report's url, the span of
+    control of whoever asked for it and the version of the data it reads
+    (see :mod:`timetracker.reporting.jobs`), so asking for a report which
+    is already being calculated, or has been and hasn't changed since,
+    gives back the same job.
+    '''
+
+    STATUS_CHOICES = (
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    )
+
+    key = models.CharField(max_length=32, unique=True)
+    # the url of the report, as if it were downloaded directly.
+    path = models.CharField(max_length=255)
+    # who asked for it first, the report is calculated as them.
+    user = models.ForeignKey(Tbluser, related_name="report_jobs")
+    # hash of the ids in the span of control the report covers.
+    span = models.CharField(max_length=32)
+    status = models.CharField(choices=STATUS_CHOICES, max_length=7,
+                              default='PENDING')
+    created = models.DateTimeField()
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    expires = models.DateTimeField(null=True)
+    filename = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblreportjob'
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s - %s' % (self.path, self.user_id, self.status)
+
+    @property
+    def result_path(self):
+        '''Where the result of the job is written.'''
+        return os.path.join(report_job_dir(), '%s.csv' % self.key)
+
+    def is_expired(self, now=None):
+        '''Whether the job finished so long ago that its result is gone,
+        or is going.'''
+        return self.expires is not None and \
+            self.expires <= (now or datetime.datetime.now())
+
+    @staticmethod
+    def get_or_submit(key, path, user, span):
+        '''The job with the key, if it's still useful, otherwise a new
+        pending job.
+
+        :returns: A tuple of the job and whether it was created.'''
+        now = datetime.datetime.now()
+        for _ in range(2):
+            try:
+                job = ReportJob.objects.get(key=key)
+            except ReportJob.DoesNotExist:
+                pass
+            else:
+                if job.status != 'FAILED' and not job.is_expired(now):
+                    return job, False
+                ReportJob.objects.filter(id=job.id).delete()
+            sid = transaction.savepoint()
+            try:
+                job = ReportJob.objects.create(key=key, path=path,
+                                               user=user, span=span,
+                                               created=now)
+                transaction.savepoint_commit(sid)
+                return job, True
+            except IntegrityError:
+                # somebody else submitted it in the meantime
+                transaction.savepoint_rollback(sid)
+        return ReportJob.objects.get(key=key), False
+
+    def claim(self):
+        '''Marks the job as running, unless another worker got to it
+        first.
+
+        :returns: Whether the job was claimed.'''
+        now = datetime.datetime.now()
+        claimed = ReportJob.objects.filter(
+            id=self.id, status='PENDING'
+            ).update(status='RUNNING', started=now)
+        if claimed:
+            self.status = 'RUNNING'
+            self.started = now
+        return bool(claimed)
+
+    def finish(self, filename='', error=''):
+        '''Records the outcome of the job.'''
+        self.finished = datetime.datetime.now()
+        self.status = 'FAILED' if error else 'DONE'
+        self.filename = filename
+        self.error = error
+        self.expires = self.finished + report_job_expiry()
+        self.save()
@@ -1,9 +1,10 @@
 from django.conf.urls import patterns, include, url
 
-from timetracker.reporting import views
+from timetracker.reporting import views, jobs
 
 YEAR = '(?P<year>\d{4})'
 MONTH = '(?P<month>\d{1,2})'
+DATE = '\d{4}-\d{2}-\d{2}'
 
 urlpatterns = patterns(
     '',
@@ -13,4 +14,7 @@ urlpatterns = patterns(
     url(r'^ot_by_month/%s/%s/?$' % (YEAR, MONTH), views.ot_by_month),
     url(r'^ot_by_year/%s/?$' % YEAR, views.ot_by_year),
     url(r'^hols_for_yearmonth/%s/?$' % YEAR, views.holidays_for_yearmonth),
+    url(r'^balance_by_range/(?P<start>%s)/(?P<end>%s)/?$' % (DATE, DATE),
+        views.balance_by_range),
+    url(r'^jobs/(?P<key>[0-9a-f]{32})/?$', jobs.download_report_job),
 )
@@ -7,34 +7,35 @@ do the basic set up of creating a buffer object, inserting the BOM and
 pushing it back to the user.
 '''
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
 import datetime
 import csv
+from itertools import chain
 
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.http import HttpResponse, Http404
 
-from timetracker.utils.decorators import admin_check, loggedin
-from timetracker.tracker.models import Tbluser, TrackingEntry
+from timetracker.utils.decorators import (admin_check, loggedin,
+                                          data_versioned)
+from timetracker.tracker.models import (Tbluser, TrackingEntry, DataVersion,
+                                        ArchivedEntry, BalanceIndex,
+                                        MonthSnapshot, entry_model)
 from timetracker.tracker.models import Tblauthorization as tblauth
-from timetracker.utils.datemaps import generate_employee_box, generate_month_box, MONTH_MAP
-from timetracker.utils.writers import UnicodeWriter
+from timetracker.utils.datemaps import (generate_employee_box,
+                                        generate_month_box, MONTH_MAP,
+                                        DAYTYPE_CHOICES)
+from timetracker.utils.writers import CSVWriter
+from timetracker.utils.records import EntryPolicy, entry_records
 
 @admin_check
 def reporting(request):
     '''Base reporting hub
     Generates all the select boxes and pre-filled text fields.
     '''
-    user = Tbluser.objects.get(id=request.session.get("user_id"))
     return render_to_response(
         "reporting.html",
         {
-            "employee_box": generate_employee_box(user),
+            "employee_box": generate_employee_box(),
             "yearbox_hol": datetime.datetime.now().year,
             "monthbox_hol": generate_month_box("monthbox_hol"),
             "monthbox_ot": generate_month_box("monthbox_ot"),
@@ -42,7 +43,19 @@ def reporting(request):
         },
         RequestContext(request))
 
+def user_stamps(request, who=None):
+    '''Reports on a single user depend on all of their data and on the
+    teams, which decide whether the report can be seen at all.'''
+    if not who:
+        return None
+    return DataVersion.of_user(who) | DataVersion.of_details()
+
+def period_stamps(request, year=None, month=None):
+    '''Reports on a period depend on everyone's data in that period.'''
+    return DataVersion.of_period(year, month) if year else None
+
 @admin_check
+@data_versioned(user_stamps)
 def download_all_holiday_data(request, who=None):
     '''Endpoint which creates a CSV file for all holiday data for a
     single employee.
@@ -59,20 +72,26 @@ def download_all_holiday_data(request, who=None):
     except Tbluser.DoesNotExist:
         raise Http404
 
-    buf = StringIO()
-    buf.write("\xef\xbb\xbf")
-    csvfile = UnicodeWriter(buf)
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
     csvfile.writerow(TrackingEntry.headings())
 
-    for entry in TrackingEntry.objects.filter(user_id=who):
-        csvfile.writerow(entry.display_as_csv())
+    policies = EntryPolicy.for_users([target_user])
+    csvfile.writerows(
+        entry.display_as_csv()
+        for entry in chain(
+            entry_records(ArchivedEntry.objects.filter(user_id=who),
+                          policies),
+            entry_records(TrackingEntry.objects.filter(user_id=who),
+                          policies)))
 
-    response = HttpResponse(buf.getvalue(), mimetype="text/csv")
+    csvfile.flush()
     response['Content-Disposition'] = \
         'attachment;filename=AllHolidayData_%s.csv' % target_user.id
     return response
 
 @admin_check
+@data_versioned(period_stamps)
 def yearmonthhol(request, year=None, month=None):
     '''Endpoint which creates a CSV file for all holiday data within
     a specific month.
@@ -82,22 +101,26 @@ def yearmonthhol(request, year=None, month=None):
 
     :note: Both year and mont are required.'''
     auth_user = Tbluser.objects.get(id=request.session.get("user_id"))
-    buf = StringIO()
-    buf.write("\xef\xbb\xbf")
-    csvfile = UnicodeWriter(buf)
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
     csvfile.writerow(TrackingEntry.headings())
-    for user in auth_user.get_subordinates():
-        for entry in TrackingEntry.objects.filter(
-            entry_date__year=year,
-            entry_date__month=month,
-            user_id=user.id):
-            csvfile.writerow(entry.display_as_csv())
-    response = HttpResponse(buf.getvalue(), mimetype="text/csv")
+    entries = entry_model(year)
+    users = list(auth_user.get_subordinates())
+    policies = EntryPolicy.for_users(users)
+    for user in users:
+        csvfile.writerows(
+            entry.display_as_csv() for entry in entry_records(
+                entries.objects.filter(entry_date__year=year,
+                                       entry_date__month=month,
+                                       user_id=user.id),
+                policies))
+    csvfile.flush()
     response['Content-Disposition'] = \
         'attachment;filename=HolidayData_%s_%s.csv' % (year, month)
     return response
 
 @admin_check
+@data_versioned(period_stamps)
 def ot_by_month(request, year=None, month=None):
     '''Endpoint which creates a CSV file for all OT in a given month
 
@@ -106,31 +129,48 @@ def ot_by_month(request, year=None, month=None):
 
     :note: Both year and mont are required.'''
     auth_user = Tbluser.objects.get(id=request.session.get("user_id"))
-    buf = StringIO()
-    buf.write("\xef\xbb\xbf")
-    csvfile = UnicodeWriter(buf)
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
     csvfile.writerow(
         ["Name", "Team", MONTH_MAP[int(month)-1][1]]
         )
     total_balance = 0
-    for user in auth_user.get_subordinates():
-        balance = user.get_total_balance(ret='flo', year=year, month=month)
+    users = list(auth_user.get_subordinates())
+    snapshots = MonthSnapshot.for_users(users, year, [month])
+    # the months which aren't closed are summed by the database, apart
+    # from the markets which calculate their balances themselves.
+    live = [user.id for user in users
+            if (user.id, int(month)) not in snapshots
+            and not user.policy.calculation]
+    balances = Tbluser.regular_balances(
+        entry_model(year).objects.filter(entry_date__year=year,
+                                         entry_date__month=month),
+        live) if live else {}
+    for user in users:
+        snapshot = snapshots.get((user.id, int(month)))
+        if snapshot:
+            balance = snapshot.balance
+        elif user.id in balances:
+            balance = balances[user.id]
+        else:
+            balance = user.get_total_balance(ret='flo', year=year,
+                                             month=month)
         total_balance += balance
         csvfile.writerow([user.name(), user.process, "%.2f" % balance])
     csvfile.writerow(["Total", "Total", "%.2f" % total_balance])
-    response = HttpResponse(buf.getvalue(), mimetype="text/csv")
+    csvfile.flush()
     response['Content-Disposition'] = \
         'attachment;filename=OT_By_Month_%s_%s.csv' % (year, month)
     return response
 
 @admin_check
+@data_versioned(period_stamps)
 def ot_by_year(request, year=None):
     '''Endpoint which creates a CSV file for all OT in a year.
     :param year: The year for the report.'''
     auth_user = Tbluser.objects.get(id=request.session.get("user_id"))
-    buf = StringIO()
-    buf.write("\xef\xbb\xbf")
-    csvfile = UnicodeWriter(buf)
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
     csvfile.writerow(
         ["Name", "Team"] + [MONTH_MAP[n][1] for n in range(0,12)]
         )
@@ -138,22 +178,89 @@ def ot_by_year(request, year=None):
     balances = {
         n: 0 for n in range(1, 13)
         }
-    for user in auth_user.get_subordinates():
+    users = list(auth_user.get_subordinates())
+    snapshots = MonthSnapshot.for_users(users, year)
+    BalanceIndex.prefetch(users, [year])
+    for user in users:
         row = [user.name(), user.process]
         for month in range(1, 13):
-            balance = user.get_total_balance(ret='flo', year=year, month=month)
+            snapshot = snapshots.get((user.id, month))
+            if snapshot:
+                balance = snapshot.balance
+            else:
+                balance = user.get_total_balance(ret='flo', year=year,
+                                                 month=month)
             balances[month] += balance
             row.append("%.2f" % balance if balance != 0.0 else "-")
         csvfile.writerow(row)
     totalrow = ["Total", "Total"]
     [totalrow.append("%.2f" % balances[n]) for n in range(1,13)]
     csvfile.writerow(totalrow)
-    response = HttpResponse(buf.getvalue(), mimetype="text/csv")
+    csvfile.flush()
     response['Content-Disposition'] = \
         'attachment;filename=OT_By_Year_%s_%s.csv' % (year, month)
     return response
 
+def range_stamps(request, start=None, end=None):
+    '''Reports on a range of dates depend on everyone's data in the years
+    the range covers.'''
+    try:
+        start, end = parse_range(start, end)
+    except ValueError:
+        return None
+    query = DataVersion.of_details()
+    for year in range(start.year, end.year + 1):
+        query |= DataVersion.of_period(year)
+    return query
+
+def parse_range(start, end):
+    '''Parses the dates of a range report.'''
+    start, end = [datetime.datetime.strptime(date, "%Y-%m-%d").date()
+                  for date in (start, end)]
+    if start > end:
+        raise ValueError("The range ends before it starts.")
+    return start, end
+
+@admin_check
+@data_versioned(range_stamps)
+def balance_by_range(request, start=None, end=None):
+    '''Endpoint which creates a CSV file of the balance and the number of
+    days of each daytype for every employee between two dates.
+
+    The totals are read from the :class:`BalanceIndex` of each year, so
+    the report costs the same whether the range is a week or a fiscal
+    year.
+
+    :param start: The first day of the range, as YYYY-MM-DD.
+    :param end: The last day of the range, as YYYY-MM-DD.'''
+    try:
+        start, end = parse_range(start, end)
+    except ValueError:
+        raise Http404
+    auth_user = Tbluser.objects.get(id=request.session.get("user_id"))
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
+    csvfile.writerow(
+        ["Name", "Team", "Balance"] + [name for _, name in DAYTYPE_CHOICES]
+        )
+    users = list(auth_user.get_subordinates())
+    BalanceIndex.prefetch(users, range(start.year, end.year + 1))
+    total_balance = 0
+    for user in users:
+        balance = user.get_range_balance(start, end)
+        total_balance += balance
+        counts = user.range_totals(start, end,
+                                   *[code for code, _ in DAYTYPE_CHOICES])
+        csvfile.writerow([user.name(), user.process, "%.2f" % balance]
+                         + [str(count) for count in counts])
+    csvfile.writerow(["Total", "Total", "%.2f" % total_balance])
+    csvfile.flush()
+    response['Content-Disposition'] = \
+        'attachment;filename=Balance_%s_%s.csv' % (start, end)
+    return response
+
 @admin_check
+@data_versioned(period_stamps)
 def holidays_for_yearmonth(request, year=None):
     '''Endpoint which creates a CSV file for all holidays per month
     in a year
@@ -162,25 +269,31 @@ def holidays_for_yearmonth(request, year=None):
     if not year:
         raise Http404
     auth_user = Tbluser.objects.get(id=request.session.get("user_id"))
-    buf = StringIO()
-    buf.write("\xef\xbb\xbf")
-    csvfile = UnicodeWriter(buf)
+    response = HttpResponse(mimetype="text/csv")
+    csvfile = CSVWriter(response, bom=True)
     csvfile.writerow(
         ["Name"] + [MONTH_MAP[n][1] for n in range(0,12)] + ["Used", "Remaining"]
         )
-    for user in auth_user.get_subordinates():
+    entries = entry_model(year)
+    users = list(auth_user.get_subordinates())
+    snapshots = MonthSnapshot.for_users(users, year)
+    for user in users:
         row = [user.name()]
         total = 0
         for month in range(1,13):
-            e = TrackingEntry.objects.filter(user_id=user.id,
-                                             entry_date__year=year,
-                                             entry_date__month=month,
-                                             daytype="HOLIS").count()
+            snapshot = snapshots.get((user.id, month))
+            if snapshot:
+                e = snapshot.daytype_count("HOLIS")
+            else:
+                e = entries.objects.filter(user_id=user.id,
+                                           entry_date__year=year,
+                                           entry_date__month=month,
+                                           daytype="HOLIS").count()
             total += e
             row.append(e)
         row.append(["%d" % total, "%d" % user.holiday_balance])
         csvfile.writerow(row)
-    response = HttpResponse(buf.getvalue(), mimetype="text/csv")
+    csvfile.flush()
     response['Content-Disposition'] = \
         'attachment;filename=Holidays_for_year%s.csv' % year
     return response
@@ -0,0 +1,62 @@
+/*global $*/
+/*
+   Employee boxes are a text box which searches the span of control
+   of the logged in user as it's typed into and a hidden #user_select
+   input holding the id of the chosen employee. Choosing an employee
+   triggers the change event of #user_select so that the pages can
+   treat it as they treated the select box it replaced.
+*/
+
+function employeeSearch(box) {
+    "use strict";
+
+    var all = box.closest(".employee-search").attr("all");
+
+    box.autocomplete({
+        minLength: 0,
+        delay: 150,
+        source: function (request, response) {
+            $.ajax({
+                type: "GET",
+                url: "/ajax/",
+                dataType: "json",
+                data: {
+                    form_type: "employee_search",
+                    q: request.term,
+                    all: all
+                },
+                success: function (data) {
+                    response($.map(data.results || [], function (employee) {
+                        return {
+                            label: employee.name + " (" + employee.user_id + ")",
+                            value: employee.name,
+                            id: employee.id
+                        };
+                    }));
+                },
+                error: function () {
+                    response([]);
+                }
+            });
+        },
+        select: function (event, ui) {
+            box.siblings("#user_select")
+                .val(ui.item.id)
+                .trigger("change");
+        }
+    });
+    return box;
+}
+
+$(function () {
+    "use strict";
+
+    // the boxes are created the first time they're used so that boxes
+    // loaded into the page later on work as well.
+    $(document).on("focus", ".employee-search-box", function () {
+        var box = $(this);
+        if (!box.data("autocomplete")) {
+            employeeSearch(box).autocomplete("search", "");
+        }
+    });
+});
@@ -1,6 +1,22 @@
-/*global $,document,window,js_calendar,alert,change_table_data,retrieveComments,table_year,table_month*/
+/*global $,document,window,js_calendar,alert,change_table_data,retrieveComments,table_year,table_month,setTimeout,clearTimeout,previous*/
 
 var mouseState = false;
+
+/*
+   The rows of the table are fetched a page at a time and only those in
+   view are drawn, the rows above and below are stood in for by the
+   spacer rows. holiday_rows holds the rows fetched so far by their
+   position in the table.
+*/
+var holiday_rows = [],
+    holiday_total = null,
+    holiday_loading = {},
+    holiday_generation = 0,
+    holiday_rendered = null,
+    holiday_poll = null,
+    row_height = 22,
+    ROW_BUFFER = 10;
+
 document.onmousedown = function (e) {
 	"use strict";
     mouseState = true;
@@ -174,14 +190,14 @@ function submit_holidays(user_id) {
     return true;
 }
 
-function addFunctions() {
+function bindCells(rows) {
     "use strict";
 
     // all the daytype classes
     // are assigned a click handler which
     // swaps the colour depending on what
     // it currently is.
-    $("#holiday-table")
+    rows
         .find('.empty, .DAYOD, .TRAIN, '
             + '.WKDAY, .SICKD, .HOLIS, '
             + '.SPECI, .MEDIC, .PUABS, '
@@ -209,6 +225,258 @@ function addFunctions() {
                 $(this).addClass("selected");
             }
         });
+    return true;
+}
+
+function escapeHtml(text) {
+    "use strict";
+    return $("<div/>").text(text).html();
+}
+
+function rowHtml(row) {
+    "use strict";
+    /*
+       Draws a row from the data fetched for it, the daytypes are taken
+       from js_calendar so that changes which haven't been submitted yet
+       survive the row being scrolled out of view.
+    */
+    var html = [],
+        days = js_calendar[row.id],
+        klass = '',
+        x = 0;
+
+    html.push('<tr id="' + row.id + '_row" class="holiday-row">');
+    html.push('<th onclick="highlight_row(' + row.id + ')" class="user-td">'
+              + escapeHtml(row.name) + '</th>');
+    html.push('<td>' + row.balance + '</td>');
+    html.push('<td>' + row.dod + '</td>');
+    html.push('<td class="job_code">' + escapeHtml(row.job_code) + '</td>');
+    for (x = 1; x <= row.days.length; x += 1) {
+        klass = days[x];
+        if (klass === "empty" && row.days[x - 1] === "WKEND") {
+            klass = "WKEND";
+        }
+        html.push('<td usrid=' + row.id + ' class=' + klass + '>' + x + '</td>');
+    }
+    html.push('<td><input value="submit" type="button" user_id="' + row.id
+              + '" onclick="submit_holidays(' + row.id + ')" /></td>');
+    html.push('</tr>');
+    return html.join('');
+}
+
+function fetchRows(offset) {
+    "use strict";
+    /*
+       Fetches the page of rows starting at offset, the rows are drawn
+       once they arrive if they're in view.
+    */
+    var generation = holiday_generation,
+        process = $("#process_select").val();
+
+    if (holiday_loading[offset]) {
+        return true;
+    }
+    holiday_loading[offset] = true;
+    if (process === "ALL" || process == null) {
+        process = "";
+    }
+
+    $.ajax({
+        type: "GET",
+        dataType: "json",
+        url: "/ajax/",
+        data: {
+            form_type: "holiday_rows",
+            year: $("#holiday-table").attr("year"),
+            month: $("#holiday-table").attr("month"),
+            process: process,
+            name: $("#name_filter").val() || "",
+            job_code: $("#job_code_filter").val() || "",
+            offset: offset,
+            limit: $("#holiday-table").attr("page_size")
+        },
+        success: function (data) {
+            var x = 0,
+                row = null;
+            // the filters or the month changed in the meantime.
+            if (generation !== holiday_generation) {
+                return;
+            }
+            if (data.success !== true) {
+                alert(data.error);
+                return;
+            }
+            holiday_total = data.total;
+            for (x = 0; x < data.rows.length; x += 1) {
+                row = data.rows[x];
+                holiday_rows[data.offset + x] = row;
+                js_calendar[row.id] = ["empty"].concat($.map(row.days, function (day) {
+                    return day === "WKEND" ? "empty" : day;
+                }));
+                $.each(row.comments, function (idx, comment) {
+                    $("#comments-list").append($("<li/>").text(comment));
+                });
+            }
+            holiday_rendered = null;
+            renderRows();
+        },
+        error: function (ajaxObj, textStatus, error) {
+            holiday_loading[offset] = false;
+            alert(error);
+        }
+    });
+    return true;
+}
+
+function renderRows() {
+    "use strict";
+    /*
+       Draws the rows which are in view, fetching the pages of any which
+       haven't been fetched yet.
+    */
+    var top = $("#holiday-top"),
+        page_size = parseInt($("#holiday-table").attr("page_size"), 10),
+        html = [],
+        first = 0,
+        last = 0,
+        x = 0,
+        rows = null;
+
+    if (!top.length || holiday_total === null) {
+        return true;
+    }
+    first = Math.floor(($(window).scrollTop() - top.offset().top) / row_height);
+    first = Math.min(Math.max(first - ROW_BUFFER, 0), holiday_total);
+    last = Math.min(
+        first + Math.ceil($(window).height() / row_height) + 2 * ROW_BUFFER,
+        holiday_total
+    );
+    if (holiday_rendered === first + ":" + last) {
+        return true;
+    }
+    holiday_rendered = first + ":" + last;
+
+    for (x = first; x < last; x += 1) {
+        if (holiday_rows[x]) {
+            html.push(rowHtml(holiday_rows[x]));
+        } else {
+            html.push('<tr class="holiday-row"><td colspan="100">'
+                      + 'Loading...</td></tr>');
+            fetchRows(x - x % page_size);
+        }
+    }
+
+    $("#holiday-table tr.holiday-row").remove();
+    top.after(html.join(''));
+    rows = $("#holiday-table tr.holiday-row");
+    if (rows.length && holiday_rows[first]) {
+        row_height = rows.first().outerHeight() || row_height;
+    }
+    top.children("td").height(first * row_height);
+    $("#holiday-bottom").children("td").height((holiday_total - last) * row_height);
+    bindCells(rows);
+    if (previous) {
+        $("#" + previous + "_row").addClass("highlighted-row");
+    }
+    return true;
+}
+
+function pollChanges() {
+    "use strict";
+    /*
+       Waits for the cells changed since the version the table has and
+       draws them in place, then waits for the next ones. The server holds
+       the request until something changes, so this doesn't load it while
+       nothing does.
+    */
+    var generation = holiday_generation,
+        process = $("#process_select").val(),
+        retry = function () {
+            // unless the month or the filters changed in the meantime.
+            if (generation === holiday_generation) {
+                pollChanges();
+            }
+        };
+
+    if (process === "ALL" || process == null) {
+        process = "";
+    }
+
+    holiday_poll = $.ajax({
+        type: "GET",
+        dataType: "json",
+        url: "/ajax/",
+        data: {
+            form_type: "holiday_changes",
+            year: $("#holiday-table").attr("year"),
+            month: $("#holiday-table").attr("month"),
+            process: process,
+            version: $("#holiday-table").attr("version"),
+            seen: $("#holiday-table").attr("seen")
+        },
+        success: function (data) {
+            var x = 0,
+                cell = null;
+            if (generation !== holiday_generation) {
+                return;
+            }
+            if (data.success !== true) {
+                setTimeout(retry, 5000);
+                return;
+            }
+            for (x = 0; x < data.cells.length; x += 1) {
+                cell = data.cells[x];
+                // rows which haven't been fetched get the change with them.
+                if (js_calendar[cell.user]) {
+                    js_calendar[cell.user][cell.day] = cell.daytype;
+                }
+            }
+            $("#holiday-table").attr("version", data.version);
+            $("#holiday-table").attr("seen", data.seen);
+            if (data.cells.length) {
+                holiday_rendered = null;
+                renderRows();
+            }
+            pollChanges();
+        },
+        error: function (ajaxObj, textStatus, error) {
+            if (textStatus !== "abort") {
+                setTimeout(retry, 5000);
+            }
+        }
+    });
+    return true;
+}
+
+function resetRows() {
+    "use strict";
+    /*
+       Forgets the fetched rows and fetches the first page again, used
+       whenever the month or the filters change.
+    */
+    holiday_generation += 1;
+    if (holiday_poll !== null) {
+        holiday_poll.abort();
+        holiday_poll = null;
+    }
+    holiday_rows = [];
+    holiday_total = null;
+    holiday_loading = {};
+    holiday_rendered = null;
+    js_calendar = {};
+    $("#comments-list").empty();
+    $("#holiday-table tr.holiday-row").remove();
+    fetchRows(0);
+    if ($("#holiday-table").attr("version") !== undefined) {
+        pollChanges();
+    }
+    return true;
+}
+
+function addFunctions() {
+    "use strict";
+
+    var filter_timer = null;
 
     $("#year_select").val($("#holiday-table").attr("year"));
     $("#month_select").val($("#holiday-table").attr("month"));
@@ -219,10 +487,16 @@ function addFunctions() {
     $("#year_select, #month_select, #process_select").change(function () {
         change_table_data();
     });
+    $("#name_filter, #job_code_filter").keyup(function () {
+        // wait for the typing to stop before fetching.
+        clearTimeout(filter_timer);
+        filter_timer = setTimeout(resetRows, 300);
+    });
 
     $("#holiday-table")
         .attr("border", "1");
 
+    resetRows();
     return true;
 }
 
@@ -237,6 +511,8 @@ function change_table_data() {
     var year = $("#year_select").val(),
         month = $("#month_select").val(),
         process = $("#process_select").val(),
+        name = $("#name_filter").val(),
+        job_code = $("#job_code_filter").val(),
 	    url = [];
 
     if (process === "ALL") {
@@ -264,7 +540,9 @@ function change_table_data() {
 				var holiday_html = '',
 				    comments_html = '',
 				    table_year = '',
-				    table_month = '';
+				    table_month = '',
+				    table_version = '',
+				    table_seen = '';
                 if ($("#isie").attr("isie") === "true") {
                     $("#comments-wrapper").load(
                         url + " #com-field"
@@ -272,6 +550,8 @@ function change_table_data() {
                     $("#holiday-wrapper").load(
                         url + " #holiday-table",
                         function () {
+                            $("#name_filter").val(name);
+                            $("#job_code_filter").val(job_code);
                             addFunctions();
                             retrieveComments();
                         }
@@ -281,11 +561,19 @@ function change_table_data() {
                     comments_html = $(data).find("#comments-wrapper").html();
                     table_year = $(data).find("#holiday-table").attr("year");
                     table_month = $(data).find("#holiday-table").attr("month");
+                    table_version = $(data).find("#holiday-table").attr("version");
+                    table_seen = $(data).find("#holiday-table").attr("seen");
                     $("#com-field").html(comments_html);
                     $("#holiday-table").html(holiday_html);
                 }
                 $("#holiday-table").attr("year", table_year);
                 $("#holiday-table").attr("month", table_month);
+                if (table_version) {
+                    $("#holiday-table").attr("version", table_version);
+                    $("#holiday-table").attr("seen", table_seen);
+                }
+                $("#name_filter").val(name);
+                $("#job_code_filter").val(job_code);
                 addFunctions();
                 $("#year_select").val(year);
                 $("#month_select").val(month);
@@ -294,11 +582,6 @@ function change_table_data() {
                 } else {
                     $("#process_select").val(process);
                 }
-                $(data).find("div").each(function () {
-                    if ($(this).attr("id") === "newjs") {
-                        eval($(this).text());
-                    }
-                });
                 $("#holiday-wrapper, #comments-wrapper").fadeTo(500, 1);
             });
         }
@@ -426,6 +709,15 @@ function retrieveComments() {
 
 $(function () {
     "use strict";
+    var scroll_timer = null;
     addFunctions();
     $("#pic").hide();
+    $(window).bind("scroll resize", function () {
+        if (scroll_timer === null) {
+            scroll_timer = setTimeout(function () {
+                scroll_timer = null;
+                renderRows();
+            }, 50);
+        }
+    });
 });
@@ -1,9 +1,89 @@
-/*global $,alert,window*/
+/*global $,alert,window,setTimeout*/
 function isNumber(n) {
 	"use strict";
 	return !isNaN(parseFloat(n)) && isFinite(n);
 }
 
+function reportStatus(text) {
+    "use strict";
+    $("#report_status").text(text);
+}
+
+function pollReport(key, delay) {
+    /*
+       Asks after a submitted report until it's been calculated, backing
+       off up to every 5 seconds, then downloads it. If no worker takes
+       the report on the server says so and it's downloaded directly.
+    */
+    "use strict";
+    $.ajax({
+        type: "GET",
+        url: "/ajax/",
+        dataType: "json",
+        data: {
+            form_type: "report_job_status",
+            key: key
+        },
+        success: function (data) {
+            if (!data.success || data.status === "FAILED") {
+                reportStatus("");
+                alert(data.error || "The report failed.");
+            } else if (data.status === "DONE") {
+                reportStatus("");
+                window.location.assign(data.download);
+            } else if (data.fallback) {
+                // no worker picked it up, so it's calculated directly.
+                reportStatus("");
+                window.location.assign(data.fallback);
+            } else {
+                setTimeout(function () {
+                    pollReport(key, Math.min(delay * 2, 5000));
+                }, delay);
+            }
+        },
+        error: function () {
+            reportStatus("");
+            alert("The report couldn't be checked.");
+        }
+    });
+}
+
+function download(path) {
+    /*
+       Reports are calculated in the background, so rather than going
+       to the report's url we submit it and wait for it to be done.
+    */
+    "use strict";
+    reportStatus("Preparing report...");
+    $.ajax({
+        type: "POST",
+        url: "/ajax/",
+        dataType: "json",
+        data: {
+            form_type: "report_job",
+            path: path
+        },
+        success: function (data) {
+            if (!data.success) {
+                reportStatus("");
+                alert(data.error);
+            } else if (data.status === "DONE") {
+                reportStatus("");
+                window.location.assign(data.download);
+            } else if (data.fallback) {
+                reportStatus("");
+                window.location.assign(data.fallback);
+            } else {
+                pollReport(data.key, 500);
+            }
+        },
+        error: function () {
+            reportStatus("");
+            alert("The report couldn't be submitted.");
+        }
+    });
+}
+
 function overtime_data() {
 	"use strict";
     alert("Not implemented");
@@ -14,7 +94,7 @@ function all_holiday_data() {
     if ($("#user_select").val() === "null") {
         return;
     }
-    window.location.assign(
+    download(
         "/reporting/all/" + $("#user_select").val()  + "/"
     );
 }
@@ -23,7 +103,7 @@ function yearmonth_holiday_data() {
 	"use strict";
     var year =  $("#yearbox_hol").val();
     if (isNumber(year) && year.length >= 4) {
-        window.location.assign([
+        download([
 			"/reporting/yearmonthhol/",
             year + "/",
             $("#monthbox_hol").val() + "/"
@@ -39,7 +119,7 @@ function ot_by_month() {
 	"use strict";
     var year = $("#yearbox_ot_month").val();
     if (isNumber(year) && year.length >= 4) {
-        window.location.assign([
+        download([
 			"/reporting/ot_by_month/",
             year + "/",
             $("#monthbox_ot").val() + "/"
@@ -55,7 +135,7 @@ function ot_by_year() {
 	"use strict";
     var year = $("#yearbox_ot_year").val();
     if (isNumber(year) && year.length >= 4) {
-        window.location.assign([
+        download([
 			"/reporting/ot_by_year/",
             year + "/",
         ].join("")
@@ -70,7 +150,7 @@ function holidays_for_yearmonth() {
 	"use strict";
     var year = $("#yearbox_hols_year").val();
     if (isNumber(year) && year.length >= 4) {
-        window.location.assign([
+        download([
 			"/reporting/hols_for_yearmonth/",
             year + "/"
         ].join("")
@@ -80,3 +160,20 @@ function holidays_for_yearmonth() {
         alert("Invalid year.");
     }
 }
+
+function balance_by_range() {
+	"use strict";
+    var start = $("#range_start").val(),
+        end = $("#range_end").val(),
+        date = /^\d{4}-\d{2}-\d{2}$/;
+    if (date.test(start) && date.test(end) && start <= end) {
+        download([
+			"/reporting/balance_by_range/",
+            start + "/",
+            end + "/"
+        ].join("")
+							  );
+    } else {
+        alert("Invalid range.");
+    }
+}
@@ -246,6 +246,7 @@ function ajaxSuccess() {
     setupUI();
     clearForm();
     $("#user_select").val("null");
+    $(".employee-search-box").val("");
     $("#user_select").change(function () {
         onOptionChange();
     });
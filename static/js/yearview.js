@@ -12,5 +12,4 @@ $(function () {
     $("#user_select").change(onchanger);
     $("#cmb_yearbox").change(onchanger);
     $("#cmb_yearbox").val($("#hidden_year").text());
-    $("#user_select").val($("#hidden_ee").text());
 });
@@ -4,7 +4,11 @@ administrating the application.
 '''
 
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.core.mail import send_mail
+from django.core.paginator import Paginator, Page, InvalidPage
+from django.db import connections
 
 from timetracker.tracker import models
 from timetracker.utils.error_codes import CONNECTION_REFUSED
@@ -60,6 +64,124 @@ def create_100_random_users(modeladmin, request, queryset):
             )
 
 
+# tables estimated to have fewer rows than this are counted exactly.
+EXACT_COUNT_LIMIT = 100000
+
+
+def estimated_count(queryset):
+    '''An estimate of the number of rows in the table of `queryset` which
+    doesn't scan it, None when the database can't give one.
+
+    PostgreSQL and MySQL keep statistics of their tables, SQLite's largest
+    id is found from its index and is only off by the rows deleted.'''
+    connection = connections[queryset.db]
+    quote = connection.ops.quote_name
+    table = queryset.model._meta.db_table
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute('SELECT table_rows FROM information_schema.tables '
+                       'WHERE table_schema = DATABASE() AND table_name = %s',
+                       [table])
+    else:
+        cursor.execute('SELECT MAX(%s) FROM %s' % (
+                quote(queryset.model._meta.pk.column), quote(table)))
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return int(row[0])
+
+
+def _count(queryset):
+    '''The number of rows of `queryset`, estimated when it's the whole of
+    a large table.
+
+    :returns: A tuple of the number and whether it's an estimate.'''
+    if not queryset.query.where:
+        estimate = estimated_count(queryset)
+        if estimate is not None and estimate >= EXACT_COUNT_LIMIT:
+            return estimate, True
+    return queryset.count(), False
+
+
+class EstimatedCountPaginator(Paginator):
+    '''Pages through a large table without counting every row of it when
+    it isn't filtered.
+
+    An estimate can be more than there are rows, SQLite's always is once
+    rows have been deleted, so the count is cut down to the rows which
+    are found as soon as a page comes back short and a page past the end
+    gives the last page instead.'''
+
+    _estimated = False
+
+    def _get_count(self):
+        '''The total number of objects, estimated over the whole table.'''
+        if self._count is None:
+            self._count, self._estimated = _count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def page(self, number):
+        '''Returns a Page object for the given 1-based page number.'''
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = self.object_list[bottom:bottom + self.per_page]
+        found = len(rows)
+        if self._estimated and found < self.per_page:
+            self._estimated = False
+            self._num_pages = None
+            if found or number == 1:
+                self._count = bottom + found
+            else:
+                # the page is past the end, only counting finds where it is.
+                self._count = self.object_list.count()
+                return self.page(self.num_pages)
+        return Page(rows, number, self)
+
+
+class EstimatedCountChangeList(ChangeList):
+    '''A changelist which estimates the number of rows of the whole table,
+    rather than counting them, both when the list isn't filtered and for the
+    total which is shown next to a filtered list.'''
+
+    def get_results(self, request):
+        '''Gets the page of results as the ChangeList does, but with the
+        total of the whole table estimated.'''
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        result_count = paginator.count
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                page = paginator.page(self.page_num + 1)
+            except InvalidPage:
+                raise IncorrectLookupParameters
+            result_list = page.object_list
+            # the page may have found the estimate was too high.
+            self.page_num = page.number - 1
+            result_count = paginator.count
+            multi_page = result_count > self.list_per_page
+
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = _count(self.root_query_set)[0]
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
 class UserAdmin(admin.ModelAdmin):
     """Creates access to and customizes the admin interface to the tbluser
     instances. We give the list_display of __unicode__ and a 2nd type of
@@ -83,6 +205,12 @@ class RelatedAdmin(admin.ModelAdmin):
     """
     list_display = ('__unicode__', 'display_users')
 
+    def queryset(self, request):
+        '''Loads the managers and the users of every link of the page
+        together, rather than row by row.'''
+        return super(RelatedAdmin, self).queryset(request).select_related(
+            'admin').prefetch_related('users')
+
 
 class AuthAdmin(admin.ModelAdmin):
     filter_horizontal = ('users',)
@@ -93,6 +221,12 @@ class AuthAdmin(admin.ModelAdmin):
     """
     list_display = ('__unicode__', 'display_users')
 
+    def queryset(self, request):
+        '''Loads the managers and the users of every link of the page
+        together, rather than row by row.'''
+        return super(AuthAdmin, self).queryset(request).select_related(
+            'admin').prefetch_related('users')
+
 
 class TrackerAdmin(admin.ModelAdmin):
     """Creates access to and customizes the admin interface to the
@@ -100,8 +234,18 @@ class TrackerAdmin(admin.ModelAdmin):
     additions because the default values are useful enough as the interface to
     edit these items is far more useful and better programmed than the basic
     model editor the admin interface provides.
+
+    The table is very large, so the changelist loads the user along with
+    each entry, estimates the number of entries rather than counting them
+    and the user is picked by id.
     """
-    pass
+    list_select_related = True
+    paginator = EstimatedCountPaginator
+    raw_id_fields = ('user',)
+
+    def get_changelist(self, request, **kwargs):
+        '''The changelist which estimates the size of the table.'''
+        return EstimatedCountChangeList
 
 
 admin.site.register(models.Tbluser, UserAdmin)
@@ -0,0 +1,60 @@
+'''
+Base classes shared by the tracker's management commands.
+'''
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timetracker.utils.profiling import (profile_call, memory_profiling,
+                                         PROFILE_MODES)
+from timetracker.utils.replica import use_replica
+
+
+class ProfiledCommand(BaseCommand):
+    '''A command which accepts `--profile=cpu|mem`.
+
+    When given, the whole command is run under
+    :func:`timetracker.utils.profiling.profile_call` and the files that
+    were written are listed once the command finishes.
+
+    Commands which only read, such as the reports, set `read_only` so
+    that they read from the replica when there is one.'''
+
+    read_only = False
+
+    option_list = BaseCommand.option_list + (
+        make_option('--profile',
+                    action='store',
+                    default=None,
+                    dest='profile',
+                    type='choice',
+                    choices=PROFILE_MODES,
+                    help='Profile the command, either cpu or mem.'),
+        )
+
+    def execute(self, *args, **options):
+        '''Runs the command, reading from the replica if it's read only.'''
+        if self.read_only:
+            with use_replica():
+                return self._execute(*args, **options)
+        return self._execute(*args, **options)
+
+    def _execute(self, *args, **options):
+        '''Runs the command, profiling it if requested.'''
+        mode = options.get('profile')
+        if not mode:
+            return super(ProfiledCommand, self).execute(*args, **options)
+        if mode == 'mem' and not memory_profiling():
+            sys.stderr.write(self.style.ERROR(
+                "Error: Memory profiling requires tracemalloc.\n"))
+            sys.exit(1)
+        name = self.__module__.rsplit('.', 1)[-1]
+        result, files = profile_call(
+            name, mode, super(ProfiledCommand, self).execute,
+            *args, **options
+            )
+        for path in files:
+            sys.stderr.write("Profile written to %s\n" % path)
+        return result
@@ -0,0 +1,74 @@
+'''
+Moves the tracking entries of closed years into the archive.
+
+The entries of each year are moved into the ArchivedEntry table and every
+user who had entries that year gets a summary row with their balance and
+the number of entries of each daytype. The balances, yearviews and
+reports read archived years from the archive, so nothing changes for the
+users, but the live table only holds the years still being worked on::
+
+    manage.py archive_years 2011 2012
+    manage.py archive_years --before=2013
+    manage.py archive_years --restore 2012
+
+Entries can't be added to or changed in an archived year until it's
+restored.
+'''
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import CommandError
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.models import TrackingEntry, ArchivedYear
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    args = '<year year ...>'
+    help = 'Moves the tracking entries of closed years into the archive.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--before',
+                    action='store',
+                    type='int',
+                    default=None,
+                    dest='before',
+                    help='Archive every year before this one.'),
+        make_option('--restore',
+                    action='store_true',
+                    default=False,
+                    dest='restore',
+                    help='Move the years back out of the archive.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        try:
+            years = set(int(year) for year in args)
+        except ValueError:
+            raise CommandError("Years must be numbers.")
+        if options['before']:
+            years.update(date.year for date in
+                         TrackingEntry.objects.dates('entry_date', 'year')
+                         if date.year < options['before'])
+        if not years:
+            raise CommandError("No years given.")
+
+        current = datetime.datetime.now().year
+        if not options['restore'] and max(years) >= current:
+            raise CommandError("Only years before %d can be archived." %
+                               current)
+
+        for year in sorted(years):
+            try:
+                if options['restore']:
+                    moved = ArchivedYear.restore(year)
+                    self.stdout.write("Restored %d entries of %d\n" % (
+                            moved, year))
+                else:
+                    moved = ArchivedYear.archive(year)
+                    self.stdout.write("Archived %d entries of %d\n" % (
+                            moved, year))
+            except ValueError as error:
+                raise CommandError(str(error))
@@ -11,8 +11,9 @@ import csv
 import calendar
 from optparse import make_option
 
-from timetracker.tracker.models import Tbluser, TrackingEntry
-from django.core.management.base import BaseCommand
+from timetracker.tracker.models import Tbluser, MonthSnapshot, entry_model
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.utils.worktime import annotate
 
 
 QUERIES = 0
@@ -111,18 +112,52 @@ def blankrow(user, year, month, day):
         ]
 
 def realrow(user, year, month, day, entry):
-    '''Returns a real row for the user.'''
+    '''Returns a real row for the user.
+
+    :param entry: A tuple of the daytype of the entry and its hours
+                  rounded to the nearest half hour.'''
+    daytype, hours = entry
     return [
         "", user.user_id, "%s/%s/%s" % (month, day, year),
-        catw_code(user, entry.daytype), "400",
+        catw_code(user, daytype), "400",
         # the rest are empty except for the time.
-        "", "","", "", "", "%.2f" % entry.nearest_half(),
+        "", "","", "", "", "%.2f" % hours,
         "","","","","","","",""
         ]
 
+def catw_rows(user, year, month, entries):
+    '''The rows of the CATW report of a user for a month.
+
+    :param entries: A dict of tuples of the daytype and rounded hours of
+                    the user's entries in the month keyed by their dates
+                    as strings.'''
+    # get a list of valid day numbers for the month we're creating
+    # the report for. Prefix all single-digit digits with a leading
+    # "0" so they format well for the date strings.
+    days_this_month = [day if day > 9 else "0%d" % day for day in filter(
+            lambda x: x > 0,
+            list(calendar.Calendar().itermonthdays(year, month))
+            )]
+    # Prefix the month digit with a leading "0"
+    months = month if month > 9 else "0%d" % month
+
+    rows = []
+    for day in days_this_month:
+        entry = entries.get("%s-%s-%s" % (year, months, day))
+        if entry:
+            rows.append(realrow(user, year, months, day, entry))
+        else:
+            rows.append(blankrow(user, year, months, day))
+    return rows
+
 def report_for_account(choice_list, year, month):
     '''
     Writes out the report to disk.
+
+    The rows of users with a snapshot of a closed month are read from the
+    snapshot, only the others are calculated from their entries. The hours
+    of those are rounded by the database, so only the columns the report
+    needs are loaded.
     '''
 
     accs, filename = choice_list
@@ -131,44 +166,33 @@ def report_for_account(choice_list, year, month):
     csvout.writerow(HEADINGS)
 
     users = Tbluser.objects.filter(market__in=accs)
-    entries = TrackingEntry.objects.select_related("user").filter(
-        user__market__in=accs,
+    snapshots = MonthSnapshot.for_users(users, year, [month])
+    live = [user.id for user in users
+            if (user.id, month) not in snapshots]
+    entries = annotate(entry_model(year).objects.filter(
+        user__in=live,
         entry_date__year=year,
         entry_date__month=month
-        )
+        ), 'half_hours').values_list(
+        'user_id', 'entry_date', 'daytype', 'half_hours') if live else []
 
     # we generate the map using blank dicts since we need to use the
     # id of the employee (who may not have any entries this month).
-    entry_map = {user.id: {} for user in users}
-    for entry in entries:
-        if entry_map.get(entry.user.id):
-            entry_map[entry.user.id][str(entry.entry_date)] = entry
-        else:
-            entry_map[entry.user.id] = {
-                str(entry.entry_date): entry
-                }
-
-    # get a list of valid day numbers for the month we're creating
-    # the report for. Prefix all single-digit digits with a leading
-    # "0" so they format well for the date strings.
-    days_this_month = [day if day > 9 else "0%d" % day for day in filter(
-            lambda x: x > 0,
-            list(calendar.Calendar().itermonthdays(year, month))
-            )]
-    # Prefix the month digit with a leading "0"
-    months = month if month > 9 else "0%d" % month
+    entry_map = {user_id: {} for user_id in live}
+    for user_id, entry_date, daytype, half_hours in entries:
+        entry_map[user_id][str(entry_date)] = (daytype, half_hours / 2.0)
 
     for user in users:
-        for day in days_this_month:
-            entry = entry_map[user.id].get("%s-%s-%s" % (year, months, day))
-            if entry:
-                csvout.writerow(realrow(user, year, months, day, entry))
-            else:
-                csvout.writerow(blankrow(user, year, months, day))
-
-class Command(BaseCommand):
+        snapshot = snapshots.get((user.id, month))
+        if snapshot:
+            csvout.writerows(snapshot.catw_rows())
+        else:
+            csvout.writerows(catw_rows(user, year, month, entry_map[user.id]))
+
+class Command(ProfiledCommand):
     '''Implementation of a Django command.'''
-    option_list = BaseCommand.option_list + (
+    read_only = True
+    option_list = ProfiledCommand.option_list + (
         make_option('--year',
                     action='store',
                     default=datetime.datetime.now().year,
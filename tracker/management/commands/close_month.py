@@ -0,0 +1,208 @@
+'''
+Closes a month, freezing the totals of every user for it.
+
+Each user gets a snapshot of their balance, hours worked, the number of
+entries of each daytype, their overtime entries and their CATW rows for
+the month. The CATW, month end overtime, OT by month/year and holidays
+reports read closed months from the snapshots rather than from the
+entries::
+
+    manage.py close_month --year=2012 --month=11
+    manage.py close_month --year=2012 --month=11 --verify
+    manage.py close_month --year=2012 --month=11 --reopen
+
+Without a year and month the previous month is closed. The entries of a
+closed month can't be changed, to correct one the month is reopened and
+closed again. `--verify` recalculates the month from its entries and
+lists where it differs from the snapshots, which only happens when the
+entries were changed behind the models' back, such as by bulk updates.
+'''
+
+import datetime
+from itertools import chain
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.db import transaction
+
+import simplejson
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.management.commands.catw_report import (CHOICES,
+                                                                 catw_rows)
+from timetracker.tracker.management.commands.mec_ot_report import (
+    overtime_map, get_previous_month)
+from timetracker.tracker.models import (Tbluser, BalanceIndex, ClosedMonth,
+                                        MonthSnapshot, entry_model)
+from timetracker.utils.records import EntryPolicy, entry_records
+
+# the markets which have a CATW report.
+CATW_MARKETS = set(chain(*[markets for markets, _ in CHOICES]))
+
+
+def month_totals(year, month):
+    '''Calculates the totals of every user for a month from the entries.
+
+    :returns: A dict keyed by the user id of dicts with the fields of a
+              :class:`MonthSnapshot`.'''
+    users = list(Tbluser.objects.all())
+    BalanceIndex.prefetch(users, [year])
+    entry_map = {user.id: {} for user in users}
+    for entry in entry_records(entry_model(year).objects.filter(
+            entry_date__year=year, entry_date__month=month),
+                               EntryPolicy.for_users(users)):
+        entry_map[entry.user.id][str(entry.entry_date)] = entry
+
+    first = datetime.date(year, month, 1)
+    last = (first + datetime.timedelta(days=31)).replace(day=1) \
+        - datetime.timedelta(days=1)
+    totals = {}
+    for user in users:
+        entries = entry_map[user.id]
+        daytypes = {}
+        for entry in entries.values():
+            daytypes[entry.daytype] = daytypes.get(entry.daytype, 0) + 1
+        totals[user.id] = {
+            'balance': user.get_total_balance(ret='flo', year=year,
+                                              month=month),
+            'hours': user.range_totals(first, last, "worked")[0] / 60.0,
+            'daytypes': daytypes,
+            'overtime': overtime_map(entries.values()),
+            'catw': catw_rows(user, year, month, dict(
+                    (date, (entry.daytype, entry.nearest_half()))
+                    for date, entry in entries.items()))
+                    if user.market in CATW_MARKETS else [],
+            }
+    return totals
+
+
+@transaction.commit_on_success
+def close(year, month):
+    '''Writes the snapshots of a month and marks it closed.
+
+    :returns: The number of snapshots which were written.'''
+    if ClosedMonth.is_closed(year, month):
+        raise ValueError("%d/%d has already been closed." % (month, year))
+    totals = month_totals(year, month)
+    MonthSnapshot.objects.bulk_create([
+        MonthSnapshot(user_id=user_id, year=year, month=month,
+                      balance=values['balance'], hours=values['hours'],
+                      daytypes=simplejson.dumps(values['daytypes']),
+                      overtime=simplejson.dumps(values['overtime']),
+                      catw=simplejson.dumps(values['catw']))
+        for user_id, values in totals.items()
+        ])
+    ClosedMonth.objects.create(year=year, month=month,
+                               closed=datetime.datetime.now())
+    return len(totals)
+
+
+@transaction.commit_on_success
+def reopen(year, month):
+    '''Throws away the snapshots of a closed month.'''
+    if not ClosedMonth.is_closed(year, month):
+        raise ValueError("%d/%d hasn't been closed." % (month, year))
+    MonthSnapshot.objects.filter(year=year, month=month).delete()
+    ClosedMonth.objects.filter(year=year, month=month).delete()
+
+
+def _rounded(value):
+    '''Rounds the hours in a value so that they can be compared.'''
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {key: _rounded(item) for key, item in value.items()}
+    return value
+
+
+def verify(year, month):
+    '''Compares the snapshots of a closed month with the month calculated
+    from the entries as they are now.
+
+    :returns: A list of (user id, field, snapshot value, current value) of
+              the differences.'''
+    if not ClosedMonth.is_closed(year, month):
+        raise ValueError("%d/%d hasn't been closed." % (month, year))
+    totals = month_totals(year, month)
+    differences = []
+    for snapshot in MonthSnapshot.objects.filter(year=year, month=month):
+        current = totals.get(snapshot.user_id)
+        if current is None:
+            continue
+        frozen = {
+            'balance': snapshot.balance,
+            'hours': snapshot.hours,
+            'daytypes': simplejson.loads(snapshot.daytypes),
+            'overtime': snapshot.overtime_map(),
+            'catw': snapshot.catw_rows(),
+            }
+        for field in ('balance', 'hours', 'daytypes', 'overtime', 'catw'):
+            # the snapshot has been through json, so the current values
+            # have to be as well to compare them.
+            value = simplejson.loads(simplejson.dumps(current[field]))
+            if _rounded(value) != _rounded(frozen[field]):
+                differences.append((snapshot.user_id, field,
+                                    frozen[field], value))
+    return differences
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    help = 'Freezes the totals of every user for a month.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--year',
+                    action='store',
+                    type='int',
+                    default=None,
+                    dest='year',
+                    help='The year of the month to close.'),
+        make_option('--month',
+                    action='store',
+                    type='int',
+                    default=None,
+                    dest='month',
+                    help='The month to close, defaults to the last one.'),
+        make_option('--verify',
+                    action='store_true',
+                    default=False,
+                    dest='verify',
+                    help='Compare the snapshots with the entries.'),
+        make_option('--reopen',
+                    action='store_true',
+                    default=False,
+                    dest='reopen',
+                    help='Throw the snapshots away.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        previous = get_previous_month(datetime.date.today())
+        year = options['year'] or previous.year
+        month = options['month'] or previous.month
+        if not 1 <= month <= 12:
+            raise CommandError("Months are 1 to 12.")
+
+        try:
+            if options['verify']:
+                differences = verify(year, month)
+                for user_id, field, frozen, current in differences:
+                    self.stdout.write("%s %s: %r closed, %r now\n" % (
+                            user_id, field, frozen, current))
+                if differences:
+                    raise CommandError(
+                        "%d differences in %d/%d." % (len(differences),
+                                                      month, year))
+                self.stdout.write("%d/%d matches its entries\n" % (month,
+                                                                   year))
+            elif options['reopen']:
+                reopen(year, month)
+                self.stdout.write("Reopened %d/%d\n" % (month, year))
+            else:
+                if datetime.date(year, month, 1) > previous:
+                    raise CommandError("Only months which have ended can "
+                                       "be closed.")
+                count = close(year, month)
+                self.stdout.write("Closed %d/%d for %d users\n" % (
+                        month, year, count))
+        except ValueError as error:
+            raise CommandError(str(error))
@@ -0,0 +1,132 @@
+'''
+Compares the speed of the CSV writers on a large export.
+
+The same rows, shaped like the holiday data exports, are written with
+:class:`timetracker.utils.writers.UnicodeWriter` a row at a time and with
+:class:`timetracker.utils.writers.CSVWriter` a row at a time, with
+writerows and streamed with iterencode. The output is hashed rather than
+kept so that only the writers are measured, and every writer has to
+produce the same document::
+
+    manage.py csv_benchmark
+    manage.py csv_benchmark --rows=100000 --dialect=excel-semicolon
+'''
+
+import csv
+import time
+import hashlib
+import datetime
+from itertools import cycle, islice
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timetracker.utils.writers import UnicodeWriter, CSVWriter
+
+NAMES = [u'Jan Nov\xe1k', u'Aaron France', u'Zs\xf3fia Kov\xe1cs',
+         u'\u0141ukasz Wi\u015bniewski', u'Jo\xe3o Silva']
+DAYTYPES = [u'Work Day', u'Vacation', u'Sickness Absence', u'Training']
+
+
+def sample_rows(count=1000):
+    '''A pool of rows like those of the holiday data exports.'''
+    start = datetime.date(2012, 1, 1)
+    return [[NAMES[number % len(NAMES)],
+             start + datetime.timedelta(days=number % 365),
+             datetime.time(9, number % 60), datetime.time(17, 30),
+             datetime.time(0, 15), DAYTYPES[number % len(DAYTYPES)],
+             u'Comment, "quoted"' if number % 7 == 0 else u'',
+             number, number / 8.0]
+            for number in range(count)]
+
+
+class Digest(object):
+    '''A stream which only hashes what's written to it.'''
+    def __init__(self):
+        self.hash = hashlib.md5()
+        self.write = self.hash.update
+
+
+def unicode_writer(rows, dialect):
+    '''The writer the reports used to use.'''
+    stream = Digest()
+    writer = UnicodeWriter(stream, dialect=dialect)
+    for row in rows:
+        writer.writerow(row)
+    return stream.hash.hexdigest()
+
+
+def csv_writerow(rows, dialect):
+    '''CSVWriter a row at a time.'''
+    stream = Digest()
+    writer = CSVWriter(stream, dialect=dialect)
+    for row in rows:
+        writer.writerow(row)
+    writer.flush()
+    return stream.hash.hexdigest()
+
+
+def csv_writerows(rows, dialect):
+    '''CSVWriter given all of the rows.'''
+    stream = Digest()
+    writer = CSVWriter(stream, dialect=dialect)
+    writer.writerows(rows)
+    writer.flush()
+    return stream.hash.hexdigest()
+
+
+def csv_iterencode(rows, dialect):
+    '''CSVWriter streaming the rows.'''
+    stream = Digest()
+    for data in CSVWriter(dialect=dialect).iterencode(rows):
+        stream.write(data)
+    return stream.hash.hexdigest()
+
+
+WRITERS = [
+    ('UnicodeWriter', unicode_writer),
+    ('CSVWriter.writerow', csv_writerow),
+    ('CSVWriter.writerows', csv_writerows),
+    ('CSVWriter.iterencode', csv_iterencode),
+    ]
+
+
+class Command(BaseCommand):
+    '''Implementation of a Django command.'''
+    help = 'Compares the speed of the CSV writers.'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows',
+                    action='store',
+                    type='int',
+                    default=1000000,
+                    dest='rows',
+                    help='How many rows to write.'),
+        make_option('--dialect',
+                    action='store',
+                    type='choice',
+                    choices=csv.list_dialects(),
+                    default='excel',
+                    dest='dialect',
+                    help='The dialect to write.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['rows'] < 1:
+            raise CommandError("Rows must be at least 1.")
+        pool = sample_rows()
+        digests = set()
+        baseline = None
+        self.stdout.write("%-22s %9s %12s %8s\n" % ('', 'seconds', 'rows/s',
+                                                    'speedup'))
+        for name, writer in WRITERS:
+            rows = islice(cycle(pool), options['rows'])
+            started = time.time()
+            digests.add(writer(rows, options['dialect']))
+            taken = time.time() - started
+            baseline = baseline or taken
+            self.stdout.write("%-22s %8.2fs %12d %7.1fx\n" % (
+                    name, taken, options['rows'] / max(taken, 1e-9),
+                    baseline / max(taken, 1e-9)))
+        if len(digests) != 1:
+            raise CommandError("The writers wrote different documents.")
@@ -0,0 +1,156 @@
+'''
+Compares the memory and speed of loading entries as models and as
+records.
+
+The reports used to load every entry as a :class:`TrackingEntry`, they now
+load :class:`timetracker.utils.records.EntryRecord` objects. The same rows,
+built in memory so that only the objects are measured, are turned into
+each and run through the calculations of a holiday data export and of the
+overtime view::
+
+    manage.py entry_benchmark
+    manage.py entry_benchmark --rows=100000 --sample=5000
+
+The footprint is the memory of a sample of the objects which is held by
+each object alone, anything shared between them, such as a daytype, is
+only counted once over the sample. The throughput is measured over all of
+the rows, which are streamed as an export streams them.
+'''
+
+import gc
+import sys
+import time
+import datetime
+from itertools import cycle, islice
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from timetracker.tracker.models import Tbluser, TrackingEntry
+from timetracker.utils.records import EntryPolicy, EntryRecord
+
+DAYTYPES = ['WKDAY', 'WKDAY', 'WKDAY', 'HOLIS', 'SICKD', 'ROVER', 'WKHOM']
+
+
+def sample_user():
+    '''A user like those the entries belong to.'''
+    return Tbluser(id=1, user_id='aaron.france@example.com',
+                   firstname='Aaron', lastname='France', market='BG',
+                   breaklength=datetime.time(0, 15),
+                   shiftlength=datetime.time(7, 45))
+
+
+def sample_rows(count=1000):
+    '''A pool of rows as values_list gives them, in the order of
+    :attr:`EntryRecord.FIELDS`.'''
+    start = datetime.date(2012, 1, 1)
+    rows = []
+    for number in range(count):
+        begin = 8 * 60 + number % 90
+        end = 16 * 60 + number % 150
+        breaks = 15 + number % 30
+        rows.append((1, start + datetime.timedelta(days=number % 365),
+                     datetime.time(*divmod(begin, 60)),
+                     datetime.time(*divmod(end, 60)),
+                     datetime.time(*divmod(breaks, 60)),
+                     DAYTYPES[number % len(DAYTYPES)],
+                     u'Comment' if number % 7 == 0 else u'',
+                     begin, end, breaks))
+    return rows
+
+
+def models(rows, user):
+    '''The rows as models, built as a queryset builds them with their user
+    cached as select_related would cache it.'''
+    # querysets give the columns in the order of the model's fields.
+    order = [EntryRecord.FIELDS.index(field.attname)
+             for field in TrackingEntry._meta.fields if field.attname != 'id']
+    for number, row in enumerate(rows):
+        entry = TrackingEntry(number, *[row[index] for index in order])
+        entry._user_cache = user
+        yield entry
+
+
+def records(rows, user):
+    '''The rows as records sharing a policy.'''
+    policy = EntryPolicy(user)
+    for row in rows:
+        yield EntryRecord(policy, *row[1:])
+
+
+def footprint(objects):
+    '''The bytes held by the objects, on average.'''
+    seen = set()
+    total = 0
+    pending = list(objects)
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, (Tbluser, EntryPolicy)):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if hasattr(item, '__dict__'):
+            pending.append(item.__dict__)
+        if isinstance(item, dict):
+            pending.extend(item.values())
+        for slot in getattr(type(item), '__slots__', ()):
+            pending.append(getattr(item, slot, None))
+    return total / float(len(objects))
+
+
+def throughput(objects):
+    '''Runs the calculations of the reports over the objects.
+
+    :returns: How many objects were calculated per second.'''
+    started = time.time()
+    count = 0
+    for entry in objects:
+        entry.display_as_csv()
+        entry.overtime_class()
+        entry.nearest_half()
+        count += 1
+    return count / max(time.time() - started, 1e-9)
+
+
+KINDS = [
+    ('TrackingEntry', models),
+    ('EntryRecord', records),
+    ]
+
+
+class Command(BaseCommand):
+    '''Implementation of a Django command.'''
+    help = 'Compares the memory and speed of entry models and records.'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows',
+                    action='store',
+                    type='int',
+                    default=1000000,
+                    dest='rows',
+                    help='How many entries to calculate.'),
+        make_option('--sample',
+                    action='store',
+                    type='int',
+                    default=10000,
+                    dest='sample',
+                    help='How many entries to measure the memory of.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['rows'] < 1 or options['sample'] < 1:
+            raise CommandError("Rows and sample must be at least 1.")
+        user = sample_user()
+        # the sample doesn't share any values between its entries.
+        pool = sample_rows(options['sample'])
+        self.stdout.write("%-14s %14s %14s %12s\n" % (
+                '', 'bytes/entry', 'MB/%d' % options['rows'], 'entries/s'))
+        for name, kind in KINDS:
+            sample = list(kind(islice(cycle(pool), options['sample']), user))
+            size = footprint(sample)
+            del sample
+            gc.collect()
+            rate = throughput(kind(islice(cycle(pool), options['rows']),
+                                   user))
+            self.stdout.write("%-14s %14.1f %14.1f %12d\n" % (
+                    name, size, size * options['rows'] / 2 ** 20, rate))
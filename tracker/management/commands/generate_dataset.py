@@ -0,0 +1,361 @@
+'''
+Generates a synthetic dataset for load and scale testing.
+
+The dataset is made up of one SUPER user per market who is linked to the
+managers (ADMIN) of that market. Each manager has a team with a team
+leader and a share of the agents, some managers are also given related
+users from other teams. Every agent then gets tracking entries for each
+day of the years requested with a realistic mix of daytypes and
+over/undertime.
+
+Everything is inserted with bulk_create in batches and the output only
+depends on the options given, so the same seed always gives the same
+dataset::
+
+    manage.py generate_dataset --agents=5000 --years=3 --seed=42
+'''
+
+import time
+import bisect
+import random
+import datetime
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.models import (Tbluser, TrackingEntry,
+                                        Tblauthorization, RelatedUsers,
+                                        DataVersion)
+
+# daytype weights for the days of the week an agent should work.
+WEEKDAY_MIX = (
+    ('WKDAY', 850),
+    ('HOLIS', 60),
+    ('WKHOM', 30),
+    ('SICKD', 20),
+    ('PUABS', 12),
+    ('TRAIN', 10),
+    ('DAYOD', 5),
+    ('SPECI', 4),
+    ('ROVER', 4),
+    ('OTHER', 3),
+    ('PUWRK', 2),
+    )
+
+# the chance of an agent working on any given weekend day.
+WEEKEND_WORK = 0.02
+
+# the chance of an agent forgetting to track a day.
+UNTRACKED = 0.03
+
+# minutes either side of the shiftlength worked, with their weights.
+OVERTIME_MIX = (
+    (0, 700),
+    (15, 60), (30, 40), (45, 20), (60, 15), (90, 8), (120, 5),
+    (180, 2), (240, 1),
+    (-15, 60), (-30, 35), (-45, 9), (-60, 5),
+    )
+
+SHIFTLENGTHS = (
+    (datetime.time(7, 45), 50),
+    (datetime.time(8, 0), 30),
+    (datetime.time(7, 30), 15),
+    (datetime.time(6, 0), 5),
+    )
+
+BREAKLENGTHS = (
+    (datetime.time(0, 15), 20),
+    (datetime.time(0, 30), 50),
+    (datetime.time(0, 45), 10),
+    (datetime.time(1, 0), 20),
+    )
+
+FIRST_NAMES = ('Anna', 'Piotr', 'Jan', 'Eva', 'Tomas', 'Lena', 'Marek',
+               'Julia', 'Karl', 'Sofia', 'Pavel', 'Maria', 'Lukas', 'Irena')
+LAST_NAMES = ('Novak', 'Kowalski', 'Muller', 'Schmidt', 'Dvorak', 'Nowak',
+              'Fischer', 'Wagner', 'Svoboda', 'Lewandowski', 'Becker')
+
+
+def weighted(rng, choices):
+    '''Picks from a tuple of (value, weight) pairs.'''
+    try:
+        values, bounds = _TABLES[choices]
+    except KeyError:
+        values, bounds, total = [], [], 0
+        for value, weight in choices:
+            total += weight
+            values.append(value)
+            bounds.append(total)
+        _TABLES[choices] = values, bounds
+    return values[bisect.bisect_right(bounds, rng.random() * bounds[-1])]
+
+# the cumulative weights of the tables above, built on first use.
+_TABLES = {}
+
+
+def add_minutes(time_, minutes):
+    '''Adds minutes to a :class:`datetime.time`, clamped to the day.'''
+    total = max(0, min(time_.hour * 60 + time_.minute + minutes, 23 * 60 + 59))
+    return datetime.time(total // 60, total % 60)
+
+
+def minutes(time_):
+    '''Minutes in a :class:`datetime.time`.'''
+    return time_.hour * 60 + time_.minute
+
+
+def make_user(rng, email, user_type, market, start_date, password):
+    '''Creates an unsaved :class:`Tbluser`.'''
+    return Tbluser(
+        user_id=email,
+        firstname=rng.choice(FIRST_NAMES),
+        lastname=rng.choice(LAST_NAMES),
+        password=password,
+        user_type=user_type,
+        market=market,
+        process=rng.choice(Tbluser.PROCESS_CHOICES[1:])[0],
+        start_date=start_date,
+        breaklength=weighted(rng, BREAKLENGTHS),
+        shiftlength=weighted(rng, SHIFTLENGTHS),
+        job_code=rng.choice(Tbluser.JOB_CODES)[0],
+        holiday_balance=rng.choice((20, 24, 25, 26)),
+        disabled=False
+        )
+
+
+def entries_for_user(rng, user, days):
+    '''Generates the unsaved tracking entries of a user over `days`.'''
+    shift = minutes(user.shiftlength)
+    for day in days:
+        weekend = day.isoweekday() in (6, 7)
+        if weekend:
+            if rng.random() >= WEEKEND_WORK:
+                continue
+            daytype = 'SATUR'
+        else:
+            if rng.random() < UNTRACKED:
+                continue
+            daytype = weighted(rng, WEEKDAY_MIX)
+
+        if daytype in ('WKDAY', 'WKHOM', 'SATUR', 'PUWRK'):
+            start = datetime.time(rng.choice((7, 8, 8, 9, 9, 9)),
+                                  rng.choice((0, 15, 30, 45)))
+            breaks = user.breaklength
+            if rng.random() < 0.1:
+                breaks = add_minutes(breaks, 15)
+            worked = shift + minutes(breaks) + weighted(rng, OVERTIME_MIX)
+            end = add_minutes(start, worked)
+        else:
+            # non-working days are tracked as the holiday page does.
+            start = datetime.time(9, 0)
+            end = add_minutes(start, shift)
+            breaks = user.breaklength
+
+        yield TrackingEntry(user_id=user.id, entry_date=day, start_time=start,
+                            end_time=end, breaks=breaks, daytype=daytype,
+                            comments='')
+
+
+def bulk_insert(model, objects, batch_size):
+    '''Inserts an iterable of unsaved instances in batches.
+
+    :returns: The number of instances inserted.'''
+    total = 0
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == batch_size:
+            model.objects.bulk_create(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+        total += len(batch)
+    return total
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    help = 'Generates a synthetic dataset of users, teams and tracking ' \
+           'entries for load testing.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--seed',
+                    action='store',
+                    type='int',
+                    default=0,
+                    dest='seed',
+                    help='The random seed, defaults to 0.'),
+        make_option('--agents',
+                    action='store',
+                    type='int',
+                    default=1000,
+                    dest='agents',
+                    help='The number of agents to create.'),
+        make_option('--team-size',
+                    action='store',
+                    type='int',
+                    default=50,
+                    dest='team_size',
+                    help='The number of agents per manager.'),
+        make_option('--years',
+                    action='store',
+                    type='int',
+                    default=2,
+                    dest='years',
+                    help='The number of years of entries to create.'),
+        make_option('--end-year',
+                    action='store',
+                    type='int',
+                    default=datetime.datetime.now().year,
+                    dest='end_year',
+                    help='The last year to create entries for.'),
+        make_option('--markets',
+                    action='store',
+                    default='BF,BG,BK,CZ,EN,NE',
+                    dest='markets',
+                    help='Comma separated markets to spread the users over.'),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    default=2000,
+                    dest='batch_size',
+                    help='The number of rows inserted per query.'),
+        make_option('--prefix',
+                    action='store',
+                    default='gen',
+                    dest='prefix',
+                    help='Prefix of the generated e-mail addresses.'),
+        make_option('--password',
+                    action='store',
+                    default='password',
+                    dest='password',
+                    help='The password given to every generated user.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        markets = [m for m in options['markets'].split(',') if m]
+        unknown = set(markets) - set(m[0] for m in Tbluser.MARKET_CHOICES)
+        if unknown or not markets:
+            raise CommandError("Unknown markets: %s" % ', '.join(unknown))
+        if options['agents'] < 1 or options['team_size'] < 1 \
+                or options['years'] < 1 or options['batch_size'] < 1:
+            raise CommandError("Counts must be positive.")
+        prefix = options['prefix']
+        if Tbluser.objects.filter(user_id__startswith=prefix + '.').exists():
+            raise CommandError("Users with the prefix %s already exist." %
+                               prefix)
+        self.generate(random.Random(options['seed']), markets, options)
+
+    def report(self, phase, count, started):
+        '''Writes out the timing of a phase.'''
+        self.stdout.write("%-10s %10d rows %8.1fs\n" % (
+                phase, count, time.time() - started))
+
+    @transaction.commit_on_success
+    def generate(self, rng, markets, options):
+        '''Generates the whole dataset in a single transaction.'''
+        prefix = options['prefix']
+        batch_size = options['batch_size']
+        first_year = options['end_year'] - options['years'] + 1
+        start_date = datetime.date(first_year, 1, 1)
+        num_managers = -(-options['agents'] // options['team_size'])
+        password = options['password']
+
+        # users
+        started = time.time()
+        users = []
+
+        def add_user(name, user_type, market):
+            users.append(make_user(rng, '%s.%s@dataset.test' % (prefix, name),
+                                   user_type, market, start_date, password))
+
+        for market in markets:
+            add_user('super.%s' % market.lower(), 'SUPER', market)
+        for idx in range(num_managers):
+            market = markets[idx % len(markets)]
+            add_user('manager%05d' % idx, 'ADMIN', market)
+            add_user('teamlead%05d' % idx, 'TEAML', market)
+        for idx in range(options['agents']):
+            market = markets[(idx // options['team_size']) % len(markets)]
+            add_user('agent%07d' % idx, 'RUSER', market)
+        count = bulk_insert(Tbluser, users, batch_size)
+        ids = dict(Tbluser.objects.filter(
+                user_id__startswith=prefix + '.').values_list('user_id', 'id'))
+        for user in users:
+            user.id = ids[user.user_id]
+        self.report('users', count, started)
+
+        # teams
+        started = time.time()
+        supers = dict((user.market, user) for user in users
+                      if user.user_type == 'SUPER')
+        managers = [user for user in users if user.user_type == 'ADMIN']
+        leads = [user for user in users if user.user_type == 'TEAML']
+        agents = [user for user in users if user.user_type == 'RUSER']
+        teams = dict((manager.id, [lead]) for manager, lead
+                     in zip(managers, leads))
+        for idx, agent in enumerate(agents):
+            teams[managers[idx // options['team_size']].id].append(agent)
+        for manager in managers:
+            teams.setdefault(supers[manager.market].id, []).append(manager)
+
+        bulk_insert(Tblauthorization, (Tblauthorization(admin_id=admin_id)
+                                       for admin_id in sorted(teams)),
+                    batch_size)
+        links = dict(Tblauthorization.objects.filter(
+                admin__in=teams.keys()).values_list('admin_id', 'id'))
+        count = bulk_insert(
+            Tblauthorization.users.through,
+            (Tblauthorization.users.through(tblauthorization_id=links[admin],
+                                            tbluser_id=member.id)
+             for admin in sorted(teams) for member in teams[admin]),
+            batch_size)
+
+        # a fifth of the managers can also see some agents of other teams
+        related = dict((manager.id, rng.sample(agents, min(len(agents),
+                                                           rng.randint(1, 5))))
+                       for manager in managers if rng.random() < 0.2)
+        bulk_insert(RelatedUsers, (RelatedUsers(admin_id=admin_id)
+                                   for admin_id in sorted(related)),
+                    batch_size)
+        links = dict(RelatedUsers.objects.filter(
+                admin__in=related.keys()).values_list('admin_id', 'id'))
+        count += bulk_insert(
+            RelatedUsers.users.through,
+            (RelatedUsers.users.through(relatedusers_id=links[admin],
+                                        tbluser_id=member.id)
+             for admin in sorted(related) for member in related[admin]),
+            batch_size)
+        self.report('teams', count, started)
+
+        # tracking entries
+        started = time.time()
+        days = []
+        day = start_date
+        while day.year <= options['end_year']:
+            days.append(day)
+            day += datetime.timedelta(days=1)
+        count = bulk_insert(
+            TrackingEntry,
+            (entry for user in agents + leads + managers
+             for entry in entries_for_user(rng, user, days)),
+            batch_size)
+        self.report('entries', count, started)
+
+        # bulk_create doesn't send signals so we stamp the data ourselves
+        started = time.time()
+        now = datetime.datetime.now()
+        periods = [(0, 0)] + [(year, month)
+                              for year in range(first_year,
+                                                options['end_year'] + 1)
+                              for month in range(1, 13)]
+        count = bulk_insert(
+            DataVersion,
+            (DataVersion(user_id=user.id, year=year, month=month, version=1,
+                         modified=now)
+             for user in users for year, month in periods),
+            batch_size)
+        self.report('stamps', count, started)
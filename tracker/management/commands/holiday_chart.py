@@ -1,41 +1,144 @@
-'''Generates a holiday chart for a year'''
+'''Generates a chart of how many people are on holiday on each day of one
+or more years.
+
+The daily totals are counted by the database in a single grouped query,
+or one each for the live and the archived years, and binned per day of
+the year with :func:`numpy.bincount`. numpy and
+matplotlib are only imported when the command runs so that they aren't
+loaded by every invocation of manage.py.
+
+Usage::
+
+    manage.py holiday_chart 2012 2013 --markets=BG,BK --by-market \\
+        --daytypes=HOLIS,SICKD --output=/tmp/holidays.png
+'''
 
 import datetime
-import numpy as np
-import matplotlib.pyplot as plt
-
-from django.core.management.base import BaseCommand, CommandError
-from timetracker.tracker.models import TrackingEntry
-
-def gendates(year):
-    ''"Generates the dates for a given year.'''
-    m = {}
-    d = datetime.date(year, 1, 1)
-    td = datetime.timedelta(days=1)
-    while d.year == year:
-        m[d] = 0
-        d += td
-    return m
-
-class Command(BaseCommand):
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.db.models import Count, Q
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.models import Tbluser, entry_model
+from timetracker.utils.datemaps import DAYTYPE_CHOICES
+
+
+def daily_counts(years, daytypes, markets=None, by_market=False):
+    '''Counts the entries of the given daytypes per day of the year.
+
+    :param years: :class:`list` of :class:`int` years to count.
+    :param daytypes: :class:`list` of daytype short codes.
+    :param markets: :class:`list` of market short codes to restrict the
+                    count to, all markets are counted when not given.
+    :param by_market: :class:`bool` whether to split the counts per market.
+    :returns: :class:`dict` mapping a (year, market, daytype) tuple to a
+              numpy array of 366 counts indexed by the day of the year
+              minus one. market is None unless by_market is given.
+    '''
+    import numpy as np
+
+    fields = ['entry_date', 'daytype']
+    if by_market:
+        fields.append('user__market')
+
+    # gather the rows into the columns for each series before binning,
+    # the default ordering is cleared so it doesn't end up in the GROUP BY.
+    # archived years are counted in the archive.
+    columns = {}
+    by_model = {}
+    for year in years:
+        by_model.setdefault(entry_model(year), []).append(year)
+    for model, model_years in by_model.items():
+        in_years = Q()
+        for year in model_years:
+            in_years |= Q(entry_date__range=(datetime.date(year, 1, 1),
+                                             datetime.date(year, 12, 31)))
+        entries = model.objects.filter(in_years, daytype__in=daytypes)
+        if markets:
+            entries = entries.filter(user__market__in=markets)
+        rows = entries.values(*fields).annotate(total=Count('id')).order_by()
+        for row in rows:
+            date = row['entry_date']
+            key = (date.year, row.get('user__market'), row['daytype'])
+            days, totals = columns.setdefault(key, ([], []))
+            days.append(date.timetuple().tm_yday - 1)
+            totals.append(row['total'])
+
+    return dict(
+        (key, np.bincount(np.array(days, dtype=np.int64),
+                          weights=np.array(totals, dtype=np.float64),
+                          minlength=366))
+        for key, (days, totals) in columns.items()
+        )
+
+
+def series_label(key):
+    '''Creates the legend label for a series key.'''
+    return ' '.join(str(part) for part in key if part is not None)
+
+
+class Command(ProfiledCommand):
     '''Django command.'''
-    args = '<poll_id poll_id ...>'
-    help = 'Closes the specified poll for voting'
+    read_only = True
+    args = '<year year ...>'
+    help = 'Generates a chart of the holidays taken per day of the year.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--output',
+                    action='store',
+                    default='holiday_chart.png',
+                    dest='output',
+                    help='The file the chart is written to.'),
+        make_option('--markets',
+                    action='store',
+                    default='',
+                    dest='markets',
+                    help='Comma separated markets to include, '
+                         'defaults to all.'),
+        make_option('--by-market',
+                    action='store_true',
+                    default=False,
+                    dest='by_market',
+                    help='Plot a series per market.'),
+        make_option('--daytypes',
+                    action='store',
+                    default='HOLIS',
+                    dest='daytypes',
+                    help='Comma separated daytypes to plot, '
+                         'defaults to HOLIS.'),
+        )
 
     def handle(self, *args, **options):
         '''Implementation.'''
-        year = args[0]
-        totals = gendates(int(year))
-        for date_entry in TrackingEntry.objects.filter(entry_date__year=year, daytype="HOLIS"):
-            totals[date_entry.entry_date] += 1
+        try:
+            years = sorted(set(int(year) for year in args)) \
+                or [datetime.datetime.now().year]
+        except ValueError:
+            raise CommandError("Years must be numbers.")
+        daytypes = [d for d in options['daytypes'].split(',') if d]
+        unknown = set(daytypes) - set(d[0] for d in DAYTYPE_CHOICES)
+        if unknown:
+            raise CommandError("Unknown daytypes: %s" % ', '.join(unknown))
+        markets = [m for m in options['markets'].split(',') if m]
+        unknown = set(markets) - set(m[0] for m in Tbluser.MARKET_CHOICES)
+        if unknown:
+            raise CommandError("Unknown markets: %s" % ', '.join(unknown))
 
-        total_nums = [item[1] for item in totals.items()]
+        counts = daily_counts(years, daytypes, markets, options['by_market'])
 
-        N = len(total_nums)
-        ind = np.arange(N)
-        width = 0.35
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
 
-        fig = plt.figure()
+        fig = plt.figure(figsize=(16, 6))
         ax = fig.add_subplot(111)
-        rects1 = ax.bar(ind, total_nums, width, color='r')
-        fig.savefig("/home/aero/fig1.png")
+        for key in sorted(counts):
+            ax.plot(range(1, 367), counts[key], label=series_label(key))
+        ax.set_xlim(1, 366)
+        ax.set_xlabel('Day of the year')
+        ax.set_ylabel('Entries')
+        if counts:
+            ax.legend(loc='upper left', fontsize='small')
+        fig.savefig(options['output'])
+        plt.close(fig)
+        self.stdout.write("Chart written to %s\n" % options['output'])
@@ -0,0 +1,383 @@
+'''
+Replays the real user flows against the application to find out how many
+concurrent users a single worker can serve.
+
+Every worker logs in through the login page as one of the users created
+by the `generate_dataset` command and then drives the Django test client
+through the flow of its role:
+
+* agents load their calendar and then add, change and delete an entry
+  through the ajax view.
+* managers load the holiday planning page, mark a holiday for a team
+  member with mass_holidays, take it back off again and download the
+  reports.
+
+The workers run in threads, optionally spread over several processes,
+and the latency and the number of queries of every request are recorded
+against its flow. Once all the workers have finished the throughput,
+error rate, queries per request and the 50th, 95th and 99th percentile
+latencies of each flow are reported. The queries of the ajax_add,
+ajax_change and ajax_delete flows are the cost of writing an entry::
+
+    manage.py generate_dataset --agents=2000
+    manage.py loadtest --workers=20 --processes=4 --iterations=50
+
+E-mails are sent to the dummy backend whilst the test runs.
+'''
+
+import math
+import time
+import random
+import datetime
+import threading
+import multiprocessing
+from optparse import make_option
+
+import simplejson
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.client import Client
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.models import Tbluser, TrackingEntry
+from timetracker.utils.querylog import QueryCounter
+
+AJAX = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of a sorted list.'''
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Session(object):
+    '''A logged in user driving the test client.
+
+    The outcome of every request made is recorded in `results` as a
+    tuple of the flow, the seconds taken, an error message, which is None
+    when the request succeeded, and the number of queries it made.'''
+
+    def __init__(self, user, password, results):
+        self.user = user
+        self.password = password
+        self.results = results
+        self.client = Client()
+
+    def request(self, flow, method, path, data=None, ajax=False, status=200):
+        '''Makes a request, recording how it went.
+
+        :returns: The decoded json of ajax requests, otherwise the
+                  response. None if the request failed.'''
+        extra = AJAX if ajax else {}
+        started = time.time()
+        error = None
+        result = None
+        queries = QueryCounter()
+        queries.start()
+        try:
+            response = getattr(self.client, method)(path, data or {}, **extra)
+            if response.status_code != status:
+                error = 'HTTP %d' % response.status_code
+            elif ajax:
+                result = simplejson.loads(response.content)
+                if not result.get('success'):
+                    error = result.get('error') or 'unsuccessful'
+                    result = None
+            else:
+                result = response
+        except Exception as exc:
+            error = '%s: %s' % (exc.__class__.__name__, exc)
+        finally:
+            queries.stop()
+        self.results.append((flow, time.time() - started, error,
+                             queries.count))
+        return result
+
+    def login(self):
+        '''Logs in through the login page.'''
+        return self.request('login', 'post', '/login/', {
+                'user_name': self.user.user_id,
+                'password': self.password,
+                }, status=302)
+
+
+def agent_flow(session, iteration, year):
+    '''An agent looking at their calendar and tracking a day.
+
+    Each worker has its own user so the dates of a single user never
+    collide, the entries are put in `year` which should be free.'''
+    day = datetime.date(year, 1, 1) + datetime.timedelta(days=iteration % 365)
+    session.request('user_view', 'get', '/calendar/')
+    entry = {
+        'entry_date': day.isoformat(),
+        'start_time': '09:00',
+        'end_time': '17:30',
+        'breaks': '00:30:00',
+        'daytype': 'WKDAY',
+        }
+    if session.request('ajax_add', 'post', '/ajax/',
+                       dict(entry, form_type='add'), ajax=True) is None:
+        return
+    try:
+        entry['hidden-id'] = TrackingEntry.objects.get(
+            user=session.user, entry_date=day).id
+    except TrackingEntry.DoesNotExist:
+        return
+    entry['end_time'] = '18:00'
+    session.request('ajax_change', 'post', '/ajax/',
+                    dict(entry, form_type='change'), ajax=True)
+    session.request('ajax_delete', 'post', '/ajax/',
+                    {'form_type': 'delete', 'hidden-id': entry['hidden-id'],
+                     'entry_date': entry['entry_date']}, ajax=True)
+
+
+def month_daytypes(user_id, year, month):
+    '''The mass_holidays list of a user's month, as the planner sends it.'''
+    days = ['empty'] * 32
+    for entry_date, daytype in TrackingEntry.objects.filter(
+            user_id=user_id, entry_date__year=year,
+            entry_date__month=month).values_list('entry_date', 'daytype'):
+        days[entry_date.day] = daytype
+    return days
+
+
+def manager_flow(session, iteration, year, rng, team):
+    '''A manager planning holidays and downloading the reports.'''
+    month = iteration % 12 + 1
+    session.request('holiday_planning', 'get',
+                    '/holiday_planning/%d/%d' % (year, month))
+    if team:
+        member = rng.choice(team)
+        days = month_daytypes(member, year, month)
+        day = rng.randint(1, 28)
+        if days[day] == 'empty':
+            original = list(days)
+            days[day] = 'HOLIS'
+            for mass_data in (days, original):
+                session.request('mass_holidays', 'post', '/ajax/', {
+                        'form_type': 'mass_holidays',
+                        'year': year,
+                        'month': month,
+                        'mass_data': simplejson.dumps({member: mass_data}),
+                        }, ajax=True)
+    session.request('report_ot_by_month', 'get',
+                    '/reporting/ot_by_month/%d/%d/' % (year, month))
+    session.request('report_yearmonthhol', 'get',
+                    '/reporting/yearmonthhol/%d/%d/' % (year, month))
+    if team:
+        session.request('report_all', 'get',
+                        '/reporting/all/%d/' % rng.choice(team))
+
+
+def run_worker(user, options, results, seed):
+    '''Logs `user` in and runs their flow for the iterations or time
+    given in `options`.'''
+    rng = random.Random(seed)
+    session = Session(user, options['password'], results)
+    if session.login() is None:
+        return
+    team = []
+    if user.sup_tl_or_admin():
+        team = [member.id for member in user.get_subordinates()
+                if not member.sup_tl_or_admin()]
+    deadline = time.time() + options['duration'] \
+        if options['duration'] else None
+    iteration = 0
+    while True:
+        if deadline is None and iteration >= options['iterations']:
+            break
+        if deadline is not None and time.time() >= deadline:
+            break
+        if team:
+            manager_flow(session, iteration, options['manager_year'],
+                         rng, team)
+        else:
+            agent_flow(session, iteration, options['agent_year'])
+        iteration += 1
+
+
+def _run_thread(*args):
+    '''Entry point of the worker threads, each thread has its own
+    connection which is closed once it's done.'''
+    try:
+        run_worker(*args)
+    finally:
+        connection.close()
+
+
+def run_threads(users, options, seed):
+    '''Runs a worker thread per user.
+
+    :returns: :class:`list` of the results of all the workers.'''
+    results = []
+    if len(users) == 1:
+        # no need for a thread, this also lets a single worker run inside
+        # a test's transaction.
+        run_worker(users[0], options, results, seed)
+        return results
+    threads = [threading.Thread(target=_run_thread,
+                                args=(user, options, results, seed + idx))
+               for idx, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _run_process(args):
+    '''Entry point of the worker processes.'''
+    return run_threads(*args)
+
+
+def summarize(results, elapsed):
+    '''Aggregates the results per flow.
+
+    :returns: A :class:`list` of dicts ordered by the flow name, the last
+              of which is the total over all flows.'''
+    flows = {}
+    for flow, seconds, error, queries in results:
+        flows.setdefault(flow, []).append((seconds, error, queries))
+    flows['total'] = [(seconds, error, queries)
+                      for _, seconds, error, queries in results]
+    summary = []
+    for flow in sorted(flows, key=lambda name: (name == 'total', name)):
+        timings = sorted(seconds for seconds, _, _ in flows[flow])
+        errors = [error for _, error, _ in flows[flow] if error]
+        queries = sum(count for _, _, count in flows[flow])
+        row = {
+            'flow': flow,
+            'requests': len(timings),
+            'errors': len(errors),
+            'error_rate': float(len(errors)) / len(timings) if timings else 0,
+            'throughput': len(timings) / elapsed if elapsed else 0,
+            'queries': float(queries) / len(timings) if timings else 0,
+            'top_error': max(set(errors), key=errors.count) if errors
+                         else '',
+            }
+        for pct in PERCENTILES:
+            row['p%d' % pct] = percentile(timings, pct)
+        summary.append(row)
+    return summary
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    help = 'Replays agent and manager flows with concurrent workers and ' \
+           'reports the latency and error rates.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    default=10,
+                    dest='workers',
+                    help='The number of concurrent users per process.'),
+        make_option('--processes',
+                    action='store',
+                    type='int',
+                    default=1,
+                    dest='processes',
+                    help='The number of processes to run the workers in.'),
+        make_option('--iterations',
+                    action='store',
+                    type='int',
+                    default=20,
+                    dest='iterations',
+                    help='The number of times each worker runs its flow.'),
+        make_option('--duration',
+                    action='store',
+                    type='int',
+                    default=0,
+                    dest='duration',
+                    help='Run for this many seconds instead of a number '
+                         'of iterations.'),
+        make_option('--manager-ratio',
+                    action='store',
+                    type='float',
+                    default=0.1,
+                    dest='manager_ratio',
+                    help='The share of workers which are managers.'),
+        make_option('--prefix',
+                    action='store',
+                    default='gen',
+                    dest='prefix',
+                    help='The prefix the users were generated with.'),
+        make_option('--password',
+                    action='store',
+                    default='password',
+                    dest='password',
+                    help='The password of the generated users.'),
+        make_option('--year',
+                    action='store',
+                    type='int',
+                    default=datetime.datetime.now().year,
+                    dest='manager_year',
+                    help='The year managers plan and report on.'),
+        make_option('--seed',
+                    action='store',
+                    type='int',
+                    default=0,
+                    dest='seed',
+                    help='The random seed, defaults to 0.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['workers'] < 1 or options['processes'] < 1:
+            raise CommandError("There must be at least one worker.")
+        # agents track days in the year after the last one planned so they
+        # never collide with the generated entries.
+        options['agent_year'] = options['manager_year'] + 1
+        total = options['workers'] * options['processes']
+        num_managers = int(round(total * options['manager_ratio']))
+        users = Tbluser.objects.filter(user_id__startswith=options['prefix'] + '.',
+                                       disabled=False)
+        managers = list(users.filter(user_type='ADMIN')[:num_managers])
+        agents = list(users.filter(user_type='RUSER')[:total - len(managers)])
+        if len(managers) + len(agents) < total:
+            raise CommandError("Not enough users, run generate_dataset "
+                               "with more agents.")
+        rng = random.Random(options['seed'])
+        workers = managers + agents
+        rng.shuffle(workers)
+
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+        started = time.time()
+        if options['processes'] == 1:
+            results = run_threads(workers, options, options['seed'])
+        else:
+            # the children mustn't share the parent's connection.
+            connection.close()
+            pool = multiprocessing.Pool(options['processes'])
+            chunks = [(workers[idx::options['processes']], options,
+                       options['seed'] + idx * options['workers'])
+                      for idx in range(options['processes'])]
+            results = [result for chunk in pool.map(_run_process, chunks)
+                       for result in chunk]
+            pool.close()
+            pool.join()
+        elapsed = time.time() - started
+
+        self.stdout.write("%d workers (%d managers) in %.1fs\n\n" % (
+                total, len(managers), elapsed))
+        self.stdout.write("%-22s %8s %7s %7s %8s %8s %8s %8s %8s\n" % (
+                'flow', 'requests', 'errors', 'err%', 'req/s', 'queries',
+                'p50 ms', 'p95 ms', 'p99 ms'))
+        summary = summarize(results, elapsed)
+        for row in summary:
+            self.stdout.write(
+                "%-22s %8d %7d %6.1f%% %8.1f %8.1f %8.1f %8.1f %8.1f\n" % (
+                    row['flow'], row['requests'], row['errors'],
+                    row['error_rate'] * 100, row['throughput'],
+                    row['queries'], row['p50'] * 1000, row['p95'] * 1000, row['p99'] * 1000))
+        for row in summary:
+            if row['errors'] and row['flow'] != 'total':
+                self.stdout.write("%s: %s\n" % (row['flow'],
+                                                row['top_error']))
@@ -13,14 +13,21 @@ import codecs
 import datetime
 import calendar
 
-from django.core.management.base import BaseCommand, CommandError
+from timetracker.tracker.management.base import ProfiledCommand
 from django.core import mail
-from timetracker.tracker.models import Tbluser, TrackingEntry
-from timetracker.utils.writers import UnicodeWriter
+from timetracker.tracker.models import Tbluser, MonthSnapshot, entry_model
+from timetracker.utils.writers import CSVWriter
+from timetracker.utils.records import EntryPolicy, entry_records
 
 connection = mail.get_connection()
 
 
+def overtime_map(entries):
+    '''The overtime of each of the overtime entries keyed by their dates
+    as strings.'''
+    return {str(entry.entry_date): 0-entry.time_difference()
+            for entry in entries if entry.is_overtime()}
+
 def send_report_for_account(account, now):
     '''Sends all overtime reports to the managers of an account for a given
     date.'''
@@ -35,8 +42,7 @@ def send_report_for_account(account, now):
         "Timetracker team"
 
     buff = StringIO()
-    buff.write("\xef\xbb\xbf")
-    csvout = UnicodeWriter(buff, delimiter=';')
+    csvout = CSVWriter(buff, dialect="excel-semicolon", bom=True)
     users = filter(
         lambda user: user.get_total_balance(ret='num') == 0,
         Tbluser.objects.filter(market=account, disabled=False)
@@ -67,22 +73,28 @@ def send_report_for_account(account, now):
         ["Balance"] + [str(user.get_total_balance(ret='num'))
                        for user in users]
         )
+    # closed months are read from their snapshots.
+    snapshots = MonthSnapshot.for_users(users, now.year, [now.month])
+    entries = entry_model(now.year)
+    policies = EntryPolicy.for_users(users)
+    overtime = {}
+    for user in users:
+        snapshot = snapshots.get((user.id, now.month))
+        if snapshot:
+            overtime[user.id] = snapshot.overtime_map()
+        else:
+            overtime[user.id] = overtime_map(entry_records(
+                    entries.objects.filter(user=user.id,
+                                           entry_date__year=now.year,
+                                           entry_date__month=now.month),
+                    policies))
     for date in dates:
         current_line = [str(date)]
         for user in users:
-            try:
-                entry = TrackingEntry.objects.get(user_id=user.id,
-                                                  entry_date=date)
-            except TrackingEntry.DoesNotExist:
-                current_line.append("")
-                continue
-
-            if entry.is_overtime():
-                current_line.append(0-entry.time_difference())
-            else:
-                current_line.append("")
+            current_line.append(overtime[user.id].get(str(date), ""))
         csvout.writerow(current_line)
 
+    csvout.flush()
     csvfile = buff.getvalue()
     message.attach(
         "overtimereport.csv",
@@ -104,8 +116,9 @@ def get_previous_month(d):
                                   datetime.timedelta(days=1))
     return last_day_of_previous_month.replace(day=1)
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     '''Implementation of a Django command.'''
+    read_only = True
     help = 'Sends notifications of overtime balances to the all those ' \
            'who have balances over zero hours.'
 
@@ -0,0 +1,198 @@
+'''
+Adds the minutes columns to an existing database and fills them in.
+
+The start, end and breaks of the entries and the shiftlength and
+breaklength of the users are kept in minutes alongside their time fields
+(see :class:`timetracker.tracker.models.MinutesField`). syncdb doesn't
+change tables which already exist, so a database created before they
+were added needs this run once. It's safe to run again, the columns
+which already exist are only filled in::
+
+    manage.py migrate_minutes
+    manage.py migrate_minutes --batch=5000
+    manage.py migrate_minutes --verify
+
+The rows are filled in batches of ids, each in its own transaction, so
+the tables aren't locked for the whole migration. `--verify` only counts
+the rows whose minutes don't match their times. On SQLite, PostgreSQL and
+MySQL the minutes are worked out by the database, on any other the rows
+are read and the minutes worked out in Python, which is slower.
+'''
+
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.db import connections, router, transaction
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.tracker.models import (Tbluser, TrackingEntry,
+                                        ArchivedEntry, MinutesField)
+from timetracker.utils.worktime import time_minutes
+
+MODELS = (Tbluser, TrackingEntry, ArchivedEntry)
+
+
+def minutes_fields(model):
+    '''The minutes fields of `model` and the time fields they're from.'''
+    return [(field, model._meta.get_field(field.source))
+            for field in model._meta.fields
+            if isinstance(field, MinutesField)]
+
+
+def missing_columns(model):
+    '''The minutes fields whose columns the table of `model` is
+    missing.'''
+    connection = connections[router.db_for_write(model)]
+    existing = set(row[0] for row in
+                   connection.introspection.get_table_description(
+                       connection.cursor(), model._meta.db_table))
+    return [field for field, _ in minutes_fields(model)
+            if field.column not in existing]
+
+
+def add_columns(model):
+    '''Adds the minutes columns which the table of `model` is missing.
+
+    :returns: The names of the columns which were added.'''
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    missing = missing_columns(model)
+    cursor = connection.cursor()
+    with transaction.commit_on_success(using=connection.alias):
+        for field in missing:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL '
+                           'DEFAULT 0' % (quote(model._meta.db_table),
+                                          quote(field.column),
+                                          field.db_type(connection)))
+        transaction.set_dirty(using=connection.alias)
+    return [field.column for field in missing]
+
+
+def _assignments(model, connection):
+    '''The column and the expression of its minutes of every minutes
+    field, None if the database can't work them out.'''
+    quote = connection.ops.quote_name
+    assignments = [(quote(field.column),
+                    time_minutes(connection.vendor, quote(source.column)))
+                   for field, source in minutes_fields(model)]
+    if any(expression is None for _, expression in assignments):
+        return None
+    return assignments
+
+
+def _wrong_minutes(model, rows):
+    '''The minutes of each of `rows` which don't match their times.
+
+    :returns: A list of the primary key and a dict of the minutes of each
+              row which needs changing.'''
+    fields = [field for field, _ in minutes_fields(model)]
+    wrong = []
+    for row in rows:
+        changes = dict((field.attname, field.from_time(row))
+                       for field in fields
+                       if row.__dict__.get(field.attname) !=
+                       field.from_time(row))
+        if changes:
+            wrong.append((row.pk, changes))
+    return wrong
+
+
+def _python_backfill(model, connection, batch):
+    '''Sets the minutes of the rows of `model` from their times by
+    reading them, for databases which can't work them out in SQL.'''
+    rows = model._default_manager.using(connection.alias)
+    updated = 0
+    last = None
+    while True:
+        page = rows.order_by('pk')
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        page = list(page[:batch])
+        if not page:
+            return updated
+        with transaction.commit_on_success(using=connection.alias):
+            for pk, changes in _wrong_minutes(model, page):
+                updated += rows.filter(pk=pk).update(**changes)
+        last = page[-1].pk
+
+
+def backfill(model, batch=10000):
+    '''Sets the minutes of every row of `model` from its times.
+
+    :returns: The number of rows which were updated.'''
+    connection = connections[router.db_for_write(model)]
+    if _assignments(model, connection) is None:
+        return _python_backfill(model, connection, batch)
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    pk = quote(model._meta.pk.column)
+    assignments = ', '.join('%s = %s' % pair
+                            for pair in _assignments(model, connection))
+    cursor = connection.cursor()
+    cursor.execute('SELECT MIN(%s), MAX(%s) FROM %s' % (pk, pk, table))
+    first, last = cursor.fetchone()
+    updated = 0
+    if first is None:
+        return updated
+    for start in range(first, last + 1, batch):
+        with transaction.commit_on_success(using=connection.alias):
+            cursor.execute('UPDATE %s SET %s WHERE %s BETWEEN %%s AND %%s'
+                           % (table, assignments, pk),
+                           (start, start + batch - 1))
+            transaction.set_dirty(using=connection.alias)
+            updated += cursor.rowcount
+    return updated
+
+
+def mismatches(model):
+    '''The number of rows of `model` whose minutes don't match their
+    times.'''
+    connection = connections[router.db_for_write(model)]
+    if _assignments(model, connection) is None:
+        return len(_wrong_minutes(
+                model, model._default_manager.using(connection.alias)))
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM %s WHERE %s' % (
+            connection.ops.quote_name(model._meta.db_table),
+            ' OR '.join('%s <> %s' % pair
+                        for pair in _assignments(model, connection))))
+    return cursor.fetchone()[0]
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    help = 'Adds the minutes columns to an existing database.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--batch',
+                    action='store',
+                    type='int',
+                    default=10000,
+                    dest='batch',
+                    help='How many ids to update in each transaction.'),
+        make_option('--verify',
+                    action='store_true',
+                    default=False,
+                    dest='verify',
+                    help="Only count the rows whose minutes are wrong."),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['batch'] < 1:
+            raise CommandError("Batch must be at least 1.")
+        for model in MODELS:
+            name = model._meta.db_table
+            if options['verify']:
+                missing = missing_columns(model)
+                if missing:
+                    self.stdout.write("%s: missing %s\n" % (
+                            name, ', '.join(field.column
+                                            for field in missing)))
+                else:
+                    self.stdout.write("%s: %d rows to fill in\n" % (
+                            name, mismatches(model)))
+                continue
+            for column in add_columns(model):
+                self.stdout.write("%s: added %s\n" % (name, column))
+            self.stdout.write("%s: filled in %d rows\n" % (
+                    name, backfill(model, options['batch'])))
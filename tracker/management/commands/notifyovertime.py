@@ -1,20 +1,27 @@
 '''This enables a django command for sending a total to an individual about
-there overtime balances.'''
+there overtime balances.
 
-from django.core.management.base import BaseCommand, CommandError
+The balances of every enabled user are calculated together by
+:meth:`Tbluser.total_balances` and only those over zero hours are given a
+message, which are all sent in one batch.'''
+
+from timetracker.tracker.management.base import ProfiledCommand
 from timetracker.tracker.models import Tbluser
 
 from django.core import mail
 connection = mail.get_connection()
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     '''Implementation of a Django command.'''
     help = 'Sends notifications of overtime balances to the all those ' \
            'who have balances over zero hours.'
 
     def handle(self, *args, **options):
         '''Main entry point'''
+        users = list(Tbluser.objects.filter(disabled=False))
+        balances = Tbluser.total_balances(users)
         messages = filter(lambda x: x != None,
-                          [user.send_pending_overtime_notification(send=False)
-                           for user in Tbluser.objects.filter(disabled=False)])
+                          [user.send_pending_overtime_notification(
+                              send=False, balance=balances[user.id])
+                           for user in users if int(balances[user.id]) > 0])
         connection.send_messages(messages)
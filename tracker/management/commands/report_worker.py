@@ -0,0 +1,64 @@
+'''
+Calculates the reports submitted from the reporting page.
+
+See :mod:`timetracker.reporting.jobs`. The worker claims the pending jobs
+oldest first, calculates them and writes their results, then waits for
+more. Expired results are deleted as it goes. Several workers can be run
+at once to calculate more reports in parallel::
+
+    manage.py report_worker
+    manage.py report_worker --once
+
+With `--once` the pending jobs are calculated and the worker exits, which
+suits running it from cron.
+
+The worker reads from the default database even where a replica is set
+up, as a job is keyed by the version of the data when it was submitted and
+a lagging replica would calculate it from older data.
+'''
+
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.db import connection
+
+from timetracker.tracker.management.base import ProfiledCommand
+from timetracker.reporting import jobs
+from timetracker.utils import policies
+
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
+    help = 'Calculates the reports submitted from the reporting page.'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--once',
+                    action='store_true',
+                    default=False,
+                    dest='once',
+                    help='Exit once there are no pending jobs.'),
+        make_option('--sleep',
+                    action='store',
+                    type='float',
+                    default=2.0,
+                    dest='sleep',
+                    help='How many seconds to wait between looking for '
+                         'jobs.'),
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['sleep'] <= 0:
+            raise CommandError("Sleep must be more than 0.")
+        while True:
+            # pick up any policies which changed whilst waiting.
+            policies.check()
+            jobs.cleanup()
+            for job in jobs.run_pending():
+                self.stdout.write("%s %s %s\n" % (job.status, job.path,
+                                                  job.error))
+            if options['once']:
+                return
+            # don't hold a connection open whilst idle.
+            connection.close()
+            time.sleep(options['sleep'])
@@ -1,11 +1,93 @@
-from django.core.management.base import BaseCommand, CommandError
+'''
+Sends the weekly reminder of their previous week's balance to every user
+of the markets given::
+
+    manage.py send_weekly_reminders BG CZ
+    manage.py send_weekly_reminders BG --dry-run=/tmp/reminders
+
+The balances of every user are summed by the database in one grouped
+query (see :meth:`Tbluser.previous_week_balances`), the messages are then
+rendered by a pool of threads and sent over a single connection to the
+mail server in batches. With `--dry-run` the messages are written to files
+in the directory given instead of being sent. The time each phase took is
+written out once they're done.
+'''
+
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core import mail
+from django.core.management.base import CommandError
+
+from timetracker.tracker.management.base import ProfiledCommand
 from timetracker.tracker.models import Tbluser
 
-class Command(BaseCommand):
+
+class Command(ProfiledCommand):
+    '''Implementation of a Django command.'''
     help = \
         'Sends a reminder of the current balance levels to all accounts ' \
         'in the argument list'
+    option_list = ProfiledCommand.option_list + (
+        make_option('--batch',
+                    action='store',
+                    type='int',
+                    default=100,
+                    dest='batch',
+                    help='How many messages to send at a time.'),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    default=4,
+                    dest='workers',
+                    help='How many threads render the messages.'),
+        make_option('--dry-run',
+                    action='store',
+                    default=None,
+                    dest='dry_run',
+                    help='Write the messages to this directory instead of '
+                         'sending them.'),
+        )
+
+    def report(self, phase, count, started):
+        '''Writes out the timing of a phase.'''
+        self.stdout.write("%-10s %10d %8.2fs\n" % (
+                phase, count, time.time() - started))
 
     def handle(self, *args, **options):
-        for user in Tbluser.objects.filter(market__in=args):
-            user.send_weekly_reminder()
+        '''Entry point for the command.'''
+        if options['batch'] < 1 or options['workers'] < 1:
+            raise CommandError("Batch and workers must be at least 1.")
+
+        started = time.time()
+        users = list(Tbluser.objects.filter(market__in=args))
+        balances = Tbluser.previous_week_balances(users)
+        self.report('balances', len(users), started)
+
+        started = time.time()
+        pool = ThreadPool(options['workers'])
+        try:
+            messages = pool.map(
+                lambda user: user.weekly_reminder(balances[user.id]), users)
+        finally:
+            pool.close()
+            pool.join()
+        self.report('render', len(messages), started)
+
+        started = time.time()
+        if options['dry_run']:
+            connection = mail.get_connection(
+                'django.core.mail.backends.filebased.EmailBackend',
+                file_path=options['dry_run'])
+        else:
+            connection = mail.get_connection()
+        sent = 0
+        connection.open()
+        try:
+            for first in range(0, len(messages), options['batch']):
+                sent += connection.send_messages(
+                    messages[first:first + options['batch']]) or 0
+        finally:
+            connection.close()
+        self.report('send', sent, started)
@@ -0,0 +1,125 @@
+'''
+Measures how long a fresh process takes to start up.
+
+WSGI workers are restarted often and the management commands are run from
+cron, so they pay for everything that happens at import time over and
+over. Each measurement is taken in a new interpreter:
+
+* wsgi: importing the WSGI application.
+* first_request: importing the WSGI application and serving the login
+  page, which loads the middleware, the urls and the views.
+* help: running `manage.py help`.
+
+The limits can be used to fail a build when startup regresses::
+
+    manage.py startup_benchmark --repeat=5 --max-wsgi=0.5 --max-help=1
+'''
+
+import os
+import sys
+import time
+import subprocess
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import timetracker
+
+WSGI_MODULE = 'timetracker.wsgi'
+
+# prints how long the import, and the request when given, took.
+SCRIPT = '''
+import time
+started = time.time()
+import %(module)s as wsgi
+if %(request)r:
+    from wsgiref.util import setup_testing_defaults
+    environ = {}
+    setup_testing_defaults(environ)
+    environ['PATH_INFO'] = '/'
+    list(wsgi.application(environ, lambda *args: None))
+print(time.time() - started)
+'''
+
+MEASUREMENTS = ('wsgi', 'first_request', 'help')
+
+
+def environment():
+    '''The environment of the child processes, which can import what this
+    one can.'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    return env
+
+
+def time_script(request):
+    '''Times the import of the WSGI application in a new interpreter.'''
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT % {'module': WSGI_MODULE,
+                                         'request': request}],
+        env=environment())
+    return float(output.strip().splitlines()[-1])
+
+
+def time_help():
+    '''Times `manage.py help` in a new interpreter.'''
+    manage = os.path.join(os.path.dirname(timetracker.__file__), 'manage.py')
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        subprocess.check_call([sys.executable, manage, 'help'],
+                              stdout=devnull, stderr=devnull,
+                              env=environment())
+        return time.time() - started
+
+
+def measure(name):
+    '''Takes a single measurement, in seconds.'''
+    if name == 'help':
+        return time_help()
+    return time_script(name == 'first_request')
+
+
+class Command(BaseCommand):
+    '''Implementation of a Django command.'''
+    help = 'Measures the startup time of the WSGI application and ' \
+           'manage.py.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+                    action='store',
+                    type='int',
+                    default=5,
+                    dest='repeat',
+                    help='How many times to take each measurement.'),
+        ) + tuple(
+        make_option('--max-%s' % name.replace('_', '-'),
+                    action='store',
+                    type='float',
+                    default=None,
+                    dest='max_%s' % name,
+                    help='Fail when the median %s time is over this many '
+                         'seconds.' % name)
+        for name in MEASUREMENTS
+        )
+
+    def handle(self, *args, **options):
+        '''Entry point for the command.'''
+        if options['repeat'] < 1:
+            raise CommandError("Repeat must be at least 1.")
+        failures = []
+        self.stdout.write("%-14s %8s %8s %8s\n" % ('', 'min', 'median',
+                                                   'max'))
+        for name in MEASUREMENTS:
+            try:
+                timings = sorted(measure(name)
+                                 for _ in range(options['repeat']))
+            except (subprocess.CalledProcessError, ValueError) as error:
+                raise CommandError("Measuring %s failed: %s" % (name, error))
+            median = timings[len(timings) // 2]
+            self.stdout.write("%-14s %7.3fs %7.3fs %7.3fs\n" % (
+                    name, timings[0], median, timings[-1]))
+            limit = options['max_%s' % name]
+            if limit is not None and median > limit:
+                failures.append("%s took %.3fs, the limit is %.3fs" % (
+                        name, median, limit))
+        if failures:
+            raise CommandError('\n'.join(failures))
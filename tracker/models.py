@@ -9,49 +9,173 @@
     :synopsis: Module which contains view functions that are mapped from urls
 '''
 
+import sys
+import time
+import zlib
+import base64
 import datetime as dt
-
-from operator import add
-
-from django.db import models
+import calendar
+import simplejson
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import (models, transaction, connections, router,
+                       IntegrityError)
+from django.db.models import F, Q, Max, Sum, Count
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+                                      post_delete, m2m_changed)
+from django.dispatch import receiver
 from django.forms import ModelForm
 from django.conf import settings
 from django.core.mail import EmailMessage
-
-try:
-    NUM_WORKING_DAYS = settings.NUM_WORKING_DAYS
-except AttributeError:
-    # usual working day amount
-    NUM_WORKING_DAYS = 5
+from django.core.exceptions import ValidationError
 
 from timetracker.utils.datemaps import (
-    WORKING_CHOICES, DAYTYPE_CHOICES, float_to_time, datetime_to_timestring,
+    WORKING_CHOICES, DAYTYPE_CHOICES, float_to_time,
     MONTH_MAP, generate_year_box, nearest_half
     )
 
-try:
-    # The modules which provide these functions should be provided for by
-    # the setup environment, this is due to the fact that some notifications
-    # may include business-specific details, we can override by simply incl-
-    # uding a local notifications.py in this directory with the required fu-
-    # nctions we need.
-    from timetracker.tracker.notifications import (
-        send_overtime_notification, send_pending_overtime_notification,
-        send_undertime_notification
-        )
-except ImportError:
-    #pylint: disable=W0613
-    def send_overtime_notification(*args, **kwargs):
-        '''Not implemented'''
-        pass
-    def send_pending_overtime_notification(*args, **kwargs):
-        '''Not implemented'''
-        pass
-    def send_undertime_notification(*args, **kwargs):
-        '''Not implemented'''
-        pass
+# The modules which provide the notification functions should be provided
+# for by the setup environment, this is due to the fact that some
+# notifications may include business-specific details, we can override by
+# simply including a local notifications.py in this directory with the
+# required functions we need. It's only looked for once the first
+# notification is sent.
+_NOTIFICATIONS = {}
+
+def _notification(name):
+    '''Finds the notification function called `name`.'''
+    if not _NOTIFICATIONS:
+        try:
+            from timetracker.tracker import notifications
+        except ImportError:
+            notifications = None
+        for func in ('send_overtime_notification',
+                     'send_pending_overtime_notification',
+                     'send_undertime_notification'):
+            _NOTIFICATIONS[func] = getattr(notifications, func,
+                                           _not_implemented)
+    return _NOTIFICATIONS[name]
+
+#pylint: disable=W0613
+def _not_implemented(*args, **kwargs):
+    '''Not implemented'''
+    pass
+
+def send_overtime_notification(*args, **kwargs):
+    '''Sends the notification of an entry with overtime.'''
+    return _notification('send_overtime_notification')(*args, **kwargs)
+
+def send_pending_overtime_notification(*args, **kwargs):
+    '''Sends the notification of a user's pending overtime.'''
+    return _notification('send_pending_overtime_notification')(*args,
+                                                               **kwargs)
+
+def send_undertime_notification(*args, **kwargs):
+    '''Sends the notification of an entry with undertime.'''
+    return _notification('send_undertime_notification')(*args, **kwargs)
+
+def num_working_days():
+    '''The number of working days in a week.'''
+    # usual working day amount
+    return getattr(settings, 'NUM_WORKING_DAYS', 5)
+
+# how many days of holiday each daytype is worth.
+HOLIDAY_VALUES = {
+    'HOLIS': -1,
+    'PUWRK': 2,
+    'RETRN': -1,
+    'DAYOD': -1,
+    'SATUR': 1
+    }
 
 from timetracker.loggers import debug_log
+from timetracker.utils.worktime import sum_minutes
+from timetracker.utils import policies
+
+
+class MinutesField(models.SmallIntegerField):
+
+    '''The minutes since midnight of the time in another field of the
+    model.
+
+    The time fields are kept as they are for the forms, the ajax and the
+    admin, the calculations read the minutes instead so that they're
+    integer arithmetic and the database can sum them. The minutes are
+    worked out from the time whenever the time is changed, as well as when
+    the model is saved, bulk_create included, so they only have to be set
+    by hand alongside a queryset's update of the time. The
+    `migrate_minutes` management command adds the columns to an existing
+    database and fills them in.
+    '''
+
+    def __init__(self, source, *args, **kwargs):
+        '''
+        :param source: The name of the time field.
+        '''
+        self.source = source
+        kwargs.setdefault('editable', False)
+        super(MinutesField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(MinutesField, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, _Minutes(self))
+        setattr(cls, self.source, _ResetsMinutes(self.source, self.attname))
+
+    def from_time(self, model_instance):
+        '''The minutes of the time, which may still be a string if the
+        model hasn't been cleaned.'''
+        value = model_instance._meta.get_field(self.source).to_python(
+            getattr(model_instance, self.source))
+        return _minutes(value) if value is not None else 0
+
+    def pre_save(self, model_instance, add):
+        minutes = self.from_time(model_instance)
+        setattr(model_instance, self.attname, minutes)
+        return minutes
+
+
+class _Minutes(object):
+    '''The minutes of a :class:`MinutesField`, worked out from the time
+    if they haven't been loaded with it.'''
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname)
+        if value is None:
+            value = instance.__dict__[self.field.attname] = \
+                self.field.from_time(instance)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class _ResetsMinutes(object):
+    '''A time field whose minutes are worked out again when it's
+    changed.'''
+    def __init__(self, name, minutes):
+        self.name = name
+        self.minutes = minutes
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+        instance.__dict__.pop(self.minutes, None)
+
 
 class Tbluser(models.Model):
 
@@ -171,6 +295,10 @@ class Tbluser(models.Model):
     shiftlength = models.TimeField(db_column='shiftLength',
                                    verbose_name=("Shift Length"))
 
+    break_minutes = MinutesField('breaklength')
+
+    shift_minutes = MinutesField('shiftlength')
+
     job_code = models.CharField(max_length=6,
                                 choices=JOB_CODES,
                                 db_column='Job_Code',
@@ -210,6 +338,12 @@ class Tbluser(models.Model):
         '''Returns whether this user is disabled or not'''
         return self.disabled
 
+    @property
+    def policy(self):
+        '''The :class:`timetracker.utils.policies.MarketPolicy` of the
+        user's market.'''
+        return policies.for_market(self.market)
+
     def get_shiftlength_list(self):
         '''
         Returns the users' timestring formatted neatly
@@ -218,23 +352,10 @@ class Tbluser(models.Model):
                   depending on the user's shiftlength
         '''
 
-        start_time = dt.datetime(
-            year=1980,
-            month=1,
-            day=1,
-            hour=9,
-            minute=0,
-            second=0,
-            )
-
-        end_time = start_time + dt.timedelta(
-            hours=self.shiftlength.hour,
-            minutes=self.shiftlength.minute,
-            seconds=self.shiftlength.second
-            )
-
-        return map(datetime_to_timestring,
-                   [start_time, end_time, self.breaklength])
+        # the shift starts at 9am.
+        return ["%02d:%02d:00" % divmod(minutes % (24 * 60), 60)
+                for minutes in (9 * 60, 9 * 60 + self.shift_minutes,
+                                self.break_minutes)]
 
     def get_subordinates(self, get_all=False):
         '''
@@ -368,16 +489,16 @@ class Tbluser(models.Model):
         if month is None:
             month = dt.datetime.today().month
 
-        return TrackingEntry.objects.filter(user_id=self.id,
-                                            entry_date__year=year,
-                                            entry_date__month=month)
+        return entry_model(year).objects.filter(user_id=self.id,
+                                                entry_date__year=year,
+                                                entry_date__month=month)
 
     def get_comments(self, year):
         '''
         Get Comments will return a formatted string of this users comments
         for a given year.
         '''
-        entries =  TrackingEntry.objects.filter(
+        entries =  entry_model(year).objects.filter(
             user_id=self.id,
             entry_date__year=year
             )
@@ -422,13 +543,14 @@ class Tbluser(models.Model):
         :type year: :class:`int`
         :rtype :class:`str`
         '''
-        entries = TrackingEntry.objects.filter(user_id=self.id,
-                                               entry_date__year=year)
+        entries = entry_model(year).objects.filter(
+            user_id=self.id, entry_date__year=year
+            ).values_list('entry_date', 'daytype')
         basehtml = self.year_as_whole(year)
-        for entry in entries:
-            basehtml[entry.entry_date.month-1][entry.entry_date.day] = \
-                basehtml[entry.entry_date.month-1][entry.entry_date.day].format(
-                c=entry.daytype, function="")
+        for entry_date, daytype in entries:
+            basehtml[entry_date.month-1][entry_date.day] = \
+                basehtml[entry_date.month-1][entry_date.day].format(
+                c=daytype, function="")
         table_string = ''.join([''.join(subrow) for subrow in basehtml])
         table_string += '''
 <tr>
@@ -470,8 +592,12 @@ class Tbluser(models.Model):
         :type year: :class:`int`
         :rtype :class:`str`
         '''
-        entries = TrackingEntry.objects.filter(user_id=self.id,
-                                               entry_date__year=year)
+        # the records share this user rather than fetching it per entry.
+        from timetracker.utils.records import EntryPolicy, entry_records
+        entries = entry_records(
+            entry_model(year).objects.filter(user_id=self.id,
+                                             entry_date__year=year),
+            EntryPolicy.for_users([self]))
         basehtml = self.year_as_whole(year)
         for entry in entries:
             basehtml[entry.entry_date.month-1][entry.entry_date.day] = \
@@ -549,20 +675,12 @@ class Tbluser(models.Model):
         :rtype: :class:`Integer`
         '''
 
-        tracking_days = TrackingEntry.objects.filter(user_id=self.id,
-                                                     entry_date__year=year)
-
-        holiday_value_map = {
-            'HOLIS': -1,
-            'PUWRK': 2,
-            'RETRN': -1,
-            'DAYOD': -1,
-            'SATUR': 1
-            }
+        tracking_days = entry_model(year).objects.filter(user_id=self.id,
+                                                         entry_date__year=year)
 
         holiday_balance = self.holiday_balance
         for entry in tracking_days:
-            holiday_balance += holiday_value_map.get(entry.daytype, 0)
+            holiday_balance += HOLIDAY_VALUES.get(entry.daytype, 0)
 
         return holiday_balance
 
@@ -571,9 +689,9 @@ class Tbluser(models.Model):
         Base method for retrieving the number of instances of a specific
         daytype in a given year.
         '''
-        return len(TrackingEntry.objects.filter(user_id=self.id,
-                                            entry_date__year=year,
-                                            daytype=daytype))
+        return len(entry_model(year).objects.filter(user_id=self.id,
+                                                    entry_date__year=year,
+                                                    daytype=daytype))
 
     def get_dod_balance(self, year):
         '''
@@ -586,10 +704,20 @@ class Tbluser(models.Model):
         Get balances will return a dictionary of long daytype names
         against their balances.
         '''
-        daytype_dict = {
-            daytype[1]: self.get_num_daytype_in_year(year, daytype[0]) \
-                for daytype in DAYTYPE_CHOICES
-            }
+        if ArchivedYear.is_archived(year):
+            try:
+                summary = ArchiveSummary.objects.get(user=self, year=year)
+            except ArchiveSummary.DoesNotExist:
+                summary = ArchiveSummary(daytypes='{}')
+            daytype_dict = {
+                daytype[1]: summary.daytype_count(daytype[0]) \
+                    for daytype in DAYTYPE_CHOICES
+                }
+        else:
+            daytype_dict = {
+                daytype[1]: self.get_num_daytype_in_year(year, daytype[0]) \
+                    for daytype in DAYTYPE_CHOICES
+                }
         daytype_dict.update({
             "Calculated Holidays": self.get_holiday_balance(year)
             })
@@ -627,40 +755,56 @@ class Tbluser(models.Model):
                      for element in WORKING_CHOICES
                      if element[0] != "SATUR"]
 
+        # the balances of archived years were calculated when they were
+        # archived, so they're carried into the balance over all time.
+        carried = 0
+        model = entry_model(year)
         if not year and not month:
+            carried = ArchiveSummary.objects.filter(user=self).aggregate(
+                total=Sum('balance'))['total'] or 0
             tracking_days = TrackingEntry.objects.filter(user_id=self.id,
                                                          daytype__in=day_types)
             return_days = TrackingEntry.objects.filter(user_id=self.id,
                                                        daytype="ROVER")
         elif year and not month:
-            tracking_days = TrackingEntry.objects.filter(user_id=self.id,
-                                                         daytype__in=day_types,
-                                                         entry_date__year=year)
-            return_days = TrackingEntry.objects.filter(user_id=self.id,
-                                                       daytype="ROVER",
-                                                       entry_date__year=year
-                                                       )
+            tracking_days = model.objects.filter(user_id=self.id,
+                                                 daytype__in=day_types,
+                                                 entry_date__year=year)
+            return_days = model.objects.filter(user_id=self.id,
+                                               daytype="ROVER",
+                                               entry_date__year=year
+                                               )
         else:
-            tracking_days = TrackingEntry.objects.filter(
+            tracking_days = model.objects.filter(
                 user_id=self.id,
                 daytype__in=day_types,
                 entry_date__year=year,
                 entry_date__month=month
                 )
-            return_days = TrackingEntry.objects.filter(user_id=self.id,
-                                                       daytype="ROVER",
-                                                       entry_date__year=year,
-                                                       entry_date__month=month)
-
-
-        if settings.OVERRIDE_CALCULATION.get(self.market):
-            trackingnumber = \
-                settings.OVERRIDE_CALCULATION[self.market](self,
-                                                           tracking_days,
-                                                           return_days)
+            return_days = model.objects.filter(user_id=self.id,
+                                               daytype="ROVER",
+                                               entry_date__year=year,
+                                               entry_date__month=month)
+
+        if model is ArchivedEntry and not month:
+            trackingnumber = ArchiveSummary.objects.filter(
+                user=self, year=year).aggregate(
+                total=Sum('balance'))['total'] or 0
+        elif self.policy.calculation:
+            trackingnumber = carried + \
+                self.policy.calculation(self, tracking_days, return_days)
+        elif year:
+            start = dt.date(int(year), int(month or 1), 1)
+            if month:
+                end = dt.date(start.year, start.month,
+                              calendar.monthrange(start.year,
+                                                  start.month)[1])
+            else:
+                end = dt.date(start.year, 12, 31)
+            trackingnumber = self.get_range_balance(start, end)
         else:
-            trackingnumber = \
-                self._regular_calculation(tracking_days, return_days)
+            trackingnumber = carried + Tbluser.regular_balances(
+                TrackingEntry.objects.all(), [self.id])[self.id]
 
         if ret == 'html':
             tracker_class_map = {
@@ -700,52 +844,148 @@ class Tbluser(models.Model):
 
         # we'll use augmented assignment
         # so zero our local vars here
-        (total_hours, total_mins,
-         shift_hours, shift_minutes) = (0, 0, 0, 0)
+        total_minutes, shift_minutes = 0, 0
 
         for item in tracking_days:
-            shift_hours += self.shiftlength.hour
-            shift_minutes += self.shiftlength.minute
+            shift_minutes += self.shift_minutes
+            total_minutes += (item.end_minutes - item.start_minutes
+                              - item.break_minutes)
 
-            total_hours += (
-                item.end_time.hour
-                - item.start_time.hour
-                - item.breaks.hour
-                )
+        for item in return_days:
+            shift_minutes += self.shift_minutes + self.break_minutes
 
-            total_mins += (
-                item.end_time.minute
-                - item.start_time.minute
-                - item.breaks.minute
-                )
+        return (total_minutes - shift_minutes) / 60.0
 
-        for item in return_days:
-            shift_hours += self.shiftlength.hour + self.breaklength.hour
-            shift_minutes += self.shiftlength.minute + self.breaklength.minute
+    @staticmethod
+    def regular_balances(entries, user_ids):
+        '''The balances :meth:`_regular_calculation` gives over `entries`
+        for each of the users, summed by the database in one query rather
+        than by loading the entries.
+
+        :param entries: A queryset of :class:`TrackingEntry` or
+                        :class:`ArchivedEntry`.
+        :param user_ids: The ids of the users.
+        :returns: A dict of the balances, in hours, keyed by the user id.'''
+        if not user_ids:
+            return {}
+        day_types = [element[0]
+                     for element in WORKING_CHOICES
+                     if element[0] != "SATUR"]
+        totals = sum_minutes(entries.filter(user__in=user_ids,
+                                            daytype__in=day_types + ['ROVER']),
+                             ['balance'], by_user=True)
+        return dict((user_id, totals.get(user_id, [0])[0] / 60.0)
+                    for user_id in user_ids)
 
-        return 0 - (add(shift_hours, (shift_minutes / 60.0))
-                           - add(total_hours, (total_mins / 60.0)))
+    @staticmethod
+    def total_balances(users):
+        '''The balance over all time, as :meth:`get_total_balance` gives
+        it, of every user in a handful of queries.
+
+        The users of markets without an OVERRIDE_CALCULATION are summed by
+        the database together. The calculation of the others is given their
+        entries as querysets, just as :meth:`get_total_balance` gives them,
+        so those cost whatever the calculation reads.
+
+        :param users: The :class:`Tbluser` objects.
+        :returns: A dict of the balances, in hours, keyed by the user id.'''
+        users = list(users)
+        calculated = [user for user in users if user.policy.calculation]
+        balances = Tbluser.regular_balances(
+            TrackingEntry.objects.all(),
+            [user.id for user in users if not user.policy.calculation])
+        day_types = [element[0] for element in WORKING_CHOICES
+                     if element[0] != "SATUR"]
+        for user in calculated:
+            balances[user.id] = user.policy.calculation(
+                user,
+                TrackingEntry.objects.filter(user_id=user.id,
+                                             daytype__in=day_types),
+                TrackingEntry.objects.filter(user_id=user.id,
+                                             daytype="ROVER"))
+        # the balances of archived years are carried, as they are for a
+        # single user.
+        for user_id, total in ArchiveSummary.objects.filter(
+                user__in=balances.keys()).values_list('user').annotate(
+                total=Sum('balance')).order_by():
+            balances[user_id] += total or 0
+        return balances
+
+    def balance_index(self, year):
+        '''The :class:`BalanceIndex` of the user for a year, use
+        :meth:`BalanceIndex.prefetch` to load those of many users at once.
+        '''
+        year = int(year)
+        if year not in (getattr(self, '_balance_indexes', None) or {}):
+            BalanceIndex.prefetch([self], [year])
+        return self._balance_indexes[year]
+
+    def range_totals(self, start, end, *names):
+        '''The totals of the user's entries from `start` to `end`
+        inclusive, which may span years.
+
+        :param names: The totals to return, see :class:`BalanceIndex`.
+        :rtype: :class:`list` with a total for each name.'''
+        totals = [0] * len(names)
+        for year, first, last in _year_ranges(start, end):
+            index = self.balance_index(year)
+            for position, name in enumerate(names):
+                totals[position] += index.total(name, first, last)
+        return totals
+
+    def get_range_balance(self, start, end):
+        '''The balance of the user over the days from `start` to `end`
+        inclusive, such as a custom week, a quarter or a fiscal year.
+
+        Markets with an OVERRIDE_CALCULATION are calculated a year at a
+        time with it, every other market is read from the
+        :class:`BalanceIndex` of each year.
+
+        :rtype: :class:`float`'''
+        calculation = self.policy.calculation
+        if not calculation:
+            return self.range_totals(start, end, "delta")[0] / 60.0
+        day_types = [element[0] for element in WORKING_CHOICES
+                     if element[0] != "SATUR"]
+        balance = 0
+        for year, first, last in _year_ranges(start, end):
+            entries = entry_model(year).objects.filter(
+                user_id=self.id, entry_date__range=(first, last))
+            balance += calculation(self,
+                                   entries.filter(daytype__in=day_types),
+                                   entries.filter(daytype="ROVER"))
+        return balance
 
     def shiftlength_as_float(self):
         '''Returns the shiftlength of the user as a float
         :rtype: :class:`float`'''
-        shift_hours = self.shiftlength.hour + self.breaklength.hour
-        shift_minutes = (self.shiftlength.minute
-                         + self.breaklength.minute) / 60.0
-        return shift_hours + shift_minutes
+        return (self.shift_minutes + self.break_minutes) / 60.0
 
-    def send_pending_overtime_notification(self, send=False):
+    def send_pending_overtime_notification(self, send=False, balance=None):
         '''Determines whether an overtime notification is required and sends
         it.
 
-        :param send: send directly or return the EmailMessage.'''
-        if self.get_total_balance(ret='num') > 0:
+        :param send: send directly or return the EmailMessage.
+        :param balance: The user's total balance, when it's already known.'''
+        if balance is None:
+            balance = self.get_total_balance(ret='num')
+        if int(balance) > 0:
             return send_pending_overtime_notification(self, send)
 
     def send_weekly_reminder(self):
         '''
         Sends the weekly reminder for an agent about their holiday balances
         '''
+        self.weekly_reminder().send()
+
+    def weekly_reminder(self, balance=None):
+        '''
+        The e-mail of the weekly reminder.
+
+        :param balance: The balance of the previous week, when it's already
+                        known.
+        :rtype: :class:`EmailMessage`
+        '''
         message = \
             "Hi,\n\n" \
             "This is your weekly timetracking reminder. If the below " \
@@ -759,7 +999,7 @@ class Tbluser(models.Model):
             "Kind Regards,\n" \
             "Timetracking Team"
 
-        cur = self.previous_week_balance()
+        cur = self.previous_week_balance() if balance is None else balance
         prev = self.expected_weekly_balance()
         message = message % (
             cur, prev,
@@ -769,34 +1009,60 @@ class Tbluser(models.Model):
         email.body = message
         email.to = [self.user_id]
         email.subject = "Weekly timetracking reminder"
-        email.send()
+        return email
 
     def previous_week_balance(self):
         '''Gets the user's previous weekly balance'''
-        entries =  TrackingEntry.objects.filter(entry_date__range=(
-                dt.datetime.now()+dt.timedelta(days=-7), dt.datetime.now()
-                ), user_id=self.id, daytype__in=["SATUR", "WKDAY"])
-        total = self.shiftlength_as_float() * (NUM_WORKING_DAYS - len(entries))
-        for entry in entries:
-            total += entry.totalhours()
-        return total
+        today = dt.date.today()
+        worked, weekdays, saturdays = self.range_totals(
+            today - dt.timedelta(days=7), today, "worked", "WKDAY", "SATUR")
+        return self.shiftlength_as_float() * (
+            num_working_days() - weekdays - saturdays) + worked / 60.0
+
+    @staticmethod
+    def previous_week_balances(users, today=None):
+        '''The :meth:`previous_week_balance` of every user, summed by the
+        database in one query for each year the week falls in.
+
+        :param users: The :class:`Tbluser` objects.
+        :returns: A dict of the balances keyed by the user ids.'''
+        today = today or dt.date.today()
+        users = list(users)
+        totals = defaultdict(lambda: [0, 0])
+        for year, first, last in _year_ranges(
+                today - dt.timedelta(days=7), today):
+            summed = sum_minutes(
+                entry_model(year).objects.filter(
+                    user__in=[user.id for user in users],
+                    entry_date__range=(first, last),
+                    daytype__in=("WKDAY", "SATUR")),
+                ("total", "days"), by_user=True)
+            for user_id, (worked, days) in summed.items():
+                totals[user_id][0] += worked
+                totals[user_id][1] += days
+        balances = {}
+        for user in users:
+            worked, days = totals.get(user.id, (0, 0))
+            balances[user.id] = user.shiftlength_as_float() * (
+                num_working_days() - days) + worked / 60.0
+        return balances
 
     def expected_weekly_balance(self):
         '''Returns the users normal working balance.'''
-        return self.shiftlength_as_float() * NUM_WORKING_DAYS
+        return self.shiftlength_as_float() * num_working_days()
 
     def get_manager_email(self):
         '''Returns a list of manager's e-mails for this particular user.'''
-        overridden = settings.MANAGER_EMAILS_OVERRIDE.get(self.market)
+        overridden = self.policy.manager_emails
         if overridden:
-            return overridden
+            return list(overridden)
         # list because the SMTP module takes lists of emails when
         # sending e-mails.
         return [self.get_administrator().user_id]
 
     def get_manager_name(self):
         '''Gets the name(s) of the managers for this particular user.'''
-        overridden = settings.MANAGER_NAMES_OVERRIDE.get(self.market)
+        overridden = self.policy.manager_names
         if overridden:
             return ',\n'.join(overridden)
         return self.get_administrator().name()
@@ -888,9 +1154,11 @@ class RelatedUsers(models.Model):
                             </tr>
                             '''
 
+        # sorted here so that the users prefetched by the admin are used.
         table_inner_list = [
             table_data_string.format(user.name())
-            for user in self.users.all().order_by('lastname')
+            for user in sorted(self.users.all(),
+                               key=lambda user: user.lastname)
         ]
 
         return u''.join([
@@ -984,9 +1252,11 @@ class Tblauthorization(models.Model):
                             </tr>
                             '''
 
+        # sorted here so that the users prefetched by the admin are used.
         table_inner_list = [
             table_data_string.format(user.name())
-            for user in self.users.all().order_by('lastname')
+            for user in sorted(self.users.all(),
+                               key=lambda user: user.lastname)
         ]
 
         return u''.join([
@@ -1025,6 +1295,10 @@ class TrackingEntry(models.Model):
     daytype = models.CharField(choices=DAYTYPE_CHOICES,
                                max_length=5)
 
+    start_minutes = MinutesField('start_time')
+    end_minutes = MinutesField('end_time')
+    break_minutes = MinutesField('breaks')
+
     comments = models.TextField(blank=True)
 
     class Meta:
@@ -1036,13 +1310,70 @@ class TrackingEntry(models.Model):
         unique_together = ('user', 'entry_date')
         ordering = ['user']
 
+    def __init__(self, *args, **kwargs):
+        super(TrackingEntry, self).__init__(*args, **kwargs)
+        # querysets pass the columns in order, the entry is as it's stored.
+        self._stored = self._journalled() if args and self.pk else None
+
+    def _journalled(self):
+        '''The date, daytype and the start, end and breaks in minutes of
+        the entry, as the journal records them.'''
+        return (_entry_date(self.entry_date), self.daytype,
+                self.start_minutes, self.end_minutes, self.break_minutes)
+
     def save(self, *args, **kwargs):
-        super(TrackingEntry, self).save(*args, **kwargs)
-        self.full_clean()
-        if self.daytype == "WKDAY" and \
-                self.entry_date.isoweekday() in [6, 7]:
-            self.daytype = "SATUR"
+        date = _entry_date(self.entry_date)
+        _check_writable(date)
+        using = kwargs.get('using') or router.db_for_write(TrackingEntry,
+                                                           instance=self)
+        # the entry is journalled in the same transaction.
+        with _transaction(using):
+            previous = None
+            if self._stored and self._stored[0] == date:
+                # the entry hasn't been moved since it was loaded.
+                previous = self._stored
+            elif self.pk:
+                previous = TrackingEntry.objects.using(using).filter(
+                    pk=self.pk).values_list(
+                    'entry_date', 'daytype', 'start_minutes', 'end_minutes',
+                    'break_minutes')
+                previous = previous[0] if previous else None
+            if previous and previous[0] != date:
+                # nor can an entry be moved out of a closed month.
+                _check_writable(previous[0])
+            # the period the entry moved out of is bumped as well.
+            self._previous_date = previous[0] if previous else None
             super(TrackingEntry, self).save(*args, **kwargs)
+            self.full_clean()
+            if self.daytype == "WKDAY" and \
+                    self.entry_date.isoweekday() in [6, 7]:
+                self.daytype = "SATUR"
+                super(TrackingEntry, self).save(*args, **kwargs)
+            new = (self.daytype, self.start_minutes, self.end_minutes,
+                   self.break_minutes)
+            if previous and previous[0] != self.entry_date:
+                # a move empties the old day, which is journalled as the
+                # entry leaving it and arriving at the new one.
+                Change.record(self, 'delete', self.user_id, previous[0],
+                              old=previous[1:])
+                previous = None
+            Change.record(self, 'update' if previous else 'create',
+                          self.user_id, self.entry_date,
+                          previous[1:] if previous else None, new)
+        self._stored = self._journalled()
+
+    def delete(self, *args, **kwargs):
+        '''Deletes the entry unless it's in a closed month. Entries deleted
+        along with their user aren't checked, as the user's snapshots go
+        with them.'''
+        if self.entry_date is None and self.pk:
+            dates = TrackingEntry.objects.filter(pk=self.pk).values_list(
+                'entry_date', flat=True)
+            if dates:
+                _check_writable(dates[0])
+        else:
+            _check_writable(_entry_date(self.entry_date))
+        super(TrackingEntry, self).delete(*args, **kwargs)
 
     def __unicode__(self):
 
@@ -1073,15 +1404,12 @@ class TrackingEntry(models.Model):
     @property
     def worklength(self):
         '''Returns the working portion of this tracking entry'''
-        td = dt.timedelta(hours=self.end_time.hour,
-                          minutes=self.end_time.minute)
-        td += self.normalized_break()
-        return td
+        return dt.timedelta(minutes=self.end_minutes) + \
+            self.normalized_break()
 
     def breaktime(self):
         '''Returns the breaks entry of this tracking entry.'''
-        return (dt.timedelta(hours=self.breaks.hour,
-                             minutes=self.breaks.minute).seconds / 60.0) / 60.0
+        return self.break_minutes / 60.0
 
     def display_as_csv(self):
         '''Returns the tracking entry as a CSV row.'''
@@ -1093,21 +1421,15 @@ class TrackingEntry(models.Model):
 
     def threshold(self):
         '''Returns the threshold for the associated user.'''
-        return settings.OT_THRESHOLDS.get(
-            self.user.market,
-            settings.DEFAULT_OT_THRESHOLD
-            )
+        return self.user.policy.threshold
 
     def totalhours(self):
         '''Total hours calculated for this tracking entry'''
-        td = dt.timedelta(hours=self.end_time.hour,
-                          minutes=self.end_time.minute)
-        td -= dt.timedelta(hours=self.start_time.hour,
-                           minutes=self.start_time.minute)
-        td += dt.timedelta(hours=self.breaks.hour,
-                           minutes=self.breaks.minute)
-        debug_log.debug(str((td.seconds / 60.0) / 60.0))
-        return ((td.seconds / 60.0) / 60.0)
+        # wraps around midnight, as the seconds of a timedelta do.
+        minutes = (self.end_minutes - self.start_minutes
+                   + self.break_minutes) % (24 * 60)
+        debug_log.debug(str(minutes / 60.0))
+        return minutes / 60.0
 
     def nearest_half(self):
         '''Rounds the time to the nearest half hour.'''
@@ -1116,26 +1438,23 @@ class TrackingEntry(models.Model):
     def normalized_break(self):
         '''Returns the shorter of breaklengths between the users actual break
         length and the one for this entry.'''
-        breaklength = dt.timedelta(hours=self.breaks.hour,
-                                   minutes=self.breaks.minute)
-        breaklength_reg = dt.timedelta(hours=self.user.breaklength.hour,
-                                       minutes=self.user.breaklength.minute)
-        if breaklength.seconds > breaklength_reg.seconds:
+        return dt.timedelta(minutes=self._normalized_break_minutes())
+
+    def _normalized_break_minutes(self):
+        '''The minutes of :meth:`normalized_break`.'''
+        if self.break_minutes > self.user.break_minutes:
             debug_log.debug("Returning regular break.")
-            return breaklength_reg
+            return self.user.break_minutes
         else:
             debug_log.debug("Returning actual break.")
-            return breaklength
+            return self.break_minutes
 
     def total_working_time(self):
         '''Total working time returns the actual working time of an
         entry, ignoring breaks taken over the regular amount.'''
-        td = dt.timedelta(hours=self.end_time.hour,
-                          minutes=self.end_time.minute)
-        td -= dt.timedelta(hours=self.start_time.hour,
-                           minutes=self.start_time.minute)
-        td += self.normalized_break()
-        return ((td.seconds / 60.0) / 60.0)
+        minutes = (self.end_minutes - self.start_minutes
+                   + self._normalized_break_minutes()) % (24 * 60)
+        return minutes / 60.0
 
     def is_overtime(self):
         '''Determines whether this tracking entry is overtime.'''
@@ -1172,7 +1491,7 @@ class TrackingEntry(models.Model):
 
     def sending_undertime(self):
         '''Returns if we are sending undertime for this entry.'''
-        return settings.UNDER_TIME_ENABLED.get(self.user.market)
+        return self.user.policy.undertime
 
     def send_notifications(self):
         '''Send the associated notifications for this tracking entry.
@@ -1185,3 +1504,918 @@ class TrackingEntry(models.Model):
             send_overtime_notification(self)
         if self.is_undertime() and self.sending_undertime():
             send_undertime_notification(self)
+
+
+class ArchivedEntry(models.Model):
+
+    '''A :class:`TrackingEntry` of a year which has been archived.
+
+    Closed years are moved out of the TrackingEntry table by the
+    `archive_years` management command so that the live table only holds
+    the years which are still being worked on. The archived entries keep
+    the same fields and calculations so that everything which reads a
+    single year can read them through :func:`entry_model`.
+    '''
+
+    user = models.ForeignKey(Tbluser, related_name="archived_entries")
+
+    entry_date = models.DateField()
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    breaks = models.TimeField()
+    daytype = models.CharField(choices=DAYTYPE_CHOICES,
+                               max_length=5)
+
+    start_minutes = MinutesField('start_time')
+    end_minutes = MinutesField('end_time')
+    break_minutes = MinutesField('breaks')
+
+    comments = models.TextField(blank=True)
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblarchivedentry'
+        verbose_name = 'Archived Tracking Log'
+        verbose_name_plural = 'Archived Tracking Logs'
+        unique_together = ('user', 'entry_date')
+        ordering = ['user']
+
+# archived entries are displayed and calculated exactly as the live ones.
+for _name in ('__unicode__', 'headings', 'worklength', 'breaktime',
+              'display_as_csv', 'threshold', 'totalhours', 'nearest_half',
+              'normalized_break', '_normalized_break_minutes',
+              'total_working_time', 'is_overtime',
+              'is_undertime', 'overtime_class', 'time_difference'):
+    setattr(ArchivedEntry, _name, TrackingEntry.__dict__[_name])
+del _name
+
+
+class ArchiveSummary(models.Model):
+
+    '''The totals of a user for an archived year.
+
+    The balance is calculated when the year is archived, with the
+    OVERRIDE_CALCULATION of the user's market if there is one, so that the
+    balance over all time only has to calculate the live entries.
+    '''
+
+    user = models.ForeignKey(Tbluser, related_name="archive_summaries")
+    year = models.IntegerField()
+    balance = models.FloatField()
+    # json map of the daytypes to the number of entries of that daytype.
+    daytypes = models.TextField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblarchivesummary'
+        unique_together = ('user', 'year')
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s - %.2f' % (self.user_id, self.year, self.balance)
+
+    def daytype_count(self, daytype):
+        '''The number of entries of a daytype in the year.'''
+        return simplejson.loads(self.daytypes).get(daytype, 0)
+
+
+class ArchivedYear(models.Model):
+
+    '''Records which years have been archived.'''
+
+    year = models.IntegerField(unique=True)
+    archived = models.DateTimeField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblarchivedyear'
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return unicode(self.year)
+
+    @staticmethod
+    def is_archived(year):
+        '''Whether `year` has been archived, see :func:`locked_periods`.'''
+        return int(year) in locked_periods()['archived']
+
+    @staticmethod
+    @transaction.commit_on_success
+    def archive(year):
+        '''Moves the entries of `year` into the archive and summarises
+        them.
+
+        The entries are copied and deleted in batches of their ids with
+        a statement each so neither the entries nor their signals are
+        loaded.
+
+        :returns: The number of entries which were archived.'''
+        year = int(year)
+        if ArchivedYear.objects.filter(year=year).exists():
+            raise ValueError("%d has already been archived." % year)
+        entries = TrackingEntry.objects.filter(entry_date__year=year)
+
+        counts = {}
+        for user_id, daytype, total in entries.values_list(
+                'user_id', 'daytype').annotate(total=Count('id')).order_by():
+            counts.setdefault(user_id, {})[daytype] = total
+        ArchiveSummary.objects.bulk_create([
+            ArchiveSummary(user=user, year=year,
+                           balance=user.get_total_balance(ret='flo',
+                                                          year=year),
+                           daytypes=simplejson.dumps(counts[user.id]))
+            for user in Tbluser.objects.filter(id__in=counts.keys())
+            ])
+
+        moved = _move_entries(TrackingEntry, ArchivedEntry, year)
+        ArchivedYear.objects.create(year=year, archived=dt.datetime.now())
+        return moved
+
+    @staticmethod
+    @transaction.commit_on_success
+    def restore(year):
+        '''Moves the entries of an archived year back into the live
+        table.
+
+        :returns: The number of entries which were restored.'''
+        year = int(year)
+        if not ArchivedYear.objects.filter(year=year).exists():
+            raise ValueError("%d hasn't been archived." % year)
+        moved = _move_entries(ArchivedEntry, TrackingEntry, year)
+        ArchiveSummary.objects.filter(year=year).delete()
+        ArchivedYear.objects.filter(year=year).delete()
+        return moved
+
+
+def _move_entries(source, target, year, batch=500):
+    '''Moves the entries of a year from one entry table to the other.
+
+    The entries are locked and then moved by their ids, so that an entry
+    written to the year in the meantime is left where it is instead of
+    being deleted without having been copied.'''
+    connection = connections[router.db_for_write(target)]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in target._meta.fields
+                        if not field.primary_key)
+    ids = list(source.objects.using(connection.alias).select_for_update()
+               .filter(entry_date__range=(dt.date(year, 1, 1),
+                                          dt.date(year, 12, 31)))
+               .values_list('id', flat=True))
+    table = quote(source._meta.db_table)
+    pk = quote(source._meta.pk.column)
+    cursor = connection.cursor()
+    moved = 0
+    for start in range(0, len(ids), batch):
+        chunk = ids[start:start + batch]
+        marks = ', '.join(['%s'] * len(chunk))
+        cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN (%s)'
+            % (quote(target._meta.db_table), columns, columns, table, pk,
+               marks), chunk)
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)'
+                       % (table, pk, marks), chunk)
+        moved += cursor.rowcount
+    transaction.set_dirty(using=connection.alias)
+    return moved
+
+
+def entry_model(year):
+    '''The model which holds the entries of `year`, either
+    :class:`TrackingEntry` or :class:`ArchivedEntry` when the year has
+    been archived.'''
+    if year and ArchivedYear.is_archived(year):
+        return ArchivedEntry
+    return TrackingEntry
+
+
+class ClosedMonth(models.Model):
+
+    '''Records which months have been closed by the `close_month`
+    management command.
+
+    The totals of every user for a closed month are frozen into a
+    :class:`MonthSnapshot` when it's closed and the reports read them
+    instead of recalculating the month from its entries. So that they keep
+    agreeing, the entries of a closed month can't be added, changed or
+    deleted until it's reopened.
+    '''
+
+    year = models.IntegerField()
+    month = models.IntegerField()
+    closed = models.DateTimeField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblclosedmonth'
+        unique_together = ('year', 'month')
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s/%s' % (self.year, self.month)
+
+    @staticmethod
+    def is_closed(year, month):
+        '''Whether the month has been closed, see :func:`locked_periods`.'''
+        return (int(year), int(month)) in locked_periods()['closed']
+
+
+_periods = {'checked': None, 'archived': frozenset(), 'closed': frozenset()}
+
+
+def locked_periods(now=None):
+    '''The years which have been archived and the months which have been
+    closed.
+
+    They're checked on every entry which is written, so each process keeps
+    them and reads them again at most every PERIOD_CHECK_INTERVAL seconds,
+    or as soon as it archives, restores, closes or reopens one itself.
+
+    :returns: A dict of the set of the archived years and the set of the
+              year and month of the closed months.'''
+    now = time.time() if now is None else now
+    if _periods['checked'] is None or now - _periods['checked'] >= \
+            getattr(settings, 'PERIOD_CHECK_INTERVAL', 10):
+        _periods['archived'] = frozenset(
+            ArchivedYear.objects.values_list('year', flat=True))
+        _periods['closed'] = frozenset(
+            ClosedMonth.objects.values_list('year', 'month'))
+        _periods['checked'] = now
+    return _periods
+
+
+@receiver(post_save, sender=ArchivedYear)
+@receiver(post_delete, sender=ArchivedYear)
+@receiver(post_save, sender=ClosedMonth)
+@receiver(post_delete, sender=ClosedMonth)
+def forget_periods(**kwargs):
+    '''Makes :func:`locked_periods` read the periods again.'''
+    _periods['checked'] = None
+
+
+class MonthSnapshot(models.Model):
+
+    '''The totals of a user for a closed month as they were when it was
+    closed.
+
+    Snapshots are written once, when the month is closed, and only go
+    away when it's reopened. Users created after the month was closed
+    don't have one and are calculated from their entries as usual.
+    '''
+
+    user = models.ForeignKey(Tbluser, related_name="month_snapshots")
+    year = models.IntegerField()
+    month = models.IntegerField()
+    # the balance of the month, as get_total_balance calculates it.
+    balance = models.FloatField()
+    # the hours worked on working days and Saturdays.
+    hours = models.FloatField()
+    # json map of the daytypes to the number of entries of that daytype.
+    daytypes = models.TextField()
+    # json map of the dates of the overtime entries to their overtime, as
+    # the month end overtime report shows it.
+    overtime = models.TextField()
+    # json list of the CATW report rows of the user, empty for markets
+    # without a CATW report.
+    catw = models.TextField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblmonthsnapshot'
+        unique_together = ('user', 'year', 'month')
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s/%s - %.2f' % (self.user_id, self.year, self.month,
+                                       self.balance)
+
+    def daytype_count(self, daytype):
+        '''The number of entries of a daytype in the month.'''
+        return simplejson.loads(self.daytypes).get(daytype, 0)
+
+    def overtime_map(self):
+        '''The overtime of each overtime entry, keyed by date.'''
+        return simplejson.loads(self.overtime)
+
+    def catw_rows(self):
+        '''The rows of the CATW report of the user.'''
+        return simplejson.loads(self.catw)
+
+    @staticmethod
+    def for_users(users, year, months=None):
+        '''The snapshots of the users in a year, optionally only those of
+        some months, in a single query.
+
+        :param users: An iterable of :class:`Tbluser` or their ids.
+        :returns: A dict keyed by the user id and month.'''
+        ids = [getattr(user, 'id', user) for user in users]
+        snapshots = MonthSnapshot.objects.filter(user__in=ids,
+                                                 year=int(year))
+        if months is not None:
+            snapshots = snapshots.filter(month__in=[int(month)
+                                                    for month in months])
+        return {(snapshot.user_id, snapshot.month): snapshot
+                for snapshot in snapshots}
+
+
+class DataVersion(models.Model):
+
+    '''Stamps which record when the data of a user for a given period last
+    changed.
+
+    A stamp is kept per user, year and month and is bumped whenever a
+    :class:`TrackingEntry` in that period is written. Changes to the user
+    themselves and to the teams they manage are recorded against year and
+    month 0.
+
+    Views can compute a cheap ETag/Last-Modified from the stamps with
+    :meth:`stamp` and avoid rendering anything when the client is up to
+    date.
+    '''
+
+    user = models.ForeignKey(Tbluser, related_name="data_versions")
+    year = models.IntegerField(db_index=True)
+    month = models.IntegerField()
+    version = models.IntegerField(default=0)
+    modified = models.DateTimeField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tbldataversion'
+        unique_together = ('user', 'year', 'month')
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s/%s - %s' % (self.user_id, self.year, self.month,
+                                     self.version)
+
+    @staticmethod
+    def bump(user_id, year=0, month=0):
+        '''Increments the stamp for a user and period, creating it if it
+        doesn't exist yet.'''
+        now = dt.datetime.now()
+        stamps = DataVersion.objects.filter(user=user_id, year=year,
+                                            month=month)
+        if stamps.update(version=F('version') + 1, modified=now):
+            return
+        # the user is being deleted along with their entries.
+        if not Tbluser.objects.filter(id=user_id).exists():
+            return
+        sid = transaction.savepoint()
+        try:
+            DataVersion.objects.create(user_id=user_id, year=year,
+                                       month=month, version=1,
+                                       modified=now)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # somebody else created it in the meantime
+            transaction.savepoint_rollback(sid)
+            stamps.update(version=F('version') + 1, modified=now)
+
+    @staticmethod
+    def of_user(user_id, year=None):
+        '''Selects the stamps of a single user, optionally only those of
+        a year along with the user's own details.'''
+        if year is None:
+            return Q(user=user_id)
+        return Q(user=user_id, year__in=[0, year])
+
+    @staticmethod
+    def of_details():
+        '''Selects the stamps of the details and teams of every user.'''
+        return Q(year=0)
+
+    @staticmethod
+    def of_period(year, month=None):
+        '''Selects the stamps of every user for a year or month along with
+        the details of every user.'''
+        if month is None:
+            return Q(year__in=[0, year])
+        return Q(year=year, month=month) | DataVersion.of_details()
+
+    @staticmethod
+    def stamp(query):
+        '''Summarises the stamps matching `query` in a single query.
+
+        :param query: :class:`Q` object selecting the stamps.
+        :returns: A tuple of the number of stamps, the sum of their
+                  versions and the last time any of them was modified.'''
+        result = DataVersion.objects.filter(query).aggregate(
+            count=Count('id'), version=Sum('version'), modified=Max('modified')
+            )
+        return (result['count'], result['version'] or 0, result['modified'])
+
+
+class Change(models.Model):
+
+    '''The journal of the changes to the entries, users and teams.
+
+    A change is appended, in the same transaction, for every
+    :class:`TrackingEntry` which is saved or deleted, every
+    :class:`Tbluser`, :class:`Tblauthorization` and :class:`RelatedUsers`
+    which is saved or deleted and every user added to or removed from a
+    team. Changes are never updated, so anything which keeps its own copy
+    of the data, such as a cache, a snapshot or an export, can remember the
+    id of the last change it processed and carry on from it with
+    :meth:`since` or a :class:`ChangeCursor` instead of scanning the
+    tables again.
+
+    The entries of an entry record its daytype and its start, end and
+    breaks in minutes before and after the change. An entry moved to
+    another day is recorded as deleted from the old day and created on the
+    new one, so the old day is seen to be empty. The members of a team
+    are recorded against the team with the member as the user. Years
+    which are archived or restored and rows inserted in bulk, such as by
+    `generate_dataset`, aren't journalled.
+
+    Ids are handed out when a change is written but only seen once it's
+    committed, so on databases with concurrent writers a reader which is
+    right behind the writers can see a change before one with a lower id.
+    :meth:`since` therefore stays CHANGE_SETTLE seconds behind them.
+    '''
+
+    OPERATIONS = (
+        ('create', 'Created'),
+        ('update', 'Updated'),
+        ('delete', 'Deleted'),
+        ('add', 'Added to team'),
+        ('remove', 'Removed from team'),
+        )
+
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    # not a foreign key, changes outlive the users they're about.
+    user_id = models.IntegerField()
+    entry_date = models.DateField(null=True)
+    operation = models.CharField(choices=OPERATIONS, max_length=6)
+
+    old_daytype = models.CharField(max_length=5, blank=True)
+    old_start = models.SmallIntegerField(null=True)
+    old_end = models.SmallIntegerField(null=True)
+    old_breaks = models.SmallIntegerField(null=True)
+    new_daytype = models.CharField(max_length=5, blank=True)
+    new_start = models.SmallIntegerField(null=True)
+    new_end = models.SmallIntegerField(null=True)
+    new_breaks = models.SmallIntegerField(null=True)
+
+    changed = models.DateTimeField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblchange'
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s %s %s' % (self.id, self.operation, self.model,
+                                   self.object_id)
+
+    @staticmethod
+    def record(instance, operation, user_id, entry_date=None, old=None,
+               new=None):
+        '''Appends a change to the journal.
+
+        :param instance: The model instance which changed.
+        :param user_id: The user the change is about.
+        :param old: The daytype, start, end and breaks of an entry before
+                    the change.
+        :param new: The same after the change.'''
+        old = old or ('', None, None, None)
+        new = new or ('', None, None, None)
+        return Change.objects.create(
+            model=instance._meta.module_name, object_id=instance.pk,
+            user_id=user_id, entry_date=entry_date, operation=operation,
+            old_daytype=old[0], old_start=old[1], old_end=old[2],
+            old_breaks=old[3], new_daytype=new[0], new_start=new[1],
+            new_end=new[2], new_breaks=new[3], changed=dt.datetime.now())
+
+    @staticmethod
+    def since(cursor, limit=1000, settle=None):
+        '''The changes after `cursor`, oldest first.
+
+        Only the changes written more than `settle` seconds ago are
+        returned, as those after them may not all have been committed yet,
+        so that a reader which carries on from the last change it was given
+        doesn't skip one which commits late.
+
+        :param cursor: The id of the last change which was processed, 0
+                       for the start of the journal.
+        :param limit: The most changes to return.
+        :param settle: How long a change may take to be committed, in
+                       seconds, CHANGE_SETTLE by default.
+        :rtype: :class:`list` of :class:`Change`'''
+        if settle is None:
+            settle = getattr(settings, 'CHANGE_SETTLE', 60)
+        cutoff = dt.datetime.now() - dt.timedelta(seconds=settle)
+        return list(Change.objects.filter(id__gt=cursor, changed__lt=cutoff)
+                    .order_by('id')[:limit])
+
+
+class ChangeCursor(models.Model):
+
+    '''How far through the :class:`Change` journal a consumer is.
+
+    .. code-block:: python
+
+       changes = ChangeCursor.read('holiday-export')
+       ...
+       if changes:
+           ChangeCursor.advance('holiday-export', changes[-1].id)
+    '''
+
+    name = models.CharField(max_length=50, unique=True)
+    position = models.IntegerField(default=0)
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblchangecursor'
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s' % (self.name, self.position)
+
+    @staticmethod
+    def position_of(name):
+        '''The id of the last change the consumer `name` processed.'''
+        positions = ChangeCursor.objects.filter(name=name).values_list(
+            'position', flat=True)
+        return positions[0] if positions else 0
+
+    @staticmethod
+    def read(name, limit=1000, settle=None):
+        '''The changes the consumer `name` hasn't processed yet, see
+        :meth:`Change.since`.'''
+        return Change.since(ChangeCursor.position_of(name), limit, settle)
+
+    @staticmethod
+    def advance(name, position):
+        '''Records that the consumer `name` processed the changes up to and
+        including the change with the id `position`.'''
+        if not ChangeCursor.objects.filter(name=name).update(
+                position=position):
+            ChangeCursor.objects.create(name=name, position=position)
+
+
+class BalanceIndex(models.Model):
+
+    '''Running totals of a user's entries through a year.
+
+    For every day of the year which has an entry the index holds the
+    totals from the start of the year up to and including that day of:
+
+    * delta: the minutes over or under the shiftlength, as the regular
+      balance calculation counts them.
+    * worked: the minutes of the working days and Saturdays, as
+      :meth:`TrackingEntry.totalhours` counts them.
+    * the number of entries of each daytype.
+
+    The totals over any range of days are then the difference of two
+    lookups instead of a scan of the entries. The index remembers the
+    :class:`DataVersion` stamps it was built from and is rebuilt the first
+    time it's used after any of them changed. Whether it has is decided on
+    the database the index is written to, so that pages read from a
+    replica which is behind don't rebuild it on every request.
+    '''
+
+    # the format of the data, indexes stored in another one are rebuilt.
+    FORMAT = 'z'
+
+    user = models.ForeignKey(Tbluser, related_name="balance_indexes")
+    year = models.IntegerField()
+    # the number and sum of the stamps of the user and year.
+    version = models.CharField(max_length=40)
+    # json map of the names of the totals to their running totals packed
+    # as arrays, the days of the year the totals are for are kept under
+    # "days".
+    data = models.TextField()
+
+    class Meta:
+        '''
+        Metaclass gives access to additional options
+        '''
+        db_table = u'tblbalanceindex'
+        unique_together = ('user', 'year')
+
+    def __unicode__(self):
+        '''
+        Admin view uses this to display the entry
+        '''
+        return u'%s - %s - %s' % (self.user_id, self.year, self.version)
+
+    @property
+    def totals(self):
+        '''The running totals as arrays.'''
+        if getattr(self, '_totals', None) is None:
+            self._totals = {
+                name: _unpack_ints(values)
+                for name, values in simplejson.loads(self.data).items()
+                }
+        return self._totals
+
+    def fill(self, user, rows):
+        '''Calculates the running totals.
+
+        :param user: The :class:`Tbluser` the entries belong to.
+        :param rows: The entry_date, start_minutes, end_minutes,
+                     break_minutes and daytype of each entry, in date
+                     order.'''
+        shift = user.shift_minutes
+        rover = shift + user.break_minutes
+        counted = [choice[0] for choice in WORKING_CHOICES
+                   if choice[0] != "SATUR"]
+        totals = defaultdict(lambda: [0] * (len(rows) + 1))
+        totals["days"] = []
+        for position, (date, start, end, breaks, daytype) in \
+                enumerate(rows, 1):
+            totals["days"].append(date.timetuple().tm_yday)
+            delta = worked = 0
+            if daytype in counted:
+                delta = end - start - breaks - shift
+            elif daytype == "ROVER":
+                delta = -rover
+            if daytype in ("WKDAY", "SATUR"):
+                # totalhours wraps around midnight like a timedelta.
+                worked = (end - start + breaks) % (24 * 60)
+            totals[daytype][position] = 1
+            totals["delta"][position] = delta
+            totals["worked"][position] = worked
+        for name, values in totals.items():
+            if name != "days":
+                for position in range(1, len(values)):
+                    values[position] += values[position - 1]
+        self.data = simplejson.dumps({
+                name: _pack_ints(values) for name, values in totals.items()
+                })
+        self._totals = None
+
+    def total(self, name, start, end):
+        '''The total of `name` over the days from `start` to `end`, which
+        must be dates in the year of the index.
+
+        :param name: delta, worked or a daytype.'''
+        values = self.totals.get(name)
+        if values is None:
+            return 0
+        days = self.totals["days"]
+        return (values[bisect_right(days, end.timetuple().tm_yday)]
+                - values[bisect_left(days, start.timetuple().tm_yday)])
+
+    @staticmethod
+    def versions(user_ids, year, using=None):
+        '''The version of the data of each user in a year.'''
+        return {
+            user_id: BalanceIndex.version_of(count, version)
+            for user_id, count, version in DataVersion.objects.using(
+                using).filter(user__in=user_ids, year__in=[0, year]
+                ).values_list('user').annotate(
+                count=Count('id'), version=Sum('version')).order_by()
+            }
+
+    @staticmethod
+    def version_of(count=0, version=0):
+        '''The version of an index built from `count` stamps whose versions
+        add up to `version`.'''
+        return "%s:%d:%d" % (BalanceIndex.FORMAT, count, version)
+
+    @staticmethod
+    def prefetch(users, years):
+        '''Loads the indexes of `users` for `years` onto the users so
+        that :meth:`Tbluser.balance_index` doesn't query for them.
+
+        Out of date indexes are rebuilt from a single query of the entries
+        of every user who needs it, so this takes a handful of queries
+        however many users there are.'''
+        users = list(users)
+        ids = [user.id for user in users]
+        using = router.db_for_write(BalanceIndex)
+        for year in set(years):
+            versions = BalanceIndex.versions(ids, year, using)
+            indexes = {index.user_id: index for index in
+                       BalanceIndex.objects.using(using).filter(
+                           user__in=ids, year=year)}
+            stale = [user for user in users
+                     if user.id not in indexes or indexes[user.id].version
+                     != versions.get(user.id, BalanceIndex.version_of())]
+            rows = defaultdict(list)
+            if stale:
+                for row in entry_model(year).objects.using(using).filter(
+                        user__in=[user.id for user in stale],
+                        entry_date__year=year).order_by(
+                        'entry_date').values_list(
+                        'user_id', 'entry_date', 'start_minutes',
+                        'end_minutes', 'break_minutes', 'daytype'):
+                    rows[row[0]].append(row[1:])
+            for user in stale:
+                index = indexes.get(user.id) or BalanceIndex(user_id=user.id,
+                                                             year=year)
+                index.version = versions.get(user.id,
+                                             BalanceIndex.version_of())
+                index.fill(user, rows[user.id])
+                index.store()
+                indexes[user.id] = index
+            for user in users:
+                if getattr(user, '_balance_indexes', None) is None:
+                    user._balance_indexes = {}
+                user._balance_indexes[year] = indexes[user.id]
+
+    def store(self):
+        '''Saves the index, another process may have built the same one
+        in the meantime.'''
+        sid = transaction.savepoint()
+        try:
+            self.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+
+
+def _minutes(value):
+    '''The number of minutes since midnight of a time.'''
+    return value.hour * 60 + value.minute
+
+
+def _pack_ints(values):
+    '''Packs integers into a short string, as compressed little endian
+    32 bit integers in base64.'''
+    packed = array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return base64.b64encode(zlib.compress(packed.tostring()))
+
+
+def _unpack_ints(value):
+    '''The array of integers packed by :func:`_pack_ints`.'''
+    unpacked = array('i')
+    unpacked.fromstring(zlib.decompress(base64.b64decode(value)))
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+def _year_ranges(start, end):
+    '''Splits the days from `start` to `end` by year.'''
+    for year in range(start.year, end.year + 1):
+        yield (year, max(start, dt.date(year, 1, 1)),
+               min(end, dt.date(year, 12, 31)))
+
+
+def _entry_date(value):
+    '''Entries are often saved with the date still as a string.'''
+    return TrackingEntry._meta.get_field('entry_date').to_python(value)
+
+def _check_writable(date):
+    '''Entries can't be written into a year which has been archived, nor
+    into a month which has been closed, as the reports show the month's
+    snapshots and would no longer agree with its entries.
+
+    :raises: :class:`ValidationError`'''
+    if not date:
+        return
+    if ArchivedYear.is_archived(date.year):
+        raise ValidationError("Entries can't be changed in a year "
+                              "which has been archived.")
+    if ClosedMonth.is_closed(date.year, date.month):
+        raise ValidationError("Entries can't be changed in a month "
+                              "which has been closed.")
+
+@contextmanager
+def _transaction(using):
+    '''Runs the block in a transaction unless it's already in one, Django
+    commits each statement on its own otherwise.'''
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+@receiver(post_save, sender=TrackingEntry)
+def _bump_entry_save(sender, instance, **kwargs):
+    '''Bumps the stamps of the periods touched by a saved entry.'''
+    date = _entry_date(instance.entry_date)
+    DataVersion.bump(instance.user_id, date.year, date.month)
+    previous = getattr(instance, '_previous_date', None)
+    if previous and (previous.year, previous.month) != (date.year, date.month):
+        DataVersion.bump(instance.user_id, previous.year, previous.month)
+
+@receiver(pre_delete, sender=TrackingEntry)
+def _load_deleted_entry(sender, instance, **kwargs):
+    '''Entries are sometimes deleted through an instance which only has
+    the primary key, in that case we fetch the period.'''
+    if instance.entry_date is None or instance.user_id is None:
+        try:
+            (instance.user_id, instance.entry_date, instance.daytype,
+             instance.start_time, instance.end_time, instance.breaks) = \
+                TrackingEntry.objects.filter(pk=instance.pk).values_list(
+                'user_id', 'entry_date', 'daytype', 'start_time', 'end_time',
+                'breaks')[0]
+        except IndexError:
+            pass
+
+@receiver(post_delete, sender=TrackingEntry)
+def _bump_entry_delete(sender, instance, **kwargs):
+    '''Bumps the stamp of the period of a deleted entry.'''
+    if instance.entry_date is None or instance.user_id is None:
+        return
+    date = _entry_date(instance.entry_date)
+    DataVersion.bump(instance.user_id, date.year, date.month)
+    Change.record(instance, 'delete', instance.user_id, date,
+                  old=(instance.daytype, instance.start_minutes,
+                       instance.end_minutes, instance.break_minutes))
+
+@receiver(post_save, sender=Tbluser)
+def _bump_user_save(sender, instance, **kwargs):
+    '''Bumps the stamp of a user's own details.'''
+    DataVersion.bump(instance.id)
+
+@receiver(post_save, sender=Tblauthorization)
+@receiver(post_save, sender=RelatedUsers)
+def _bump_team_save(sender, instance, **kwargs):
+    '''Bumps the stamp of a manager when their team changes.'''
+    DataVersion.bump(instance.admin_id)
+
+@receiver(m2m_changed, sender=Tblauthorization.users.through)
+@receiver(m2m_changed, sender=RelatedUsers.users.through)
+def _bump_team_members(sender, instance, action, reverse, model, pk_set,
+                       **kwargs):
+    '''Bumps the stamp of a manager when users are added to or removed
+    from their team.'''
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        DataVersion.bump(instance.admin_id)
+        return
+    # the team was changed from the user's side.
+    DataVersion.bump(instance.id)
+    for admin_id in model.objects.filter(
+            pk__in=pk_set or []).values_list('admin_id', flat=True):
+        DataVersion.bump(admin_id)
+
+@receiver(post_save, sender=Tbluser)
+@receiver(post_save, sender=Tblauthorization)
+@receiver(post_save, sender=RelatedUsers)
+def _journal_save(sender, instance, created, raw=False, **kwargs):
+    '''Journals a saved user or team.'''
+    if raw:
+        return
+    Change.record(instance, 'create' if created else 'update',
+                  getattr(instance, 'admin_id', instance.pk))
+
+@receiver(post_delete, sender=Tbluser)
+@receiver(post_delete, sender=Tblauthorization)
+@receiver(post_delete, sender=RelatedUsers)
+def _journal_delete(sender, instance, **kwargs):
+    '''Journals a deleted user or team.'''
+    Change.record(instance, 'delete',
+                  getattr(instance, 'admin_id', instance.pk))
+
+@receiver(m2m_changed, sender=Tblauthorization.users.through)
+@receiver(m2m_changed, sender=RelatedUsers.users.through)
+def _journal_team_members(sender, instance, action, reverse, model, pk_set,
+                          **kwargs):
+    '''Journals the users added to or removed from a team, one change for
+    each of them.'''
+    if action == 'pre_clear':
+        # the members are gone by the time we're told they were cleared.
+        members = model.objects.filter(users=instance.pk) if reverse \
+            else instance.users.all()
+        instance._cleared = list(members.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    operation = 'add' if action == 'post_add' else 'remove'
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared', [])
+    if not reverse:
+        for user_id in pk_set or []:
+            Change.record(instance, operation, user_id)
+        return
+    # the team was changed from the user's side.
+    for team in model.objects.filter(pk__in=pk_set or []):
+        Change.record(team, operation, instance.pk)
@@ -7,31 +7,52 @@ that our application works.
 
 Generally, when adding new functionality you will want to write tests
 before it and then write your new feature whilst checking the tests.'''
+import os
 import datetime
 import simplejson
 import random
 import functools
 import time
+from StringIO import StringIO
 from unittest import skipUnless
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import IntegrityError
+from django.db.models import Q
 from django.test import TestCase, LiveServerTestCase
 from django.http import HttpResponse, Http404
 
 from timetracker.tracker.models import (Tbluser,
                             TrackingEntry,
-                            Tblauthorization)
+                            Tblauthorization,
+                            DataVersion,
+                            ArchivedEntry,
+                            ArchiveSummary,
+                            ArchivedYear,
+                            BalanceIndex,
+                            ClosedMonth,
+                            MonthSnapshot,
+                            forget_periods,
+                            locked_periods)
 
 from timetracker.middleware.exception_handler import UnreadablePostErrorMiddleware
+from timetracker.middleware.metrics import (MetricsMiddleware,
+                                            MetricsRegistry, render_metrics)
 from django.http import UnreadablePostError
 
 from timetracker.utils.calendar_utils import (validate_time, parse_time,
                                               delete_user, useredit,
                                               mass_holidays, ajax_delete_entry,
                                               gen_calendar, ajax_change_entry,
-                                              ajax_error)
+                                              ajax_error, get_holiday_rows,
+                                              get_holiday_changes)
 from timetracker.utils.datemaps import pad, float_to_time, generate_select, ABSENT_CHOICES
 from timetracker.utils.error_codes import DUPLICATE_ENTRY
+from timetracker.utils.profiling import profile_call
+from timetracker.utils.writers import UnicodeWriter, CSVWriter
+from timetracker.utils import employee_search as employee_search_index
+from timetracker.utils.employee_search import employee_search
 
 try:
     from selenium.webdriver.firefox.webdriver import WebDriver
@@ -41,6 +62,12 @@ try:
 except ImportError:
     SELENIUM_AVAILABLE = False
 
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 
 def create_users(cls):
     '''we create users which will be linked to test how the automatic,
@@ -511,6 +538,709 @@ class TrackingEntryTestCase(BaseUserTest):
             self.assertTrue(entry.time_difference() == 0)
 
 
+@skipUnless(NUMPY_AVAILABLE, "numpy is not installed")
+class HolidayChartTest(BaseUserTest):
+    '''Tests the counting done for the holiday chart.'''
+    def testDailyCounts(self):
+        '''Entries should be counted per day of the year, split by the
+        year, market and daytype.'''
+        from timetracker.tracker.management.commands.holiday_chart import (
+            daily_counts)
+        for user, date, daytype in [
+            (self.linked_user, "2012-01-02", "HOLIS"),
+            (self.linked_manager, "2012-01-02", "HOLIS"),
+            (self.linked_teamlead, "2012-12-31", "HOLIS"),
+            (self.linked_user, "2013-01-03", "HOLIS"),
+            (self.linked_manager, "2013-01-03", "SICKD"),
+            ]:
+            TrackingEntry(entry_date=date, user_id=user.id,
+                          start_time="09:00", end_time="17:00",
+                          breaks="00:15", daytype=daytype).save()
+        counts = daily_counts([2012, 2013], ["HOLIS"])
+        self.assertEquals(sorted(counts),
+                          [(2012, None, "HOLIS"), (2013, None, "HOLIS")])
+        self.assertEquals(counts[(2012, None, "HOLIS")][1], 2)
+        self.assertEquals(counts[(2012, None, "HOLIS")][365], 1)
+        self.assertEquals(counts[(2012, None, "HOLIS")].sum(), 3)
+        self.assertEquals(counts[(2013, None, "HOLIS")][2], 1)
+
+        counts = daily_counts([2013], ["HOLIS", "SICKD"], markets=["BG"],
+                              by_market=True)
+        self.assertEquals(sorted(counts),
+                          [(2013, "BG", "HOLIS"), (2013, "BG", "SICKD")])
+        self.assertEquals(daily_counts([2013], ["HOLIS"], markets=["BF"]), {})
+
+
+class ArchiveTest(BaseUserTest):
+    '''Tests moving closed years into the archive.'''
+    def testArchive(self):
+        '''Archived years should read the same as they did when they were
+        live and be restored untouched.'''
+        from django.core.management import call_command
+        self.addCleanup(forget_periods)
+        for date, end, daytype in [
+            ("2012-01-02", "18:00", "WKDAY"),
+            ("2012-01-03", "17:00", "HOLIS"),
+            ("2012-02-01", "16:00", "WKDAY"),
+            ("2013-01-02", "19:00", "WKDAY"),
+            ]:
+            TrackingEntry(entry_date=date, user_id=self.linked_user.id,
+                          start_time="09:00", end_time=end,
+                          breaks="00:15", daytype=daytype).save()
+        user = Tbluser.objects.get(id=self.linked_user.id)
+        before = (user.get_total_balance(ret='flo'),
+                  user.get_total_balance(ret='flo', year=2012),
+                  user.get_total_balance(ret='flo', year=2012, month=1),
+                  user.get_balances(2012), user.yearview(2012))
+
+        call_command('archive_years', 2012, stdout=StringIO())
+        self.assertEquals(TrackingEntry.objects.count(), 1)
+        self.assertEquals(ArchivedEntry.objects.count(), 3)
+        self.assertEquals(before,
+                          (user.get_total_balance(ret='flo'),
+                           user.get_total_balance(ret='flo', year=2012),
+                           user.get_total_balance(ret='flo', year=2012,
+                                                  month=1),
+                           user.get_balances(2012), user.yearview(2012)))
+        self.assertRaises(ValidationError, TrackingEntry(
+                entry_date="2012-03-01", user_id=user.id,
+                start_time="09:00", end_time="17:00",
+                breaks="00:15", daytype="WKDAY").save)
+        self.linked_manager_request.POST = {
+            'year': '2012', 'month': '3',
+            'mass_data': simplejson.dumps({user.id: ['empty', 'HOLIS']})}
+        self.assertEquals(
+            simplejson.loads(
+                mass_holidays(self.linked_manager_request).content),
+            {'success': False, 'error': "This year has been archived."})
+        self.assertRaises(ValueError, ArchivedYear.archive, 2012)
+        # the archived years are kept rather than read for every entry.
+        with self.assertNumQueries(0):
+            self.assertTrue(ArchivedYear.is_archived(2012))
+            self.assertFalse(ArchivedYear.is_archived(2013))
+
+        call_command('archive_years', 2012, restore=True,
+                     stdout=StringIO())
+        self.assertEquals(TrackingEntry.objects.count(), 4)
+        self.assertFalse(ArchivedEntry.objects.exists())
+        self.assertFalse(ArchiveSummary.objects.exists())
+        self.assertEquals(before[0], user.get_total_balance(ret='flo'))
+
+
+class MonthSnapshotTest(BaseUserTest):
+    '''Tests freezing the totals of closed months.'''
+    def testCloseMonth(self):
+        '''Closed months should be reported from their snapshots until
+        they're reopened.'''
+        from django.core.management import call_command
+        from django.test.client import RequestFactory
+        from timetracker.reporting.views import ot_by_month
+        from timetracker.tracker.management.commands import close_month
+        self.addCleanup(forget_periods)
+        for date, end, daytype in [
+            ("2012-01-02", "18:00", "WKDAY"),
+            ("2012-01-03", "17:00", "HOLIS"),
+            ("2012-02-01", "16:00", "WKDAY"),
+            ]:
+            TrackingEntry(entry_date=date, user_id=self.linked_user.id,
+                          start_time="09:00", end_time=end,
+                          breaks="00:15", daytype=daytype).save()
+        user = Tbluser.objects.get(id=self.linked_user.id)
+        balance = user.get_total_balance(ret='flo', year=2012, month=1)
+
+        call_command('close_month', year=2012, month=1, stdout=StringIO())
+        self.assertTrue(ClosedMonth.is_closed(2012, 1))
+        self.assertEquals(MonthSnapshot.objects.count(),
+                          Tbluser.objects.count())
+        snapshot = MonthSnapshot.objects.get(user=user, year=2012, month=1)
+        self.assertAlmostEquals(snapshot.balance, balance)
+        self.assertAlmostEquals(snapshot.hours, 9.25)
+        self.assertEquals(snapshot.daytype_count("HOLIS"), 1)
+        self.assertEquals(snapshot.overtime_map().keys(), ["2012-01-02"])
+        # a row for each day of the month, the weekends are blank.
+        self.assertEquals(len(snapshot.catw_rows()), 31)
+        self.assertEquals(len(filter(None, snapshot.catw_rows())), 22)
+        self.assertEquals(close_month.verify(2012, 1), [])
+        self.assertRaises(ValueError, close_month.close, 2012, 1)
+
+        # the entries of the closed month can't be changed.
+        entry = TrackingEntry.objects.get(user=user, entry_date="2012-01-02")
+        entry.end_time = "19:00"
+        self.assertRaises(ValidationError, entry.save)
+        moved = TrackingEntry.objects.get(user=user, entry_date="2012-02-01")
+        moved.entry_date = "2012-01-04"
+        self.assertRaises(ValidationError, moved.save)
+        moved = TrackingEntry.objects.get(user=user, entry_date="2012-01-03")
+        moved.entry_date = "2012-02-02"
+        self.assertRaises(ValidationError, moved.save)
+        self.assertRaises(ValidationError, TrackingEntry(id=entry.id).delete)
+        self.assertRaises(ValidationError, TrackingEntry(
+                entry_date="2012-01-05", user_id=user.id, start_time="09:00",
+                end_time="17:00", breaks="00:15", daytype="WKDAY").save)
+        self.assertEquals(
+            TrackingEntry.objects.filter(user=user).count(), 3)
+
+        # the reports keep reading the closed month as it was, even when
+        # its entries are changed behind the models' back.
+        super(TrackingEntry, entry).save()
+        self.assertEquals(
+            sorted(field for _, field, _, _ in close_month.verify(2012, 1)),
+            ["balance", "catw", "hours", "overtime"])
+        request = RequestFactory().get('/')
+        request.session = {'user_id': self.linked_manager.id}
+        rows = ot_by_month(request, year="2012", month="1") \
+            .content.decode('utf-8-sig').splitlines()
+        self.assertEquals(rows[-1].split(',')[2], "%.2f" % balance)
+
+        call_command('close_month', year=2012, month=1, reopen=True,
+                     stdout=StringIO())
+        self.assertFalse(MonthSnapshot.objects.exists())
+        rows = ot_by_month(request, year="2012", month="1") \
+            .content.decode('utf-8-sig').splitlines()
+        self.assertEquals(rows[-1].split(',')[2], "%.2f" % (balance + 1))
+
+
+class ReportJobTest(BaseUserTest):
+    '''Tests calculating the reports in the background.'''
+    def setUp(self):
+        super(ReportJobTest, self).setUp()
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(ReportJobTest, self).tearDown()
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def testReportJobs(self):
+        '''Reports should be calculated once per span of control and
+        data version and downloaded when they're done.'''
+        from django.test.client import RequestFactory
+        from timetracker.reporting import jobs
+        from timetracker.reporting.models import ReportJob
+        from timetracker.reporting.views import ot_by_month
+        path = '/reporting/ot_by_month/2012/1/'
+        request = self.linked_manager_request
+
+        def submit(path):
+            request.POST = {'path': path}
+            return simplejson.loads(jobs.submit_report_job(request).content)
+
+        def status(key):
+            request.GET = {'key': key}
+            return simplejson.loads(jobs.report_job_status(request).content)
+
+        with self.settings(REPORT_JOB_DIR=self.directory):
+            first = submit(path)
+            self.assertEquals(first['status'], 'PENDING')
+            self.assertEquals(submit(path)['key'], first['key'])
+            self.assertEquals(ReportJob.objects.count(), 1)
+            self.assertFalse(submit('/reporting/')['success'])
+            self.assertFalse(submit('/nowhere/')['success'])
+            # without a worker the page falls back to the report's url.
+            job = ReportJob.objects.get(key=first['key'])
+            self.assertFalse('fallback' in jobs.job_data(job))
+            self.assertEquals(jobs.job_data(
+                    job, job.created + datetime.timedelta(seconds=30)
+                    )['fallback'], path)
+
+            self.assertEquals(len(jobs.run_pending()), 1)
+            self.assertEquals(jobs.run_pending(), [])
+            done = status(first['key'])
+            self.assertEquals(done['status'], 'DONE')
+
+            direct = RequestFactory().get(path)
+            direct.session = {'user_id': self.linked_manager.id}
+            download = RequestFactory().get(done['download'])
+            download.session = direct.session
+            response = jobs.download_report_job(download, key=first['key'])
+            self.assertEquals(response.content,
+                              ot_by_month(direct, year='2012',
+                                          month='1').content)
+            self.assertEquals(response['Content-Disposition'],
+                              'attachment;filename=OT_By_Month_2012_1.csv')
+
+            # other spans of control can't see it.
+            download.session = {'user_id': self.unlinked_manager.id}
+            self.assertRaises(Http404, jobs.download_report_job, download,
+                              key=first['key'])
+
+            # the report is calculated again once the data changes.
+            TrackingEntry(entry_date="2012-01-02",
+                          user_id=self.linked_user.id,
+                          start_time="09:00", end_time="17:00",
+                          breaks="00:15", daytype="WKDAY").save()
+            self.assertNotEquals(submit(path)['key'], first['key'])
+
+            job = ReportJob.objects.get(key=first['key'])
+            self.assertTrue(os.path.exists(job.result_path))
+            jobs.cleanup(job.expires)
+            self.assertFalse(os.path.exists(job.result_path))
+            self.assertFalse(status(first['key'])['success'])
+
+
+class BalanceIndexTest(BaseUserTest):
+    '''Tests answering balances over ranges of dates from the index.'''
+    def setUp(self):
+        super(BalanceIndexTest, self).setUp()
+        for date, end, daytype in [
+            ("2012-01-02", "18:00", "WKDAY"),
+            ("2012-01-03", "17:00", "HOLIS"),
+            ("2012-01-04", "16:30", "WKDAY"),
+            ("2012-01-07", "12:00", "WKDAY"),
+            ("2012-02-01", "17:00", "ROVER"),
+            ("2012-12-31", "19:00", "WKDAY"),
+            ("2013-01-02", "16:00", "WKDAY"),
+            ]:
+            TrackingEntry(entry_date=date, user_id=self.linked_user.id,
+                          start_time="09:00", end_time=end,
+                          breaks="00:15", daytype=daytype).save()
+        self.user = Tbluser.objects.get(id=self.linked_user.id)
+
+    def scanned(self, start, end):
+        '''The balance of a range calculated from the entries.'''
+        entries = TrackingEntry.objects.filter(
+            user_id=self.user.id, entry_date__range=(start, end))
+        return self.user._regular_calculation(
+            entries.filter(daytype__in=["WKDAY", "WKHOM"]),
+            entries.filter(daytype="ROVER"))
+
+    def testRanges(self):
+        '''Any range should give the same balance and counts as scanning
+        the entries.'''
+        for start, end in [("2012-01-01", "2012-12-31"),
+                           ("2012-01-03", "2012-01-04"),
+                           ("2012-01-05", "2012-01-31"),
+                           ("2012-02-01", "2012-02-01"),
+                           ("2012-12-01", "2013-01-31")]:
+            start = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+            end = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+            self.assertAlmostEquals(self.user.get_range_balance(start, end),
+                                    self.scanned(start, end))
+            self.assertEquals(
+                self.user.range_totals(start, end, "WKDAY", "HOLIS"),
+                [TrackingEntry.objects.filter(
+                        user_id=self.user.id, daytype=daytype,
+                        entry_date__range=(start, end)).count()
+                 for daytype in ("WKDAY", "HOLIS")])
+        self.assertAlmostEquals(
+            self.user.get_total_balance(ret='flo', year=2012, month=1),
+            self.scanned(datetime.date(2012, 1, 1),
+                         datetime.date(2012, 1, 31)))
+
+    def testRebuild(self):
+        '''The index should only be rebuilt once the entries change.'''
+        BalanceIndex.prefetch([self.user], [2012])
+        version = BalanceIndex.objects.get(user=self.user, year=2012).version
+        user = Tbluser.objects.get(id=self.user.id)
+        forget_periods()
+        locked_periods()
+        # the version of the year and the index.
+        with self.assertNumQueries(2):
+            user.get_total_balance(ret='flo', year=2012)
+        entry = TrackingEntry.objects.get(user=self.user,
+                                          entry_date="2012-01-04")
+        entry.end_time = "18:30"
+        entry.save()
+        user = Tbluser.objects.get(id=self.user.id)
+        self.assertAlmostEquals(
+            user.get_total_balance(ret='flo', year=2012),
+            self.scanned(datetime.date(2012, 1, 1),
+                         datetime.date(2012, 12, 31)))
+        self.assertNotEquals(
+            BalanceIndex.objects.get(user=self.user, year=2012).version,
+            version)
+
+    def testReport(self):
+        '''The range report should have a row per employee.'''
+        from django.test.client import RequestFactory
+        from timetracker.reporting.views import balance_by_range
+        request = RequestFactory().get('/')
+        request.session = {'user_id': self.linked_manager.id}
+        response = balance_by_range(request, start="2012-01-01",
+                                    end="2012-01-31")
+        rows = response.content.decode('utf-8-sig').splitlines()
+        self.assertEquals(len(rows),
+                          self.linked_manager.get_subordinates().count() + 2)
+        # only the one user has any entries.
+        self.assertEquals(rows[-1].split(',')[2], "%.2f" % self.scanned(
+                datetime.date(2012, 1, 1), datetime.date(2012, 1, 31)))
+        self.assertRaises(Http404, balance_by_range, request,
+                          start="2012-02-01", end="2012-01-01")
+
+
+class WorkTimeTest(BaseUserTest):
+    '''Tests the working time calculated by the database.'''
+    def setUp(self):
+        super(WorkTimeTest, self).setUp()
+        Tbluser.objects.filter(id=self.linked_user.id).update(
+            shiftlength="07:30", breaklength="00:30", shift_minutes=450,
+            break_minutes=30)
+        day = datetime.date(2012, 1, 1)
+        for _ in range(60):
+            start = random.randint(6 * 60, 11 * 60)
+            end = random.randint(13 * 60, 21 * 60)
+            TrackingEntry(entry_date=day, user_id=self.linked_user.id,
+                          start_time="%02d:%02d" % divmod(start, 60),
+                          end_time="%02d:%02d" % divmod(end, 60),
+                          breaks="00:%02d" % random.randint(0, 59),
+                          daytype=random.choice(["WKDAY", "WKHOM", "ROVER",
+                                                 "HOLIS", "SATUR"])).save()
+            day += datetime.timedelta(days=1)
+        self.user = Tbluser.objects.get(id=self.linked_user.id)
+
+    def testSums(self):
+        '''The sums should be the same as the entries' own methods.'''
+        from timetracker.utils.worktime import sum_minutes
+        entries = TrackingEntry.objects.filter(user=self.user)
+        breaks, worked, total, delta, half_hours = sum_minutes(
+            entries, ['normalized_break', 'worked', 'total', 'delta',
+                      'half_hours'])
+        minutes = lambda hours: int(round(hours * 60))
+        self.assertEquals(breaks, sum(entry.normalized_break().seconds // 60
+                                      for entry in entries))
+        self.assertEquals(worked, sum(minutes(entry.total_working_time())
+                                      for entry in entries))
+        self.assertEquals(total, sum(minutes(entry.totalhours())
+                                     for entry in entries))
+        self.assertEquals(delta, sum(minutes(entry.time_difference())
+                                     for entry in entries))
+        self.assertEquals(half_hours, sum(int(entry.nearest_half() * 2)
+                                          for entry in entries))
+        self.assertEquals(sum_minutes(entries, ['total'], by_user=True),
+                          {self.user.id: [total]})
+
+    def testAnnotate(self):
+        '''Each entry should be rounded as nearest_half rounds it.'''
+        from timetracker.utils.worktime import annotate
+        for entry in annotate(TrackingEntry.objects.filter(user=self.user),
+                              'total', 'half_hours'):
+            self.assertEquals(entry.total, int(round(entry.totalhours() * 60)))
+            self.assertEquals(entry.half_hours / 2.0, entry.nearest_half())
+
+    def testMinutes(self):
+        '''The minutes should follow the times, saved or not.'''
+        entry = TrackingEntry(entry_date="2013-01-02", user=self.user,
+                              start_time="09:00", end_time="17:30",
+                              breaks="00:15", daytype="WKDAY")
+        self.assertEquals((entry.start_minutes, entry.end_minutes,
+                           entry.break_minutes), (540, 1050, 15))
+        entry.end_time = datetime.time(18, 0)
+        self.assertEquals(entry.end_minutes, 1080)
+        self.assertEquals(entry.totalhours(), 9.25)
+        self.assertEquals(self.user.get_shiftlength_list(),
+                          ["09:00:00", "16:30:00", "00:30:00"])
+
+    def testMigrate(self):
+        '''The migration should fill in minutes which are missing.'''
+        # adding the columns is left out, sqlite commits the test's
+        # transaction when the table is described.
+        from timetracker.tracker.management.commands import migrate_minutes
+        TrackingEntry.objects.filter(user=self.user).update(start_minutes=0)
+        self.assertEquals(migrate_minutes.mismatches(TrackingEntry), 60)
+        self.assertEquals(migrate_minutes.backfill(TrackingEntry, batch=7),
+                          TrackingEntry.objects.count())
+        self.assertEquals(migrate_minutes.mismatches(TrackingEntry), 0)
+        for entry in TrackingEntry.objects.filter(user=self.user):
+            self.assertEquals(entry.start_minutes,
+                              entry.start_time.hour * 60
+                              + entry.start_time.minute)
+
+        # databases which can't work the minutes out in SQL read the rows.
+        from django.db import connection
+        TrackingEntry.objects.filter(user=self.user).update(start_minutes=0)
+        vendor = connection.vendor
+        connection.vendor = 'unknown'
+        try:
+            self.assertEquals(migrate_minutes.mismatches(TrackingEntry), 60)
+            self.assertEquals(migrate_minutes.backfill(TrackingEntry,
+                                                       batch=7), 60)
+            self.assertEquals(migrate_minutes.mismatches(TrackingEntry), 0)
+        finally:
+            connection.vendor = vendor
+
+    def testBalance(self):
+        '''The balance summed by the database should be the one
+        _regular_calculation gives.'''
+        entries = TrackingEntry.objects.filter(user=self.user)
+        scanned = self.user._regular_calculation(
+            entries.filter(daytype__in=["WKDAY", "WKHOM"]),
+            entries.filter(daytype="ROVER"))
+        self.assertAlmostEquals(self.user.get_total_balance(ret='flo'),
+                                scanned)
+        self.assertAlmostEquals(
+            Tbluser.regular_balances(entries, [self.user.id])[self.user.id],
+            scanned)
+
+    def testTotalBalances(self):
+        '''The balances calculated together should be those of each user,
+        with or without an OVERRIDE_CALCULATION, which is given the same
+        arguments as it is for a single user.'''
+        from django.db.models.query import QuerySet
+        from django.test.utils import override_settings
+        from timetracker.utils.datemaps import hr_calculation
+        given = []
+
+        def calculation(user, tracking_days, return_days):
+            '''Records what it's given.'''
+            given.append((user, tracking_days, return_days))
+            return hr_calculation(user, tracking_days, return_days)
+        users = list(Tbluser.objects.all())
+        with self.assertNumQueries(2):
+            Tbluser.total_balances(users)
+        for overrides in ({}, {"BG": calculation}):
+            with override_settings(OVERRIDE_CALCULATION=overrides):
+                balances = Tbluser.total_balances(users)
+                for user in users:
+                    self.assertAlmostEquals(balances[user.id],
+                                            user.get_total_balance(ret='flo'))
+        self.assertTrue(given)
+        for user, tracking_days, return_days in given:
+            self.assertTrue(isinstance(user, Tbluser))
+            self.assertTrue(isinstance(tracking_days, QuerySet))
+            self.assertTrue(isinstance(return_days, QuerySet))
+
+    def testWeeklyReminders(self):
+        '''The balances of the reminders should be those each user's
+        entries give, including over the new year.'''
+        from django.core import mail
+        from timetracker.tracker.management.commands.send_weekly_reminders \
+            import Command
+        for today in (datetime.date(2012, 1, 3), datetime.date(2012, 2, 10)):
+            worked, weekdays, saturdays = self.user.range_totals(
+                today - datetime.timedelta(days=7), today,
+                "worked", "WKDAY", "SATUR")
+            self.assertAlmostEquals(
+                Tbluser.previous_week_balances([self.user],
+                                               today)[self.user.id],
+                self.user.shiftlength_as_float() * (5 - weekdays - saturdays)
+                + worked / 60.0)
+        users = Tbluser.objects.filter(market="BG")
+        Command().execute("BG", batch=2, workers=2, dry_run=None,
+                          stdout=StringIO())
+        self.assertEquals(len(mail.outbox), users.count())
+        self.assertEquals(mail.outbox[0].body,
+                          users[0].weekly_reminder().body)
+
+
+class EntryRecordTest(BaseUserTest):
+    '''Tests the read-only records of the entries.'''
+    def testSameAsEntries(self):
+        '''Records should calculate and display as the entries do.'''
+        from timetracker.utils.records import EntryPolicy, entry_records
+        for date, end, daytype in [
+            ("2012-01-02", "18:30", "WKDAY"),
+            ("2012-01-03", "14:00", "WKDAY"),
+            ("2012-01-04", "17:00", "HOLIS"),
+            ("2012-01-05", "17:00", "ROVER"),
+            ]:
+            TrackingEntry(entry_date=date, user_id=self.linked_user.id,
+                          start_time="09:00", end_time=end,
+                          breaks="00:45", daytype=daytype).save()
+        entries = TrackingEntry.objects.order_by('entry_date')
+        policies = {}
+        # the user is loaded once for all of their records.
+        with self.assertNumQueries(2):
+            records = list(entry_records(entries, policies))
+        self.assertEquals(policies.keys(), [self.linked_user.id])
+        for entry, record in zip(entries, records):
+            for method in ('display_as_csv', 'totalhours', 'nearest_half',
+                           'time_difference', 'overtime_class'):
+                self.assertEquals(getattr(record, method)(),
+                                  getattr(entry, method)())
+        self.assertRaises(AttributeError, setattr, records[0], 'extra', 1)
+        self.assertEquals(len(list(entry_records(
+                        entries, EntryPolicy.for_users([self.linked_user])))),
+                          4)
+
+
+class GenerateDatasetTest(TestCase):
+    '''Tests the generation of the load testing dataset.'''
+
+    def generate(self, seed):
+        '''Generates a small dataset and returns a summary of it.'''
+        from timetracker.tracker.management.commands.generate_dataset import (
+            Command)
+        Command().execute(seed=seed, agents=10, team_size=4, years=1,
+                          end_year=2012, markets='BG,CZ', batch_size=50,
+                          prefix='gen', password='password', stdout=StringIO())
+        return list(TrackingEntry.objects.order_by('user__user_id', 'entry_date')
+                    .values_list('user__user_id', 'entry_date', 'daytype',
+                                 'start_time', 'end_time', 'breaks'))
+
+    def testGenerate(self):
+        '''The same seed should generate the same dataset with every
+        agent in a team.'''
+        entries = self.generate(1)
+        self.assertEquals(Tbluser.objects.filter(user_type='RUSER').count(), 10)
+        self.assertEquals(Tbluser.objects.filter(user_type='ADMIN').count(), 3)
+        self.assertEquals(Tbluser.objects.filter(user_type='SUPER').count(), 2)
+        for agent in Tbluser.objects.filter(user_type='RUSER'):
+            self.assertEquals(agent.subordinates.count(), 1)
+        self.assertTrue(len(entries) > 10 * 200)
+        self.assertTrue(DataVersion.objects.filter(year=2012).exists())
+
+        Tbluser.objects.all().delete()
+        self.assertEquals(self.generate(1), entries)
+        Tbluser.objects.all().delete()
+        self.assertNotEquals(self.generate(2), entries)
+
+
+class LoadTestTest(TestCase):
+    '''Tests the flows replayed by the load test.'''
+
+    def setUp(self):
+        '''Generates a small dataset to run against.'''
+        from timetracker.tracker.management.commands.generate_dataset import (
+            Command)
+        Command().execute(seed=0, agents=4, team_size=4, years=1,
+                          end_year=2012, markets='BG', batch_size=500,
+                          prefix='gen', password='password', stdout=StringIO())
+        self.options = {
+            'password': 'password',
+            'iterations': 2,
+            'duration': 0,
+            'manager_year': 2012,
+            'agent_year': 2013,
+            }
+
+    def testFlows(self):
+        '''The agent and manager flows should run without errors and leave
+        the data as it was.'''
+        from timetracker.tracker.management.commands.loadtest import (
+            run_threads, summarize)
+        entries = TrackingEntry.objects.count()
+        for user_type in ['RUSER', 'ADMIN']:
+            user = Tbluser.objects.filter(user_type=user_type)[0]
+            results = run_threads([user], self.options, 0)
+            self.assertEquals([r for r in results if r[2]], [])
+            self.assertEquals(results[0][0], 'login')
+            summary = summarize(results, 1.0)
+            self.assertEquals(summary[-1]['flow'], 'total')
+            self.assertEquals(summary[-1]['requests'], len(results))
+            self.assertTrue(summary[-1]['queries'] > 0)
+        self.assertEquals(TrackingEntry.objects.count(), entries)
+
+    def testPercentile(self):
+        '''Percentiles are taken by the nearest rank.'''
+        from timetracker.tracker.management.commands.loadtest import (
+            percentile)
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 95), 95)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile([3], 99), 3)
+        self.assertEquals(percentile([], 50), 0.0)
+
+
+class DataVersionTestCase(BaseUserTest):
+    '''Tests the stamps used for conditional requests.'''
+
+    def stamp(self, user, year, month):
+        '''Returns the version of a single stamp.'''
+        return DataVersion.stamp(
+            DataVersion.of_user(user.id) & Q(year=year, month=month)
+            )[1]
+
+    def testEntryWritesBumpPeriods(self):
+        '''Saving, moving and deleting entries bump the periods they
+        were in.'''
+        entry = TrackingEntry(entry_date="2012-01-02",
+                              user_id=self.linked_user.id,
+                              start_time="09:00", end_time="17:00",
+                              breaks="00:15", daytype="WKDAY")
+        entry.save()
+        january = self.stamp(self.linked_user, 2012, 1)
+        self.assertTrue(january > 0)
+
+        changed = TrackingEntry(id=entry.id, user=self.linked_user,
+                                entry_date="2012-02-01",
+                                start_time="09:00", end_time="17:00",
+                                breaks="00:15", daytype="WKDAY")
+        changed.save()
+        self.assertTrue(self.stamp(self.linked_user, 2012, 1) > january)
+        february = self.stamp(self.linked_user, 2012, 2)
+        self.assertTrue(february > 0)
+
+        TrackingEntry(id=entry.id, user=self.linked_user).delete()
+        self.assertTrue(self.stamp(self.linked_user, 2012, 2) > february)
+
+    def testEntryWriteQueries(self):
+        '''Saving a loaded entry shouldn't read it again, nor whether its
+        period can be written.'''
+        TrackingEntry(entry_date="2012-01-02", user_id=self.linked_user.id,
+                      start_time="09:00", end_time="17:00",
+                      breaks="00:15", daytype="WKDAY").save()
+        entry = TrackingEntry.objects.get(user=self.linked_user,
+                                          entry_date="2012-01-02")
+        forget_periods()
+        locked_periods()
+        # whether it exists, its update, the stamp of its month, the
+        # validation of its user and uniqueness and its change.
+        with self.assertNumQueries(6):
+            entry.end_time = "18:00"
+            entry.save()
+
+    def testTeamChangesBumpManager(self):
+        '''Adding a user to a team bumps the manager's details.'''
+        before = self.stamp(self.linked_manager, 0, 0)
+        self.authorization.users.add(self.unlinked_user)
+        self.assertTrue(self.stamp(self.linked_manager, 0, 0) > before)
+
+    def testConditionalYearview(self):
+        '''The yearview answers with a 304 until the data changes.'''
+        from django.test.client import RequestFactory
+        from timetracker.views import yearview
+        factory = RequestFactory()
+        def get(etag=None):
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            request = factory.get('/yearview/%s/2012/' % self.linked_user.id,
+                                  **headers)
+            request.session = {'user_id': self.linked_manager.id}
+            return yearview(request, who=str(self.linked_user.id),
+                            year='2012')
+        response = get()
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEquals(get(etag).status_code, 304)
+        TrackingEntry(entry_date="2012-03-01", user_id=self.linked_user.id,
+                      start_time="09:00", end_time="17:00",
+                      breaks="00:15", daytype="HOLIS").save()
+        self.assertEquals(get(etag).status_code, 200)
+
+    def testConditionalCalendarNextDay(self):
+        '''The calendar shows today, so it's rendered again the next day
+        even though the data hasn't changed.'''
+        from django.test.client import RequestFactory
+        from timetracker.utils import decorators
+        from timetracker.views import user_view
+        factory = RequestFactory()
+        def get(etag=None):
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            request = factory.get('/calendar/', **headers)
+            request.session = {'user_id': self.linked_user.id}
+            return user_view(request)
+        response = get()
+        etag = response['ETag']
+        self.assertEquals(get(etag).status_code, 304)
+
+        class Tomorrow(datetime.date):
+            '''The date a day later.'''
+            @classmethod
+            def today(cls):
+                return datetime.date.today() + datetime.timedelta(days=1)
+        clock = type('clock', (object,), {'date': Tomorrow,
+                                          'datetime': datetime.datetime,
+                                          'time': datetime.time})
+        decorators.datetime = clock
+        try:
+            response = get(etag)
+        finally:
+            decorators.datetime = datetime
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response['Last-Modified'])
+
+
 class DatabaseTestCase(BaseUserTest):
     '''
     Class which tests the database for improper settings
@@ -681,6 +1411,177 @@ class AjaxTestCase(BaseUserTest):
         json = simplejson.dumps({'success': True, 'error': ''})
         self.assertEquals(valid.content, json)
 
+    def testMassHolidaysFailing(self):
+        '''No notifications should be sent for the entries of a mass
+        holiday booking which failed part of the way through.'''
+        sent = []
+        calls = []
+        shiftlength = Tbluser.get_shiftlength_list
+        notify = TrackingEntry.send_notifications
+
+        def failing(user):
+            '''Closes the month after the first entry.'''
+            calls.append(user)
+            if len(calls) > 1:
+                raise ValidationError("Entries can't be changed in a month "
+                                      "which has been closed.")
+            return shiftlength(user)
+        Tbluser.get_shiftlength_list = failing
+        TrackingEntry.send_notifications = lambda entry: sent.append(entry)
+        try:
+            self.linked_manager_request.POST = {
+                'year': '2012', 'month': '3',
+                'mass_data': simplejson.dumps(
+                    {self.linked_user.id: ['empty', 'HOLIS', 'HOLIS']})}
+            self.assertEquals(
+                simplejson.loads(
+                    mass_holidays(self.linked_manager_request).content),
+                {'success': False,
+                 'error': "Entries can't be changed in a month which has "
+                          "been closed."})
+        finally:
+            Tbluser.get_shiftlength_list = shiftlength
+            TrackingEntry.send_notifications = notify
+        self.assertEquals(sent, [])
+
+    def testHolidayRows(self):
+        '''The holiday planner should be fetched a page of filtered rows
+        at a time.'''
+        for date, daytype, comment in [("2012-01-02", "HOLIS", "Away"),
+                                       ("2012-01-03", "DAYOD", ""),
+                                       ("2012-02-01", "HOLIS", "")]:
+            TrackingEntry(entry_date=date, user_id=self.linked_user.id,
+                          start_time="09:00", end_time="17:00",
+                          breaks="00:15", daytype=daytype,
+                          comments=comment).save()
+
+        def rows(**kwargs):
+            self.linked_manager_request.GET = dict(year='2012', month='1',
+                                                   **kwargs)
+            return simplejson.loads(
+                get_holiday_rows(self.linked_manager_request).content)
+
+        total = self.linked_manager.get_subordinates().count()
+        page = rows(offset='0', limit='3')
+        self.assertEquals((page['total'], len(page['rows'])), (total, 3))
+        rest = rows(offset='3', limit='100')
+        self.assertEquals(len(rest['rows']), total - 3)
+        self.assertEquals(
+            len(set(row['id'] for row in page['rows'] + rest['rows'])), total)
+
+        self.assertEquals(rows(process='AO')['total'], 1)
+        self.assertEquals(rows(name='CAS')['total'], total)
+        self.assertEquals(rows(name='nobody')['total'], 0)
+        self.assertEquals(rows(job_code='00F')['total'], total)
+        self.assertEquals(rows(job_code='X')['total'], 0)
+
+        row = [row for row in rows(process='AP')['rows']
+               if row['id'] == self.linked_user.id][0]
+        user = Tbluser.objects.get(id=self.linked_user.id)
+        self.assertEquals(row['balance'], user.get_holiday_balance(2012))
+        self.assertEquals(row['dod'], 1)
+        self.assertEquals(row['days'][:3], ["WKEND", "HOLIS", "DAYOD"])
+        self.assertEquals(len(row['days']), 31)
+        self.assertEquals(len(row['comments']), 1)
+
+        # the work done doesn't depend on the size of the page.
+        forget_periods()
+        locked_periods()
+        with self.assertNumQueries(9):
+            rows(offset='0', limit='1')
+        with self.assertNumQueries(9):
+            rows(offset='0', limit='100')
+
+    def testHolidayChanges(self):
+        '''The holiday planner should be given the last change to each of
+        its cells since its version, and wait when there aren't any new
+        ones. Its version should stay behind the changes which may not have
+        been committed yet.'''
+        from django.test.utils import override_settings
+        from timetracker.utils.changefeed import latest_version
+
+        def changes(version, **kwargs):
+            self.linked_manager_request.GET = dict(
+                year='2012', month='1', version=str(version), **kwargs)
+            return simplejson.loads(
+                get_holiday_changes(self.linked_manager_request).content)
+
+        version = latest_version()
+        entry = TrackingEntry(entry_date="2012-01-02",
+                              user_id=self.linked_user.id,
+                              start_time="09:00", end_time="17:00",
+                              breaks="00:15", daytype="HOLIS")
+        entry.save()
+        TrackingEntry(entry_date="2012-01-03", user_id=self.linked_user.id,
+                      start_time="09:00", end_time="17:00", breaks="00:15",
+                      daytype="DAYOD").save()
+        TrackingEntry(entry_date="2012-02-01", user_id=self.linked_user.id,
+                      start_time="09:00", end_time="17:00", breaks="00:15",
+                      daytype="HOLIS").save()
+        TrackingEntry(id=entry.id).delete()
+        cells = [
+            {'user': self.linked_user.id, 'day': 2, 'daytype': 'empty'},
+            {'user': self.linked_user.id, 'day': 3, 'daytype': 'DAYOD'}]
+
+        feed = changes(version)
+        self.assertEquals(feed['version'], version)
+        self.assertEquals(feed['seen'], latest_version())
+        self.assertEquals(feed['cells'], cells)
+
+        with override_settings(HOLIDAY_FEED_TIMEOUT=0.2,
+                               HOLIDAY_FEED_INTERVAL=0.1):
+            # the changes which may not be committed are given again once
+            # the wait is over.
+            started = time.time()
+            self.assertEquals(
+                changes(feed['version'], seen=str(feed['seen']))['cells'],
+                cells)
+            self.assertTrue(time.time() - started >= 0.2)
+            self.assertEquals(changes(version, process='AO',
+                                      seen=str(feed['seen']))['cells'], [])
+
+            with override_settings(HOLIDAY_FEED_SETTLE=0):
+                feed = changes(version)
+                self.assertEquals(feed['version'], latest_version())
+                self.assertEquals(feed['cells'], cells)
+                started = time.time()
+                self.assertEquals(changes(feed['version'])['cells'], [])
+                self.assertTrue(time.time() - started >= 0.2)
+
+    def testEmployeeSearch(self):
+        '''The employee boxes should search the span of control of the
+        logged in user by the start of any word.'''
+        employee_search_index.clear()
+
+        def search(query, **kwargs):
+            self.linked_manager_request.GET = dict(q=query, **kwargs)
+            return simplejson.loads(
+                employee_search(self.linked_manager_request).content)
+
+        total = self.linked_manager.get_subordinates().count()
+        self.assertEquals(len(search('')['results']), total)
+        self.assertEquals(len(search('', limit='2')['results']), 2)
+        self.assertEquals(len(search('te CA')['results']), total)
+        self.assertEquals(search('ase')['results'], [])
+        self.assertEquals(search('', limit='x')['success'], False)
+
+        results = search(self.linked_user.user_id)['results']
+        self.assertIn(self.linked_user.id,
+                      [result['id'] for result in results])
+
+        # the index is only built once, until the details of a user change.
+        with self.assertNumQueries(3):
+            search('test')
+        # the team leaders under the manager share the manager's index.
+        self.assertTrue(
+            employee_search_index.employee_index(self.linked_teamlead) is
+            employee_search_index.employee_index(self.linked_manager))
+        self.linked_user.firstname = 'Renamed'
+        self.linked_user.save()
+        self.assertEquals(
+            [result['id'] for result in search('renam')['results']],
+            [self.linked_user.id])
+
     def testValidAjaxDeleteHolidayEntry(self):
         '''Tests to see if the ajax endpoint for deleting a holiday
         entry is working correctly.'''
@@ -739,6 +1640,186 @@ class AjaxTestCase(BaseUserTest):
                     })
                           )
 
+class PolicyTest(BaseUserTest):
+    '''Tests the compiled policies of the markets.'''
+    def testSettings(self):
+        '''Policies should follow the settings and not be changed.'''
+        from timetracker.utils import policies
+        user = Tbluser.objects.get(id=self.linked_user.id)
+        with self.settings(OT_THRESHOLDS={user.market: 0.5},
+                           UNDER_TIME_ENABLED={user.market: True},
+                           MANAGER_EMAILS_OVERRIDE={user.market: ["a@b.c"]}):
+            self.assertEquals(user.policy.threshold, 0.5)
+            self.assertTrue(user.policy.undertime)
+            self.assertEquals(user.get_manager_email(), ["a@b.c"])
+            self.assertTrue(policies.for_market(user.market) is user.policy)
+            self.assertRaises(AttributeError, setattr, user.policy,
+                              "threshold", 1)
+        self.assertFalse(user.policy.undertime)
+        self.assertEquals(user.policy.threshold,
+                          settings.DEFAULT_OT_THRESHOLD)
+
+    def testReload(self):
+        '''Policies should be read from the policy file and compiled again
+        once it changes.'''
+        import os
+        import tempfile
+        from timetracker.utils import policies
+        handle, path = tempfile.mkstemp(suffix='.py')
+        os.close(handle)
+
+        def write(threshold, mtime):
+            with open(path, 'w') as policy_file:
+                policy_file.write('OT_THRESHOLDS = {"BG": %s}\n' % threshold)
+            os.utime(path, (mtime, mtime))
+        write(2, 1000)
+        policies._state.update(checked=0)
+        try:
+            with self.settings(POLICY_FILE=path, POLICY_RELOAD_INTERVAL=60):
+                policy = policies.for_market("BG")
+                self.assertEquals(policy.threshold, 2)
+                self.assertEquals(policies.version(), 1000)
+                self.assertEquals(policies.for_market("CZ").threshold,
+                                  settings.DEFAULT_OT_THRESHOLD)
+                self.assertFalse(policies.check(now=100))
+                write(3, 2000)
+                self.assertFalse(policies.check(now=120))
+                self.assertTrue(policies.check(now=200))
+                self.assertEquals(policies.for_market("BG").threshold, 3)
+                # the pages and reports calculated with them change too.
+                self.assertEquals(policies.version(), 2000)
+                # a broken file keeps the policies which work.
+                with open(path, 'w') as policy_file:
+                    policy_file.write('OT_THRESHOLDS = {')
+                os.utime(path, (3000, 3000))
+                self.assertFalse(policies.check(now=300))
+                self.assertEquals(policies.for_market("BG").threshold, 3)
+        finally:
+            os.remove(path)
+        self.assertEquals(policies.for_market("BG").threshold,
+                          settings.DEFAULT_OT_THRESHOLD)
+        self.assertFalse(policies.for_market("BG") is policy)
+        self.assertEquals(policies.version(), None)
+
+
+class ChangeJournalTest(BaseUserTest):
+    '''Tests the journal of changes.'''
+    def testEntries(self):
+        '''Saving and deleting entries should journal their old and new
+        values, which a cursor reads once.'''
+        from timetracker.tracker.models import Change, ChangeCursor
+        ChangeCursor.advance("test", Change.objects.latest('id').id)
+        entry = TrackingEntry(entry_date="2012-01-02",
+                              user_id=self.linked_user.id,
+                              start_time="09:00", end_time="17:00",
+                              breaks="00:15", daytype="WKDAY")
+        entry.save()
+        entry.end_time = "18:30"
+        entry.daytype = "WKHOM"
+        entry.save()
+        TrackingEntry(id=entry.id).delete()
+        # the changes which may not all be committed aren't read yet.
+        self.assertEquals(ChangeCursor.read("test"), [])
+        changes = ChangeCursor.read("test", settle=0)
+        self.assertEquals(
+            [(change.operation, change.object_id, change.user_id,
+              change.entry_date, change.old_daytype, change.old_end,
+              change.new_daytype, change.new_end) for change in changes],
+            [("create", entry.id, self.linked_user.id,
+              datetime.date(2012, 1, 2), "", None, "WKDAY", 1020),
+             ("update", entry.id, self.linked_user.id,
+              datetime.date(2012, 1, 2), "WKDAY", 1020, "WKHOM", 1110),
+             ("delete", entry.id, self.linked_user.id,
+              datetime.date(2012, 1, 2), "WKHOM", 1110, "", None)])
+        ChangeCursor.advance("test", changes[-1].id)
+        self.assertEquals(ChangeCursor.read("test", settle=0), [])
+        self.assertEquals(Change.since(changes[0].id, limit=1, settle=0),
+                          [changes[1]])
+
+        # moving an entry empties the day it was on.
+        entry = TrackingEntry(entry_date="2012-01-03",
+                              user_id=self.linked_user.id,
+                              start_time="09:00", end_time="17:00",
+                              breaks="00:15", daytype="HOLIS")
+        entry.save()
+        position = Change.objects.latest('id').id
+        entry.entry_date = "2012-01-04"
+        entry.save()
+        self.assertEquals(
+            [(change.operation, change.entry_date, change.old_daytype,
+              change.new_daytype)
+             for change in Change.since(position, settle=0)],
+            [("delete", datetime.date(2012, 1, 3), "HOLIS", ""),
+             ("create", datetime.date(2012, 1, 4), "", "HOLIS")])
+
+    def testTeams(self):
+        '''Users joining and leaving a team should be journalled against
+        the team.'''
+        from timetracker.tracker.models import Change
+        position = Change.objects.latest('id').id
+        self.authorization.users.remove(self.linked_user)
+        self.linked_user.subordinates.add(self.authorization)
+        self.assertEquals(
+            [(change.model, change.object_id, change.operation,
+              change.user_id)
+             for change in Change.since(position, settle=0)],
+            [("tblauthorization", self.authorization.id, "remove",
+              self.linked_user.id),
+             ("tblauthorization", self.authorization.id, "add",
+              self.linked_user.id)])
+
+
+class AdminTest(BaseUserTest):
+    '''Tests the changelists of the admin.'''
+    def testTeams(self):
+        '''The teams of a page should be loaded together.'''
+        from django.contrib import admin
+        model_admin = admin.site._registry[Tblauthorization]
+        links = model_admin.queryset(None)
+        with self.assertNumQueries(2):
+            tables = [link.display_users() for link in links]
+        self.assertEquals(tables, [link.display_users() for link in
+                                   Tblauthorization.objects.all()])
+
+    def testEstimatedCount(self):
+        '''Only the whole of a large table should be estimated.'''
+        from timetracker.tracker import admin
+        TrackingEntry(entry_date="2012-01-02", user=self.linked_user,
+                      start_time="09:00", end_time="17:00", breaks="00:15",
+                      daytype="WKDAY").save()
+        entries = TrackingEntry.objects.all()
+        limit = admin.EXACT_COUNT_LIMIT
+        admin.EXACT_COUNT_LIMIT = 0
+        try:
+            self.assertEquals(admin.EstimatedCountPaginator(entries, 10).count,
+                              admin.estimated_count(entries))
+            self.assertEquals(admin.EstimatedCountPaginator(
+                    entries.filter(daytype="HOLIS"), 10).count, 0)
+            # the largest id overstates the rows once some are deleted.
+            for day in (3, 4):
+                TrackingEntry(entry_date="2012-01-%02d" % day,
+                              user=self.linked_user, start_time="09:00",
+                              end_time="17:00", breaks="00:15",
+                              daytype="WKDAY").save()
+            entries.order_by('id')[0].delete()
+            paginator = admin.EstimatedCountPaginator(
+                entries.order_by('id'), 1)
+            estimate = paginator.count
+            self.assertTrue(estimate > entries.count())
+            page = paginator.page(estimate)
+            self.assertEquals(page.number, paginator.num_pages)
+            self.assertEquals(paginator.count, entries.count())
+            self.assertEquals(len(page.object_list), 1)
+            paginator = admin.EstimatedCountPaginator(entries, 10)
+            self.assertEquals(len(paginator.page(1).object_list),
+                              entries.count())
+            self.assertEquals(paginator.count, entries.count())
+        finally:
+            admin.EXACT_COUNT_LIMIT = limit
+        self.assertEquals(admin.EstimatedCountPaginator(entries, 10).count,
+                          entries.count())
+
+
 class UtilitiesTest(TestCase):
     '''The utilties module contains several miscellanious pieces of
     functionality, we test those here.'''
@@ -797,6 +1878,47 @@ class UtilitiesTest(TestCase):
 </select>'''
         self.assertEquals(output, string)
 
+    def testCSVWriter(self):
+        '''The chunked CSV writer should write the same documents as the
+        UnicodeWriter, however the rows are given to it.'''
+        rows = [[u'Jan Nov\xe1k', datetime.date(2012, 1, 2),
+                 datetime.time(9, 0), 'plain', 7, 0.1 + 0.2, None,
+                 True, [u'1', u'2'], u'Comment, "quoted"']] * 50
+        for dialect, encoding in [("excel", "utf-8"),
+                                  ("excel-semicolon", "utf-8"),
+                                  ("excel", "utf-16")]:
+            expected = StringIO()
+            writer = UnicodeWriter(expected, dialect=dialect,
+                                   encoding=encoding)
+            writer.writerows(rows)
+
+            one_by_one = StringIO()
+            writer = CSVWriter(one_by_one, dialect=dialect,
+                               encoding=encoding, chunk_size=100)
+            for row in rows:
+                writer.writerow(row)
+            writer.flush()
+            together = StringIO()
+            writer = CSVWriter(together, dialect=dialect, encoding=encoding)
+            writer.writerows(iter(rows))
+            writer.flush()
+            streamer = CSVWriter(dialect=dialect, encoding=encoding,
+                                 chunk_size=100)
+            streamer.batch = 10
+            streamed = list(streamer.iterencode(rows))
+
+            self.assertEquals(one_by_one.getvalue(), expected.getvalue())
+            self.assertEquals(together.getvalue(), expected.getvalue())
+            self.assertTrue(len(streamed) > 1)
+            self.assertEquals(''.join(streamed), expected.getvalue())
+
+        buf = StringIO()
+        writer = CSVWriter(buf, dialect="excel-semicolon", bom=True)
+        writer.writerow([u'a', 1])
+        self.assertEquals(buf.getvalue(), '')
+        writer.flush()
+        self.assertEquals(buf.getvalue(), '\xef\xbb\xbfa;1\r\n')
+
 class FrontEndTest(LiveServerTestCase):
     '''FrontEndTest uses Selenium to navigate the front-end of the
     application to test the Javascript and the interaction between
@@ -1005,4 +2127,305 @@ class MiddlewareTest(TestCase):
             self.ehandler.process_exception, {}, UnreadablePostError()
             )
 
+class MetricsTest(TestCase):
+    '''Tests the request metrics.'''
+    def testRegistryMergesThreads(self):
+        '''Values recorded on different threads should be merged when
+        the registry is collected.'''
+        import threading
+        registry = MetricsRegistry()
+        registry.observe("view", 0.02, 3, 0.01)
+        thread = threading.Thread(
+            target=registry.observe, args=("view", 2.0, 1, 0.5)
+            )
+        thread.start()
+        thread.join()
+        series = registry.collect()["view"]
+        self.assertEquals(series.count, 2)
+        self.assertEquals(series.queries, 4)
+        # the ended thread's counters are kept in the base.
+        self.assertEquals(len(registry._shards), 1)
+        self.assertEquals(registry.collect()["view"].queries, 4)
+        output = render_metrics(registry)
+        self.assertTrue(
+            'timetracker_request_seconds_bucket{view="view",le="0.025"} 1'
+            in output)
+        self.assertTrue(
+            'timetracker_request_seconds_bucket{view="view",le="+Inf"} 2'
+            in output)
+        self.assertTrue('timetracker_sql_queries_total{view="view"} 4'
+                        in output)
+
+    def testQueryCounter(self):
+        '''Queries should be counted without their SQL being kept.'''
+        from django.db import connection
+        from timetracker.utils.querylog import QueryCounter
+        outer, inner = QueryCounter(), QueryCounter()
+        queries = len(connection.queries)
+        outer.start()
+        Tbluser.objects.count()
+        inner.start()
+        list(Tbluser.objects.all())
+        inner.stop()
+        outer.stop()
+        Tbluser.objects.count()
+        self.assertEquals((outer.count, inner.count), (2, 1))
+        self.assertTrue(outer.time >= inner.time)
+        self.assertEquals(len(connection.queries), queries)
+        self.assertFalse('cursor' in connection.__dict__)
+
+    def testAjaxLabel(self):
+        '''Ajax requests are recorded per form_type.'''
+        class Request(object):
+            POST = {'form_type': 'add'}
+            GET = {}
+        from timetracker import views
+        request = Request()
+        middleware = MetricsMiddleware()
+        middleware.process_view(request, views.ajax, [], {})
+        self.assertEquals(request._metrics_label,
+                          "timetracker.views.ajax:add")
+        middleware.process_response(request, HttpResponse())
+
+    def testLazyContext(self):
+        '''Context values are only calculated when a template uses them,
+        once, and the middleware records which ones were.'''
+        from django.template import Template, Context
+        from timetracker.views import user_context_manager
+        class Request(object):
+            POST = {}
+            GET = {}
+            session = {}
+        user = Tbluser.objects.create(
+            user_id="context@example.com", firstname="Context",
+            lastname="User", password="password", user_type="RUSER",
+            market="BG", process="AP", start_date=datetime.datetime.today(),
+            breaklength="00:15:00", shiftlength="07:45:00",
+            job_code="00F20G", holiday_balance=20)
+        request = Request()
+        request.session = {"user_id": user.id}
+        middleware = MetricsMiddleware()
+        middleware.process_view(request, user_context_manager, [], {})
+        context = user_context_manager(request)
+        self.assertFalse(hasattr(request, "_context_evaluated"))
+        output = Template(
+            "{{ welcome_name }}{% if is_admin %}!{% endif %}{{ welcome_name }}"
+            ).render(Context(context))
+        self.assertEquals(output, "ContextContext")
+        self.assertEquals(request._context_evaluated,
+                          ["user", "welcome_name", "is_admin"])
+        middleware.process_response(request, HttpResponse())
+        self.assertEquals(request._metrics_queries.count, 1)
+        self.assertTrue(
+            'timetracker_context_evaluations_total{view="timetracker.views.'
+            'user_context_manager",value="is_admin"} 1'
+            in render_metrics())
+        request.session = {"user_id": 0}
+        context = user_context_manager(request)
+        self.assertFalse(context["is_admin"])
+        self.assertEquals(unicode(context["balance"]), u'')
+
+class ProfilingTest(TestCase):
+    '''Tests the profiling utilities.'''
+    def testCpuProfileWritesStatsAndQueries(self):
+        '''A cpu profile writes a pstats file along with the queries which
+        were executed.'''
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(PROFILE_DIR=directory):
+                result, files = profile_call(
+                    "test", "cpu", lambda: Tbluser.objects.count()
+                    )
+            self.assertEquals(result, 0)
+            self.assertEquals(len(files), 2)
+            pstats.Stats(files[0])
+            with open(files[1]) as queries:
+                self.assertTrue(queries.readline().startswith("# 1 queries"))
+            self.assertEquals(
+                sorted(os.listdir(directory)),
+                sorted(os.path.basename(path) for path in files))
+        finally:
+            shutil.rmtree(directory)
+
+    def testMemProfileFallsBack(self):
+        '''A request for a mem profile is profiled by cpu where memory
+        profiling isn't available.'''
+        import os
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        from timetracker.middleware.profiler import ProfilerMiddleware
+        from timetracker.utils.profiling import memory_profiling
+        create_users(self)
+
+        class Request(object):
+            '''Fake Request class'''
+            GET = {'profile': 'mem'}
+            POST = {}
+            path = '/holiday_planning/'
+            session = {'user_id': self.linked_manager.id}
+
+        def view(request):
+            '''The view profiled.'''
+            return HttpResponse("profiled")
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(PROFILE_DIR=directory):
+                response = ProfilerMiddleware().process_view(
+                    Request(), view, [], {})
+            self.assertEquals(response.content, "profiled")
+            expected = ['.mem.txt'] if memory_profiling() \
+                else ['.pstats', '.sql.txt']
+            self.assertEquals(
+                sorted(name[name.rindex('-'):].lstrip('-0123456789')
+                       for name in os.listdir(directory)), expected)
+        finally:
+            shutil.rmtree(directory)
+        if not memory_profiling():
+            self.assertRaises(ValueError, profile_call, "test", "mem",
+                              lambda: None)
+
+class LoggersTest(TestCase):
+    '''Tests the shared loggers.'''
+    def testLazyLogger(self):
+        '''The log file is only opened once something is logged.'''
+        import os
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        from timetracker.loggers import LazyLogger
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(ROOT_LOG_DIR=directory):
+                logger = LazyLogger('lazytest')
+                self.assertEquals(os.listdir(directory), [])
+                logger.error("logged")
+                self.assertEquals(os.listdir(directory), ['lazytest.log'])
+                for handler in list(logger.handlers):
+                    handler.close()
+                    logger.removeHandler(handler)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ReplicaTest(TestCase):
+    '''Tests the routing of reads to a replica, using a second SQLite
+    database as the replica.'''
+
+    def setUp(self):
+        '''Creates the replica and installs the router.'''
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.db import connections, router
+        from timetracker.utils.replica import ReplicaRouter
+        self.directory = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(self.directory, 'replica.sqlite'),
+            }
+        call_command('syncdb', database='replica', interactive=False,
+                     verbosity=0)
+        self.routers = router.routers
+        router.routers = [ReplicaRouter()]
+
+    def tearDown(self):
+        '''Removes the replica and the router.'''
+        import shutil
+        from django.db import connections, router
+        router.routers = self.routers
+        connections['replica'].close()
+        delattr(connections._connections, 'replica')
+        del connections.databases['replica']
+        shutil.rmtree(self.directory)
+
+    def testRouting(self):
+        '''Reads only go to the replica when asked for and writes always
+        go to the default database.'''
+        from django.test.utils import override_settings
+        from timetracker.utils.replica import use_replica
+        Tbluser.objects.using('replica').create(
+            user_id="replica@test.com", firstname="Replica",
+            lastname="User", user_type="RUSER", market="BG", process="AR",
+            start_date="2012-01-01", breaklength="00:15:00",
+            shiftlength="07:45:00", job_code="ABCDE", holiday_balance=20)
+        with override_settings(REPLICA_DATABASE='replica'):
+            self.assertFalse(Tbluser.objects.filter(
+                    user_id="replica@test.com").exists())
+            with use_replica():
+                user = Tbluser.objects.get(user_id="replica@test.com")
+                user.save()
+            self.assertTrue(Tbluser.objects.filter(
+                    user_id="replica@test.com").exists())
+        with use_replica():
+            # without a replica configured everything is read as usual
+            self.assertEquals(Tbluser.objects.filter(
+                    user_id="replica@test.com").count(), 1)
+
+    def testBalanceIndex(self):
+        '''Balance indexes should be kept up to date from the default
+        database when a replica is in use, so that a replica which is
+        behind doesn't rebuild them on every read.'''
+        from django.test.utils import override_settings
+        from timetracker.utils.replica import use_replica
+        user = Tbluser.objects.create(
+            user_id="index@test.com", firstname="Index", lastname="User",
+            user_type="RUSER", market="BG", process="AR",
+            start_date="2012-01-01", breaklength="00:15:00",
+            shiftlength="07:45:00", job_code="ABCDE", holiday_balance=20)
+        TrackingEntry(entry_date="2012-01-02", user=user,
+                      start_time="09:00", end_time="18:00",
+                      breaks="00:15", daytype="WKDAY").save()
+        with override_settings(REPLICA_DATABASE='replica'):
+            with use_replica():
+                BalanceIndex.prefetch([user], [2012])
+                # the stamps and the index, it isn't rebuilt.
+                with self.assertNumQueries(2):
+                    BalanceIndex.prefetch([user], [2012])
+        self.assertEquals(
+            user._balance_indexes[2012].total(
+                "WKDAY", datetime.date(2012, 1, 1),
+                datetime.date(2012, 12, 31)), 1)
+        self.assertFalse(BalanceIndex.objects.using('replica').exists())
+
+    def testMiddleware(self):
+        '''Read-only pages are read from the replica until the user writes
+        something.'''
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+        from timetracker.middleware.replica import ReplicaMiddleware
+        from timetracker.reporting.views import ot_by_month
+        from timetracker.utils.replica import replica_active
+        from timetracker.views import ajax, user_view
+        middleware = ReplicaMiddleware()
+        factory = RequestFactory()
+
+        def request(method, view, session):
+            '''Runs a request through the middleware, returning whether the
+            view would have read from the replica.'''
+            req = getattr(factory, method)('/')
+            req.session = session
+            middleware.process_request(req)
+            middleware.process_view(req, view, (), {})
+            active = replica_active()
+            middleware.process_response(req, HttpResponse())
+            self.assertFalse(replica_active())
+            return active
+
+        with override_settings(REPLICA_DATABASE='replica',
+                               REPLICA_STICKY_SECONDS=60):
+            session = {'user_id': 1}
+            self.assertTrue(request('get', ot_by_month, session))
+            self.assertFalse(request('get', user_view, session))
+            self.assertFalse(request('post', ajax, session))
+            self.assertFalse(request('get', ot_by_month, session))
+            self.assertTrue(request('get', ot_by_month, {'user_id': 2}))
+        self.assertFalse(request('get', ot_by_month, {}))
+
+
 FrontEndTest = None
@@ -41,10 +41,12 @@ urlpatterns = patterns('',
 
     url(r'^holiday_planning%s$' % PROCESS,
         views.view_with_holiday_list,
-        {"template":"holidays.html", "admin_required": True}),
+        {"template":"holidays.html", "admin_required": True,
+         "paged": True}),
     url(r'^holiday_planning/%s/%s%s$' % (YEAR, MONTH, PROCESS),
         views.view_with_holiday_list,
-        {"template":"holidays.html", "admin_required": True}),
+        {"template":"holidays.html", "admin_required": True,
+         "paged": True}),
 
     url(r'^team_planning/?$', views.view_with_holiday_list,
         {"template":"team_planning.html"}),
@@ -66,6 +68,7 @@ urlpatterns = patterns('',
     url(r'^edit_profile/?$', views.edit_profile),
     url(r'^explain/?$', views.explain),
     url(r'^forgot_my_password/?$', views.forgot_pass),
+    url(r'^metrics/?$', views.metrics),
 
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
     url(r'^admin/', include(admin.site.urls)),
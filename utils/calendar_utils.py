@@ -17,7 +17,8 @@ Module Functions
 :func:`ajax_change_entry`  :func:`get_user_data`
 :func:`delete_user`        :func:`useredit`
 :func:`mass_holidays`      :func:`profile_edit`
-:func:`gen_datetime_cal`
+:func:`gen_datetime_cal`   :func:`get_holiday_rows`
+:func:`get_holiday_changes`
 =========================  ========================
 """
 
@@ -29,7 +30,9 @@ from functools import wraps
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.mail import send_mail
 from django.http import Http404, HttpResponse
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Count
 from django.forms import ValidationError
 
 try:
@@ -41,9 +44,13 @@ import simplejson
 
 from timetracker.loggers import (debug_log, database_log,
                                  error_log, suspicious_log)
-from timetracker.tracker.models import TrackingEntry, Tbluser
+from timetracker.tracker.models import (TrackingEntry, Tbluser, entry_model,
+                                        ArchivedEntry, ClosedMonth,
+                                        HOLIDAY_VALUES)
 from timetracker.tracker.models import Tblauthorization as Tblauth
 from timetracker.utils.error_codes import DUPLICATE_ENTRY
+from timetracker.utils.changefeed import (latest_version, settled_version,
+                                          wait_for_cells)
 from timetracker.utils.datemaps import (MONTH_MAP, WEEK_MAP_SHORT,
                                         generate_select, generate_year_box,
                                         pad, round_down)
@@ -157,7 +164,8 @@ def calendar_wrapper(function):
     return inner
 
 
-def gen_holiday_list(admin_user, year=None, month=None, process=None):
+def gen_holiday_list(admin_user, year=None, month=None, process=None,
+                     paged=False):
     """
     Outputs a holiday calendar for that month.
 
@@ -170,11 +178,19 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
     daytypes. We do this to minimize interactions with the DOM when querying
     which cells have which daytype.
 
+    When `paged` is True only the frame of the table is output, the rows are
+    fetched a page at a time by holiday_page.js through
+    :func:`get_holiday_rows` and only those in view are drawn. This keeps
+    the holiday planner fast however large the team is. The table then
+    carries the version of the data, from which the changes made since are
+    fetched through :func:`get_holiday_changes`.
+
     :param admin_user: :class:`timetracker.tracker.models.Tbluser` instance.
     :param year: :class:`int` of the year required to be output, defaults to
                  the current year.
     :param month: :class:`int` of the month required to be output, defaults to
                  the current month.
+    :param paged: :class:`bool` whether the rows are fetched by the client.
     :returns: A partially pretty printed html string.
     :returns: A list of comment strings
     :rtype: :class:`str` & :class:`List`
@@ -191,8 +207,12 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
 
     str_output = []
     to_out = str_output.append
-    to_out('<table year=%s month=%s process=%s id="holiday-table">' % (
-            year, month, process)
+    if paged:
+        latest = latest_version()
+        paging = 'page_size=%d version=%d seen=%d ' % (
+            holiday_page_size(), settled_version(latest=latest), latest)
+    to_out('<table year=%s month=%s process=%s %sid="holiday-table">' % (
+            year, month, process, paging if paged else "")
            )
     to_out("""<tr>
                  <th align="centre" colspan="100">{0}</th>
@@ -201,9 +221,6 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
     # generate the calendar,
     datetime_cal = gen_datetime_cal(year, month)
 
-    # get just the days for the td text
-    calendar_array = [day.day for day in datetime_cal]
-
     # generate the top row, with day names
     day_names = [WEEK_MAP_SHORT[day.weekday()] for day in datetime_cal]
     to_out(
@@ -216,41 +233,25 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
     [to_out("<td>%s</td>\n" % day) for day in day_names]
     to_out("</tr>")
 
-    user_list = admin_user.get_subordinates().filter(process=process) \
-        if process else admin_user.get_subordinates()
-
-    def isweekend(num):
-        '''Returns the CSS class for a given date whether it's on the weekend
-        or not.'''
-        return {
-            1: 'empty',
-            2: 'empty',
-            3: 'empty',
-            4: 'empty',
-            5: 'empty',
-            6: 'WKEND',
-            7: 'WKEND',
-            }[datetime.date(year=year,month=month,day=num).isoweekday()]
-
     comments_list = []
     js_calendar = ["{\n"]
     to_js = js_calendar.append
-    for idx, user in enumerate(user_list):
-        day_classes = dict( [
-            (num, isweekend(num)) for num in calendar_array
-        ] )
-
-        # We have a dict with each day as currently
-        # empty, we iterate through the tracking
-        # entries and apply the daytype from that.
-        for entry in user.tracking_entries(year, month):
-            day_classes[entry.entry_date.day] = entry.daytype
-            if entry.comments:
-                comment_string = map(
-                    unicode,
-                    [entry.entry_date, entry.user.name(), entry.comments]
-                    )
-                comments_list.append(' '.join(comment_string))
+    if paged:
+        # the rows in view are drawn between the spacers, which stand in
+        # for the height of the rows which aren't.
+        to_out('''<tr id="holiday-top" class="holiday-spacer">
+                    <td colspan="100"></td>
+                  </tr>
+                  <tr id="holiday-bottom" class="holiday-spacer">
+                    <td colspan="100"></td>
+                  </tr>''')
+        rows = []
+    else:
+        rows = holiday_rows(admin_user, holiday_users(admin_user, process),
+                            year, month)
+
+    for idx, row in enumerate(rows):
+        comments_list.extend(row['comments'])
 
         # output the table row title, which contains:-
         # Full name, Holiday Balance and the User's
@@ -261,11 +262,11 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
                    <td>%s</td>
                    <td>%s</td>
                    <td class="job_code">%s</td>""" % (
-            user.id, user.id,
-            user.name(),
-            user.get_holiday_balance(year),
-            user.get_dod_balance(year),
-            user.get_job_code_display() if admin_user.super_or_admin() else ""
+            row['id'], row['id'],
+            row['name'],
+            row['balance'],
+            row['dod'],
+            row['job_code']
             )
         )
 
@@ -274,22 +275,21 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
         # table data and also the dayclass for styling,
         # also, the current day number so that the table
         # shows what number we're on.
-        to_js('"%s":["empty",' % user.id)
-        entries = sorted(day_classes.items())
-        for iidx, (klass, day) in enumerate(entries):
+        to_js('"%s":["empty",' % row['id'])
+        for day, daytype in enumerate(row['days'], 1):
             to_js('"%s"%s' % (
-                    day if day != "WKEND" else "empty",
-                    "," if iidx+1 != len(entries) else "]")
+                    daytype if daytype != "WKEND" else "empty",
+                    "," if day != len(row['days']) else "]")
                   )
-            to_out('<td usrid=%s class=%s>%s\n' % (user.id, day, klass))
+            to_out('<td usrid=%s class=%s>%s\n' % (row['id'], daytype, day))
         # user_id is added as attr to make mass calls
         if admin_user.user_type != "RUSER":
             to_out("""<td>
                     <input value="submit" type="button" user_id="{0}"
                            onclick="submit_holidays({0})" />
-                  </td>""".format(user.id))
+                  </td>""".format(row['id']))
             to_out('</tr>')
-        to_js(",\n" if idx+1 != len(user_list) else "")
+        to_js(",\n" if idx+1 != len(rows) else "")
     to_js("\n}")
 
     # generate the data for the month select box
@@ -305,6 +305,14 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
         % generate_select( (("ALL","All"),) + Tbluser.PROCESS_CHOICES,
                            id="process_select") \
                            if admin_user.user_type != "RUSER" else ""
+    # generate the filters of the paged rows
+    filters = '''<td>
+                   <input id="name_filter" placeholder="Name" size="10" />
+                 </td>
+                 <td>
+                   <input id="job_code_filter" placeholder="Job code"
+                    size="6" />
+                 </td>''' if paged else ""
     # generate submit all button
     submit_all = '''<td>
                       <input id="submit_all" value="Submit All" type="button"
@@ -323,16 +331,106 @@ def gen_holiday_list(admin_user, year=None, month=None, process=None):
             <td>{1}</td>
             {2}
             {3}
+            {4}
           </tr>
         </table>
       </td>
      </tr>""".format(year_select,
                      month_select,
                      process_select,
+                     filters,
                      submit_all))
     return ''.join(str_output), comments_list, ''.join(js_calendar)
 
 
+def holiday_page_size():
+    """The number of rows of the holiday planner fetched at a time."""
+    return getattr(settings, 'HOLIDAY_PAGE_SIZE', 50)
+
+
+def holiday_users(admin_user, process=None, name=None, job_code=None):
+    """
+    The users shown in the holiday planner of `admin_user`, in the order
+    they're shown in.
+
+    :param process: Only those with this process.
+    :param name: Only those whose first or last name starts with this.
+    :param job_code: Only those whose job code starts with this.
+    :rtype: :class:`QuerySet`
+    """
+    users = admin_user.get_subordinates()
+    if isinstance(users, list):
+        # the user doesn't have a team.
+        return Tbluser.objects.none()
+    if process:
+        users = users.filter(process=process)
+    if name:
+        users = users.filter(Q(firstname__istartswith=name) |
+                             Q(lastname__istartswith=name))
+    if job_code:
+        users = users.filter(job_code__istartswith=job_code)
+    # the id keeps the pages stable between users of the same name
+    return users.order_by("lastname", "id")
+
+
+def holiday_rows(admin_user, users, year, month):
+    """
+    The rows of the holiday planner for `users`.
+
+    Everyone's entries are read at once, so the number of queries doesn't
+    grow with the number of users.
+
+    :param admin_user: The :class:`Tbluser` viewing the planner.
+    :param users: The :class:`Tbluser` instances to create rows for.
+    :returns: A dict for each user with their id, name, holiday balance
+              (balance), DOD balance (dod), job code (job_code), the
+              daytype of each day of the month (days), which is WKEND on
+              the weekends without an entry, and their comment strings
+              (comments).
+    :rtype: :class:`List`
+    """
+    users = list(users)
+    ids = [user.id for user in users]
+    entries = entry_model(year).objects.filter(user__in=ids,
+                                               entry_date__year=year)
+
+    weekend = [
+        "WKEND" if day.isoweekday() in [6, 7] else "empty"
+        for day in gen_datetime_cal(year, month)
+        ]
+    days = dict((user_id, list(weekend)) for user_id in ids)
+    comments = dict((user_id, []) for user_id in ids)
+    names = dict((user.id, user.name()) for user in users)
+    for user_id, date, daytype, comment in entries.filter(
+            entry_date__month=month).order_by("entry_date").values_list(
+            "user_id", "entry_date", "daytype", "comments"):
+        days[user_id][date.day - 1] = daytype
+        if comment:
+            comments[user_id].append(
+                " ".join(map(unicode, [date, names[user_id], comment]))
+                )
+
+    counts = dict((user_id, {}) for user_id in ids)
+    for user_id, daytype, count in entries.filter(
+            daytype__in=HOLIDAY_VALUES.keys()).values_list(
+            "user_id", "daytype").annotate(count=Count("id")).order_by():
+        counts[user_id][daytype] = count
+
+    return [{
+        'id': user.id,
+        'name': user.name(),
+        'balance': user.holiday_balance + sum(
+            HOLIDAY_VALUES[daytype] * count
+            for daytype, count in counts[user.id].items()
+            ),
+        'dod': counts[user.id].get("DAYOD", 0),
+        'job_code': user.get_job_code_display()
+                    if admin_user.super_or_admin() else "",
+        'days': days[user.id],
+        'comments': comments[user.id],
+        } for user in users]
+
+
 @calendar_wrapper
 def gen_calendar(year=None, month=None, day=None, user=None):
     """
@@ -433,15 +531,17 @@ def gen_calendar(year=None, month=None, day=None, user=None):
     # so this is pretty safe
     database = Tbluser.objects.get(id__exact=user)
 
-    # pull out the entries for the given month
+    # pull out the entries for the given month, archived years are read
+    # from the archive.
+    entries = entry_model(year)
     try:
-        database = TrackingEntry.objects.filter(
+        database = entries.objects.filter(
             user=database.id,
             entry_date__year=year,
             entry_date__month=month
             )
 
-    except TrackingEntry.DoesNotExist:
+    except entries.DoesNotExist:
         # it seems Django still follows through with the assignment
         # when it raises an error, this is actually quite good because
         # we can treat the query set like normal
@@ -536,7 +636,7 @@ def gen_calendar(year=None, month=None, day=None, user=None):
                            class="day-class {7}">{8}</td>\n""".format(*vals)
                        )
 
-            except TrackingEntry.DoesNotExist:
+            except entries.DoesNotExist:
 
                 # For clicking blank days to input the day quickly into the
                 # box. An alternative to the datepicker
@@ -877,10 +977,11 @@ def get_tracking_entry_data(request):
     form.update(get_request_data(form, request))
     debug_log.debug("JSON Request Tracking Entry Data: %s/%s" %
                   (form['entry_date'], form['who']))
+    entries = entry_model((form['entry_date'] or '').split('-')[0])
     try:
-        entry = TrackingEntry.objects.get(user=form['who'],
-                                          entry_date=form['entry_date'])
-    except TrackingEntry.DoesNotExist:
+        entry = entries.objects.get(user=form['who'],
+                                    entry_date=form['entry_date'])
+    except entries.DoesNotExist:
         return {
             "success": False,
             "error": "No entry on that date."
@@ -948,6 +1049,7 @@ def get_user_data(request):
 @request_check
 @admin_check
 @json_response
+@transaction.commit_on_success
 def delete_user(request):
     """Asynchronously deletes a user.
 
@@ -1012,6 +1114,7 @@ def delete_user(request):
 @request_check
 @admin_check
 @json_response
+@transaction.commit_on_success
 def useredit(request):
 
     """
@@ -1234,6 +1337,55 @@ def useredit(request):
     return json_data
 
 
+@transaction.commit_on_success
+def _save_mass_holidays(holidays, year, month):
+    """Saves the daytypes of a month posted to :func:`mass_holidays` in
+    a single transaction.
+
+    :returns: A list of the entries which were added.
+    :raises: :class:`ValidationError` if the month can't be changed.
+    """
+    added = []
+    for entry in holidays.items():
+        for (day, daytype) in enumerate(entry[1]):
+            if day == 0:
+                continue
+            # we check if the date is valid by trying to create a dt
+            # object and catching ValueError.
+            try:
+                datetime.datetime(int(year), int(month), day)
+            except ValueError:
+                # if it's an invalid date, just ignore it.
+                continue
+            datestr = '-'.join([year, month, str(day)])
+            try:
+                current_entry = TrackingEntry.objects.get(
+                    entry_date=datestr,
+                    user_id=entry[0]
+                    )
+                if daytype == "empty":
+                    current_entry.delete()
+                else:
+                    current_entry.daytype = daytype
+                    current_entry.save()
+            except TrackingEntry.DoesNotExist:
+                if daytype == "empty":
+                    continue
+                time_str = Tbluser.objects.get(
+                    id=entry[0]
+                    ).get_shiftlength_list()
+                new_entry = TrackingEntry(
+                        entry_date=datestr,
+                        user_id=entry[0],
+                        start_time=time_str[0],
+                        end_time=time_str[1],
+                        breaks=time_str[2],
+                        daytype=daytype)
+                new_entry.save()
+                added.append(new_entry)
+    return added
+
+
 @request_check
 @admin_check
 @json_response
@@ -1304,46 +1456,30 @@ def mass_holidays(request):
         json_data['error'] = str(err)
         return json_data
 
-    for entry in holidays.items():
-        for (day, daytype) in enumerate(entry[1]):
-            if day == 0:
-                continue
-            # we check if the date is valid by trying to create a dt
-            # object and catching ValueError.
-            try:
-                datetime.datetime(
-                    int(form_data['year']), int(form_data['month']), day
-                    )
-            except ValueError:
-                # if it's an invalid date, just ignore it.
-                continue
-            datestr = '-'.join([form_data['year'],
-                                form_data['month'], str(day)])
-            try:
-                current_entry = TrackingEntry.objects.get(
-                    entry_date=datestr,
-                    user_id=entry[0]
-                    )
-                if daytype == "empty":
-                    current_entry.delete()
-                else:
-                    current_entry.daytype = daytype
-                    current_entry.save()
-            except TrackingEntry.DoesNotExist:
-                if daytype == "empty":
-                    continue
-                time_str = Tbluser.objects.get(
-                    id=entry[0]
-                    ).get_shiftlength_list()
-                new_entry = TrackingEntry(
-                        entry_date=datestr,
-                        user_id=entry[0],
-                        start_time=time_str[0],
-                        end_time=time_str[1],
-                        breaks=time_str[2],
-                        daytype=daytype)
-                new_entry.save()
-                new_entry.send_notifications()
+    try:
+        archived = entry_model(form_data['year']) is ArchivedEntry
+        closed = ClosedMonth.is_closed(form_data['year'], form_data['month'])
+    except ValueError as err:
+        json_data['error'] = 'Invalid data: %s' % str(err)
+        return json_data
+    if archived:
+        json_data['error'] = "This year has been archived."
+        return json_data
+    if closed:
+        json_data['error'] = "This month has been closed."
+        return json_data
+
+    try:
+        added = _save_mass_holidays(holidays, form_data['year'],
+                                    form_data['month'])
+    except ValidationError as error:
+        # the month was closed in the meantime.
+        error_log.error(str(error))
+        json_data['error'] = ' '.join(error.messages)
+        return json_data
+    # the e-mails only go once the entries have been committed.
+    for new_entry in added:
+        new_entry.send_notifications()
     json_data['success'] = True
     return json_data
 
@@ -1536,3 +1672,85 @@ def remove_comment(request):
     entry.save()
     json_data['success'] = True
     return json_data
+
+
+@admin_check
+@json_response
+def get_holiday_rows(request):
+    """
+    Function which gets a page of the rows of the holiday planner.
+
+    The rows can be filtered by process, by the start of the employee's
+    name and by the start of their job code. At most HOLIDAY_PAGE_SIZE rows
+    are returned at a time so the cost of a request doesn't depend on the
+    size of the team.
+    """
+
+    json_data = {
+        'success': False,
+        'error': '',
+        'total': 0,
+        'offset': 0,
+        'rows': []
+    }
+
+    admin_user = Tbluser.objects.get(id=request.session.get("user_id"))
+    try:
+        year = int(request.GET["year"])
+        month = int(request.GET["month"])
+        offset = max(int(request.GET.get("offset", 0)), 0)
+        limit = min(int(request.GET.get("limit", holiday_page_size())),
+                    holiday_page_size())
+    except (KeyError, ValueError) as error:
+        json_data['error'] = 'Invalid data: %s' % str(error)
+        return json_data
+
+    users = holiday_users(admin_user,
+                          process=request.GET.get("process"),
+                          name=request.GET.get("name", "").strip(),
+                          job_code=request.GET.get("job_code", "").strip())
+    json_data['total'] = users.count()
+    json_data['offset'] = offset
+    json_data['rows'] = holiday_rows(admin_user,
+                                     users[offset:offset + max(limit, 0)],
+                                     year, month)
+    json_data['success'] = True
+    return json_data
+
+
+@admin_check
+@json_response
+def get_holiday_changes(request):
+    """
+    Function which gets the cells of the holiday planner which changed
+    since the version the client has.
+
+    When nothing has changed yet the request waits, for at most
+    HOLIDAY_FEED_TIMEOUT seconds, until something does. The version
+    and seen returned are the ones to ask with next time, see
+    :mod:`timetracker.utils.changefeed`.
+    """
+
+    json_data = {
+        'success': False,
+        'error': '',
+        'version': 0,
+        'seen': 0,
+        'cells': []
+    }
+
+    admin_user = Tbluser.objects.get(id=request.session.get("user_id"))
+    try:
+        year = int(request.GET["year"])
+        month = int(request.GET["month"])
+        version = max(int(request.GET["version"]), 0)
+        seen = max(int(request.GET.get("seen") or version), version)
+    except (KeyError, ValueError) as error:
+        json_data['error'] = 'Invalid data: %s' % str(error)
+        return json_data
+
+    users = holiday_users(admin_user, process=request.GET.get("process"))
+    json_data['version'], json_data['seen'], json_data['cells'] = \
+        wait_for_cells(version, users, year, month, seen)
+    json_data['success'] = True
+    return json_data
@@ -0,0 +1,132 @@
+'''
+The changes to the holiday planner, waited for without polling the
+database.
+
+The holiday planner asks for the cells which changed since the version of
+the data it has with :func:`wait_for_cells`. When there aren't any new
+ones yet the request waits, for at most HOLIDAY_FEED_TIMEOUT seconds, and
+is woken as soon as this process journals a change. Changes made by other
+processes, and those which weren't committed yet when the request was
+woken, are picked up by looking again every HOLIDAY_FEED_INTERVAL seconds,
+which only reads the changes after the version.
+
+The ids of the :class:`timetracker.tracker.models.Change` rows are handed
+out when they're written but only seen once they're committed, so a change
+can appear after one with a higher id. The version given back therefore
+stays behind the changes of the last HOLIDAY_FEED_SETTLE seconds, which
+are given again the next time, and the planner also says which changes it
+has already `seen` so that it isn't answered straight away with them.
+
+Each waiting planner holds a thread of the server for the length of the
+wait, so the server needs to run enough threads for the managers who
+have the planner open.
+'''
+
+import time
+import datetime
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_save
+
+from timetracker.tracker.models import Change
+
+_condition = threading.Condition()
+_state = {'written': 0}
+
+
+def feed_timeout():
+    '''The longest a request waits for changes, in seconds.'''
+    return getattr(settings, 'HOLIDAY_FEED_TIMEOUT', 25)
+
+
+def feed_interval():
+    '''How often a waiting request looks for changes it wasn't woken for,
+    in seconds.'''
+    return getattr(settings, 'HOLIDAY_FEED_INTERVAL', 5)
+
+
+def feed_settle():
+    '''How long, in seconds, a change may take to be committed.'''
+    return getattr(settings, 'HOLIDAY_FEED_SETTLE', 60)
+
+
+def latest_version():
+    '''The id of the last change, 0 when nothing has been journalled.'''
+    return Change.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def settled_version(version=0, latest=None):
+    '''The id up to which every change has been committed, taken to be the
+    last change written more than HOLIDAY_FEED_SETTLE seconds ago.'''
+    if latest is None:
+        latest = latest_version()
+    cutoff = datetime.datetime.now() - \
+        datetime.timedelta(seconds=feed_settle())
+    settled = Change.objects.filter(
+        id__gt=version, id__lte=latest, changed__lt=cutoff).order_by(
+        '-id').values_list('id', flat=True)[:1]
+    return settled[0] if settled else version
+
+
+def changed_cells(version, users, year, month, seen=None):
+    '''The cells of the holiday planner which changed after `version`.
+
+    :param users: A queryset of the users in the planner.
+    :param seen: The id of the last change the planner has been given,
+                 `version` by default.
+    :returns: The version to ask from next, the id of the last change, the
+              list of the cells, each the user, the day of the month and
+              the daytype, which is 'empty' when the entry was deleted, and
+              whether any of them changed after `seen`.'''
+    latest = latest_version()
+    seen = version if seen is None else seen
+    cells = {}
+    fresh = False
+    for change_id, user_id, date, operation, daytype in \
+            Change.objects.filter(
+            id__gt=version, id__lte=latest, model='trackingentry',
+            user_id__in=users.order_by().values('id'), entry_date__year=year,
+            entry_date__month=month).order_by('id').values_list(
+            'id', 'user_id', 'entry_date', 'operation', 'new_daytype'):
+        # only the last change to a cell matters.
+        cells[user_id, date.day] = 'empty' if operation == 'delete' \
+            else daytype
+        fresh = fresh or change_id > seen
+    return (settled_version(version, latest), max(latest, seen), [
+        {'user': user_id, 'day': day, 'daytype': daytype}
+        for (user_id, day), daytype in sorted(cells.items())], fresh)
+
+
+def wait_for_cells(version, users, year, month, seen=None, timeout=None):
+    '''Waits until cells of the holiday planner change after `seen`, see
+    :func:`changed_cells`.
+
+    :param timeout: The longest to wait, HOLIDAY_FEED_TIMEOUT by default.
+    :returns: The version to ask from next, the id of the last change and
+              the cells which changed after `version`.'''
+    deadline = time.time() + (feed_timeout() if timeout is None
+                              else timeout)
+    while True:
+        written = _state['written']
+        next_version, latest, cells, fresh = changed_cells(
+            version, users, year, month, seen)
+        remaining = deadline - time.time()
+        if fresh or remaining <= 0:
+            return next_version, latest, cells
+        # the next look shouldn't read from the same transaction.
+        transaction.rollback_unless_managed()
+        with _condition:
+            if _state['written'] == written:
+                _condition.wait(min(feed_interval(), remaining))
+
+
+def _change_written(sender, raw=False, **kwargs):
+    '''Wakes the requests waiting for changes.'''
+    with _condition:
+        _state['written'] += 1
+        _condition.notify_all()
+
+post_save.connect(_change_written, sender=Change)
@@ -0,0 +1,64 @@
+'''
+Lazy values for the template context.
+
+Every page rendered with a RequestContext gets the values of
+:func:`timetracker.views.user_context_manager`, but few pages use all of
+them and the balance in particular is expensive. A :class:`LazyValue` is
+only calculated the first time a template uses it and then remembered
+for the rest of the render, templates call the values they're given.
+
+The names of the values which were calculated are kept on the request,
+:class:`timetracker.middleware.metrics.MetricsMiddleware` records them
+against the view so the metrics show which pages calculate which values.
+'''
+
+
+class LazyValue(object):
+    '''A context value which is calculated when it's first used.'''
+
+    def __init__(self, request, name, function):
+        '''
+        :param request: The request the page is rendered for.
+        :param name: The name of the value in the context.
+        :param function: Calculates the value, it's called at most once.
+        '''
+        self.request = request
+        self.name = name
+        self.function = function
+        self.evaluated = False
+        self.value = None
+
+    def __call__(self):
+        if not self.evaluated:
+            self.value = self.function()
+            self.evaluated = True
+            if not hasattr(self.request, '_context_evaluated'):
+                self.request._context_evaluated = []
+            self.request._context_evaluated.append(self.name)
+        return self.value
+
+    # for code which reads the context rather than a template.
+    def __nonzero__(self):
+        return bool(self())
+
+    def __unicode__(self):
+        return unicode(self())
+
+    def __str__(self):
+        return str(self())
+
+    def __repr__(self):
+        return '<LazyValue %s%s>' % (self.name,
+                                     '' if self.evaluated else ' (pending)')
+
+
+def lazy_context(request, **functions):
+    '''The context of :class:`LazyValue` objects calculated by the
+    functions given as keyword arguments.'''
+    return dict((name, LazyValue(request, name, function))
+                for name, function in functions.items())
+
+
+def evaluated(request):
+    '''The names of the values which were calculated for `request`.'''
+    return getattr(request, '_context_evaluated', [])
@@ -36,6 +36,8 @@ the only possible absent day possibilities.
 
 import datetime
 
+from django.utils.html import escape
+
 WEEK_MAP_MID = {
     0: 'Mon',
     1: 'Tue',
@@ -137,20 +139,28 @@ def generate_month_box(id=''):
     '''
     return generate_select(MONTH_MAP_SHORT, id)
 
-def generate_employee_box(admin_user, get_all=False):
-    '''Generates a select box with all subordinates for a manager.
+def generate_employee_box(get_all=False, selected=None):
+    '''Generates a search box for the subordinates of a manager.
+
+    Only the box is generated, the employees matching what is typed into
+    it are fetched with
+    :func:`timetracker.utils.employee_search.employee_search` and the id of
+    the chosen employee is put in the hidden `user_select` input.
 
-    :param admin_user: :class:`timetracker.tracker.models.Tbluser` an instance
-                       of a manager who has subordinates underneath them.
     :param get_all: :class:`bool` Used to select or ignore disabled employees.
+    :param selected: :class:`timetracker.tracker.models.Tbluser` the employee
+                     to show in the box, if any.
     '''
-    admin_user = admin_user.get_administrator()
-    ees = admin_user.get_subordinates(get_all=get_all)
-    ees_tuple = [(user.id, user.name()) for user in ees]
-    ees_tuple.append(("null", "----------"))
-    return generate_select(
-        ees_tuple,
-        id="user_select"
+    return (
+        '<span class="employee-search" all="%s">'
+        '<input type="text" class="employee-search-box" value="%s" '
+        'placeholder="Search employees" />'
+        '<input type="hidden" id="user_select" value="%s" />'
+        '</span>' % (
+            'true' if get_all else 'false',
+            escape(selected.name()) if selected else '',
+            selected.id if selected else 'null',
+            )
         )
 
 def generate_select(data, id=''):
@@ -3,11 +3,17 @@
 Module to for sharing decorators between all modules
 '''
 from functools import wraps
+import os
+import datetime
+import hashlib
 import simplejson
 
 from django.http import HttpResponse, Http404
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 
-from timetracker.tracker.models import Tbluser
+from timetracker.tracker.models import Tbluser, DataVersion
+from timetracker.utils import policies
 from timetracker.loggers import info_log, suspicious_log
 
 
@@ -129,3 +135,94 @@ def request_check(func):
             raise Http404
         return func(request)
     return inner
+
+
+_DEPLOYED = []
+
+
+def deployed():
+    """The time the code and templates which render the pages were last
+    changed, found once per process from the newest of the package's files.
+    """
+    if not _DEPLOYED:
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        newest = 0
+        for path, dirs, files in os.walk(package):
+            dirs[:] = [name for name in dirs if name not in ('static', 'docs')]
+            for name in files:
+                if name.endswith(('.py', '.html')):
+                    newest = max(newest, os.path.getmtime(
+                            os.path.join(path, name)))
+        _DEPLOYED.append(datetime.datetime.fromtimestamp(int(newest)))
+    return _DEPLOYED[0]
+
+
+def data_versioned(stamp_query):
+
+    """Decorator which makes a view answer conditional GET requests using
+    the :class:`timetracker.tracker.models.DataVersion` stamps.
+
+    The ETag and Last-Modified headers are computed from the stamps
+    selected by `stamp_query`, if the client already has the current
+    version then a 304 is returned without calling the view at all.
+
+    As pages default to, and highlight, the current date they also change
+    when the day does, and they change with the code rendering them and
+    the policies calculating them, so the ETag includes today's date, the
+    time the code was :func:`deployed` and the version of the policies,
+    and the Last-Modified time is never before the first two.
+
+    This should be applied *beneath* :func:`loggedin` or
+    :func:`admin_check` so that the access checks are made first.
+
+    :param stamp_query: A function which is called with the same arguments
+                        as the view and returns a :class:`Q` object which
+                        selects the stamps the view's output depends on. If
+                        it returns None then the request is handled as
+                        normal.
+    :returns: The decorator.
+    """
+
+    def get_stamp(request, *args, **kwargs):
+        '''Computes the stamp once per request.'''
+        if not hasattr(request, '_data_stamp'):
+            query = stamp_query(request, *args, **kwargs)
+            request._data_stamp = DataVersion.stamp(query) \
+                if query is not None else None
+        return request._data_stamp
+
+    def etag(request, *args, **kwargs):
+        '''ETag of the stamp, the viewer is included as the page may
+        differ per user.'''
+        stamp = get_stamp(request, *args, **kwargs)
+        if stamp is None:
+            return None
+        return hashlib.md5(repr(
+            (request.path, request.session.get('user_id'), stamp,
+             datetime.date.today(), deployed(), policies.version())
+            )).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        '''Last-Modified of the stamp, bounded by the start of the day and
+        the time the code was deployed.'''
+        stamp = get_stamp(request, *args, **kwargs)
+        if stamp is None:
+            return None
+        today = datetime.datetime.combine(datetime.date.today(),
+                                          datetime.time())
+        return max(stamp[2] or today, today, deployed())
+
+    def decorator(func):
+        '''Wraps the view.'''
+        conditional = condition(etag_func=etag,
+                                last_modified_func=last_modified)(func)
+
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            '''Makes sure that browsers always revalidate.'''
+            response = conditional(request, *args, **kwargs)
+            patch_cache_control(response, private=True, max_age=0,
+                                must_revalidate=True)
+            return response
+        return inner
+    return decorator
@@ -0,0 +1,142 @@
+'''
+Searching the employees in a manager's span of control.
+
+The employee boxes on the manager pages used to list every subordinate as
+an option, which meant finding the span of control on every page view and
+shipping every name to the browser. Now the pages only ship a text input
+(see :func:`timetracker.utils.datemaps.generate_employee_box`) which asks
+:func:`employee_search` for the employees matching what has been typed.
+
+Each span of control is indexed once per process by the start of every
+word of the employees' names, e-mail addresses and job codes, so a search
+is a couple of bisections. The indexes are thrown away whenever the
+details or the teams of any user change, which the
+:class:`timetracker.tracker.models.DataVersion` stamps tell us.
+'''
+
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.conf import settings
+
+from timetracker.tracker.models import Tbluser, DataVersion
+from timetracker.utils.decorators import admin_check, json_response
+
+# splits names, e-mail addresses and job codes into the words which can be
+# searched for.
+WORDS = re.compile(r'[^\W_]+', re.UNICODE)
+
+_LOCK = threading.Lock()
+_INDEXES = OrderedDict()
+
+
+class EmployeeIndex(object):
+    '''A prefix index of a list of employees.'''
+
+    def __init__(self, employees):
+        '''
+        :param employees: A list of dicts with the id, name, user_id (the
+                          e-mail address) and job_code of each employee.
+        '''
+        self.employees = sorted(employees,
+                                key=lambda employee: employee['name'].lower())
+        self.words = sorted(
+            (word, position)
+            for position, employee in enumerate(self.employees)
+            for field in ('name', 'user_id', 'job_code')
+            for word in WORDS.findall((employee[field] or u'').lower())
+            )
+
+    def _matching(self, prefix):
+        '''The positions of the employees with a word starting with
+        `prefix`.'''
+        start = bisect_left(self.words, (prefix,))
+        end = bisect_left(self.words, (prefix + u'\uffff',))
+        return set(position for _, position in self.words[start:end])
+
+    def search(self, query, limit):
+        '''The employees who have a word starting with each word of
+        `query`, in the order of their names. Everyone matches an empty
+        query.'''
+        positions = None
+        for prefix in WORDS.findall(query.lower()):
+            matching = self._matching(prefix)
+            positions = matching if positions is None \
+                else positions & matching
+            if not positions:
+                return []
+        if positions is None:
+            return self.employees[:limit]
+        return [self.employees[position]
+                for position in sorted(positions)[:limit]]
+
+
+def build_index(user, get_all=False):
+    '''Indexes the span of control of `user`.'''
+    admin = user.get_administrator()
+    employees = admin.get_subordinates(get_all=get_all)
+    return EmployeeIndex([{
+        'id': employee.id,
+        'name': employee.name(),
+        'user_id': employee.user_id,
+        'job_code': employee.job_code,
+        } for employee in employees])
+
+
+def employee_index(user, get_all=False):
+    '''The index of the span of control of `user`, built on first use and
+    rebuilt once the details or teams of any user change. The users under
+    the same administrator share it.
+
+    At most EMPLOYEE_SEARCH_INDEXES indexes are kept, the ones used least
+    recently are dropped first.'''
+    admin = user.get_administrator()
+    key = (admin.id, bool(get_all))
+    version = DataVersion.stamp(DataVersion.of_details())[:2]
+    with _LOCK:
+        cached = _INDEXES.pop(key, None)
+        if cached is not None and cached[0] == version:
+            _INDEXES[key] = cached
+            return cached[1]
+    index = build_index(admin, get_all)
+    with _LOCK:
+        _INDEXES[key] = (version, index)
+        while len(_INDEXES) > getattr(settings, 'EMPLOYEE_SEARCH_INDEXES',
+                                      200):
+            _INDEXES.popitem(last=False)
+    return index
+
+
+def clear():
+    '''Forgets every index.'''
+    with _LOCK:
+        _INDEXES.clear()
+
+
+@admin_check
+@json_response
+def employee_search(request):
+    """
+    Function which finds the employees in the span of control of the
+    logged in user matching what has been typed into an employee box.
+    """
+
+    json_data = {
+        'success': False,
+        'error': '',
+        'results': []
+    }
+
+    try:
+        limit = min(int(request.GET.get('limit', 20)), 50)
+    except ValueError:
+        json_data['error'] = 'Invalid limit.'
+        return json_data
+
+    user = Tbluser.objects.get(id=request.session.get('user_id'))
+    index = employee_index(user, request.GET.get('all') == 'true')
+    json_data['results'] = index.search(request.GET.get('q', u''), limit)
+    json_data['success'] = True
+    return json_data
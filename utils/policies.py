@@ -0,0 +1,193 @@
+'''
+The policies of the markets, compiled from the settings.
+
+The overtime threshold, whether undertime is sent, the calculation
+override and the manager overrides of a market are spread across several
+settings (see the settings documentation). Rather than looking each of
+them up on every entry, they're compiled into one immutable
+:class:`MarketPolicy` per market the first time the market is used, and
+users and entries reach it through :attr:`Tbluser.policy`.
+
+Where POLICY_FILE is set the policy settings are read from that file
+instead, and it's read again when it changes on disk, so a running worker
+picks up a new threshold without being restarted. The file is checked at
+most every POLICY_RELOAD_INTERVAL seconds, at the start of a request and
+by the long running commands, and :func:`reload` does it straight away.
+Changing the settings in the tests recompiles them too.
+'''
+
+import os
+import sys
+import time
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
+
+from timetracker.loggers import debug_log
+
+# the settings the policies are compiled from.
+POLICY_SETTINGS = ('OT_THRESHOLDS', 'DEFAULT_OT_THRESHOLD',
+                   'UNDER_TIME_ENABLED', 'OVERRIDE_CALCULATION',
+                   'MANAGER_EMAILS_OVERRIDE', 'MANAGER_NAMES_OVERRIDE')
+
+_lock = threading.Lock()
+_policies = {}
+_state = {'checked': 0, 'mtime': None, 'values': {}}
+
+
+class MarketPolicy(object):
+    '''What a market does differently to the others. Policies can't be
+    changed once they're compiled.'''
+
+    __slots__ = ('market', 'threshold', 'undertime', 'calculation',
+                 'manager_emails', 'manager_names')
+
+    def __init__(self, market, threshold, undertime, calculation,
+                 manager_emails, manager_names):
+        '''
+        :param market: The short code of the market.
+        :param threshold: The hours either side of the shift which aren't
+                          over or undertime.
+        :param undertime: Whether undertime notifications are sent.
+        :param calculation: The OVERRIDE_CALCULATION of the balance, or
+                            None.
+        :param manager_emails: The e-mails which replace the manager's,
+                               or None.
+        :param manager_names: The names which replace the manager's, or
+                              None.
+        '''
+        for name, value in zip(self.__slots__, (
+                market, threshold, undertime, calculation,
+                tuple(manager_emails) if manager_emails else None,
+                tuple(manager_names) if manager_names else None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Market policies can't be changed.")
+
+    def __repr__(self):
+        return '<MarketPolicy %s>' % self.market
+
+    @staticmethod
+    def from_settings(market):
+        '''Compiles the policy of `market` from the settings.'''
+        return MarketPolicy(
+            market,
+            policy_setting('OT_THRESHOLDS').get(
+                market, policy_setting('DEFAULT_OT_THRESHOLD')),
+            bool(policy_setting('UNDER_TIME_ENABLED').get(market)),
+            policy_setting('OVERRIDE_CALCULATION').get(market),
+            policy_setting('MANAGER_EMAILS_OVERRIDE').get(market),
+            policy_setting('MANAGER_NAMES_OVERRIDE').get(market))
+
+
+def policy_setting(name):
+    '''The value of one of the :data:`POLICY_SETTINGS`, from the
+    POLICY_FILE if it sets it and otherwise from the settings.'''
+    values = _state['values']
+    if _policy_file() and name in values:
+        return values[name]
+    return getattr(settings, name)
+
+
+def for_market(market):
+    '''The policy of `market`.'''
+    policy = _policies.get(market)
+    if policy is None:
+        if _policy_file() and _state['mtime'] is None:
+            reload()
+        with _lock:
+            policy = _policies[market] = MarketPolicy.from_settings(market)
+    return policy
+
+
+def version():
+    '''Which policies are in force, for anything which keeps results
+    calculated with them: the modification time of the POLICY_FILE they
+    were read from, None when they're read from the settings.'''
+    if _policy_file() and _state['mtime'] is None:
+        reload()
+    return _state['mtime'] if _policy_file() else None
+
+
+def clear():
+    '''Forgets the compiled policies, they're compiled again from the
+    settings as they're used.'''
+    with _lock:
+        _policies.clear()
+
+
+def _policy_file():
+    '''The path of the file the policy settings are read from, None if
+    they're read from the settings.'''
+    return getattr(settings, 'POLICY_FILE', None)
+
+
+def _mtime(path):
+    '''The modification time of `path`, None if it can't be read.'''
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def reload():
+    '''Reads the policy settings from the POLICY_FILE again and compiles
+    the policies from them.
+
+    :returns: Whether they were read.'''
+    path = _policy_file()
+    if not path:
+        return False
+    mtime = _mtime(path)
+    namespace = {}
+    try:
+        execfile(path, namespace)
+    except Exception as error:
+        # keep the policies which work rather than breaking every request.
+        debug_log.debug("Policies weren't reloaded: %s" % error)
+        return False
+    _state['values'] = dict((name, namespace[name])
+                            for name in POLICY_SETTINGS if name in namespace)
+    _state['mtime'] = mtime
+    clear()
+    return True
+
+
+def check(now=None):
+    '''Reloads the policies if the POLICY_FILE changed since they were
+    compiled, looking at most every POLICY_RELOAD_INTERVAL seconds.
+
+    :returns: Whether they were reloaded.'''
+    interval = getattr(settings, 'POLICY_RELOAD_INTERVAL', 60)
+    now = now or time.time()
+    if not _policy_file() or not interval or \
+            now - _state['checked'] < interval:
+        return False
+    _state['checked'] = now
+    mtime = _mtime(_policy_file())
+    if mtime is None or mtime == _state['mtime']:
+        return False
+    return reload()
+
+
+def _request_started(sender, **kwargs):
+    '''Looks for changed policies before each request.'''
+    check()
+
+
+def _setting_changed(sender, setting, **kwargs):
+    '''Compiles the policies again when the tests change their settings.'''
+    if setting == 'POLICY_FILE':
+        _state.update(mtime=None, values={})
+        clear()
+    elif setting in POLICY_SETTINGS:
+        clear()
+
+request_started.connect(_request_started)
+# the tests have imported their signals by the time the models are loaded,
+# other processes shouldn't have to import django.test at all.
+if 'django.test.signals' in sys.modules:
+    sys.modules['django.test.signals'].setting_changed.connect(
+        _setting_changed)
@@ -0,0 +1,109 @@
+'''
+Module for capturing profiles of single units of work, these are used by
+both the :class:`timetracker.middleware.profiler.ProfilerMiddleware` and
+the management commands which accept the `--profile` option.
+
+Two modes are supported:
+
+* cpu: The call is run under :mod:`cProfile`, the stats are dumped to a
+  `.pstats` file and the SQL executed is written next to it.
+* mem: The call is run under :mod:`tracemalloc` and the top allocation
+  sites are written to a `.mem.txt` file.
+
+The files are written into `settings.PROFILE_DIR`, which defaults to a
+`profiles` directory under `settings.ROOT_LOG_DIR`.
+'''
+
+import os
+import re
+import datetime
+import cProfile
+
+from django.conf import settings
+
+from timetracker.utils.querylog import QueryLog
+
+PROFILE_MODES = ('cpu', 'mem')
+
+# how many allocation sites are written in the memory report.
+TOP_ALLOCATIONS = 25
+
+
+def memory_profiling():
+    '''Whether the mem mode can be used, it needs :mod:`tracemalloc` which
+    not every Python has.'''
+    try:
+        import tracemalloc
+    except ImportError:
+        return False
+    return True
+
+
+def profile_dir():
+    '''Returns the directory profiles are written to, creating it if
+    necessary.'''
+    path = getattr(settings, 'PROFILE_DIR', None) \
+        or os.path.join(settings.ROOT_LOG_DIR, 'profiles')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def profile_basename(name):
+    '''Creates the path, without an extension, of the files for a
+    profile of `name`.'''
+    name = re.sub(r'[^\w.-]+', '_', name)
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return os.path.join(profile_dir(), '%s-%s' % (name, stamp))
+
+
+def write_queries(path, queries):
+    '''Writes a list of queries, as captured by
+    :class:`timetracker.utils.querylog.QueryLog`, to `path`.'''
+    with open(path, 'w') as fileobj:
+        fileobj.write('# %d queries, %.3fs\n' % (
+            len(queries), sum(float(q.get('time', 0)) for q in queries)))
+        for query in queries:
+            fileobj.write('%s\t%s\n' % (query.get('time'), query.get('sql')))
+
+
+def profile_call(name, mode, func, *args, **kwargs):
+    '''Calls `func` with the arguments supplied whilst profiling it.
+
+    :param name: :class:`str` used to name the files written.
+    :param mode: One of :data:`PROFILE_MODES`.
+    :returns: A tuple of the return value of `func` and the list of the
+              files that were written.
+    :raises: :class:`ValueError` if the mode is unknown, or is mem and
+             :func:`memory_profiling` isn't available.
+    '''
+    if mode not in PROFILE_MODES:
+        raise ValueError("Unknown profile mode: %s" % mode)
+    if mode == 'mem' and not memory_profiling():
+        raise ValueError("Memory profiling requires tracemalloc")
+    base = profile_basename(name)
+
+    if mode == 'mem':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        path = base + '.mem.txt'
+        with open(path, 'w') as fileobj:
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                fileobj.write('%s\n' % stat)
+        return result, [path]
+
+    profiler = cProfile.Profile()
+    queries = QueryLog()
+    queries.start()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        queries.stop()
+        profiler.dump_stats(base + '.pstats')
+        write_queries(base + '.sql.txt', queries.queries)
+    return result, [base + '.pstats', base + '.sql.txt']
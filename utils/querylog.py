@@ -0,0 +1,150 @@
+'''
+Module for capturing the SQL which is executed during a unit of work, such
+as a single request or a management command.
+
+Django only records queries when DEBUG is switched on. The
+:class:`QueryLog` turns on the debug cursor of every database connection
+for the duration of the capture and restores it afterwards, so that it can
+be used in production without leaving the query list growing forever.
+Formatting and keeping every statement is too costly to do on every
+request though, so where only the number of queries and the time spent in
+them are wanted the :class:`QueryCounter` is used instead, which keeps no
+SQL at all.
+
+.. code-block:: python
+
+   log = QueryLog()
+   log.start()
+   ...
+   queries = log.stop()
+   log.count, log.time
+'''
+
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+
+
+class CountingCursor(CursorWrapper):
+    '''Wraps a cursor to add the number of statements it executes, and the
+    time they took, to a :class:`QueryCounter`.'''
+
+    def __init__(self, cursor, db, counter):
+        super(CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        '''Executes and counts a statement.'''
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.counter.add(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        '''Executes and counts a statement for each set of parameters, as
+        a single query.'''
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.counter.add(time.time() - start)
+
+
+class QueryCounter(object):
+    '''Counts the queries executed on all connections of the current
+    thread between :meth:`start` and :meth:`stop`, and the time spent in
+    them, without recording what they were.
+
+    Like the :class:`QueryLog` it must be started and stopped on the same
+    thread. Counters may be nested as long as they're stopped in the
+    reverse order they were started.'''
+
+    def __init__(self):
+        '''Initializes an empty counter.'''
+        self.count = 0
+        self.time = 0.0
+        self._state = []
+
+    def add(self, seconds):
+        '''Counts a single query which took `seconds`.'''
+        self.count += 1
+        self.time += seconds
+
+    def _wrap(self, conn):
+        '''Creates the replacement for the cursor method of `conn`.'''
+        cursor = conn.cursor
+
+        def counting_cursor():
+            '''Returns a cursor which counts for us.'''
+            return CountingCursor(cursor(), conn, self)
+        return counting_cursor
+
+    def start(self):
+        '''Begins counting queries.'''
+        self.count = 0
+        self.time = 0.0
+        self._state = []
+        for conn in connections.all():
+            # the wrapper shadows the method on this connection only.
+            self._state.append((conn, conn.__dict__.get('cursor')))
+            conn.cursor = self._wrap(conn)
+
+    def stop(self):
+        '''Stops counting queries.'''
+        for conn, cursor in reversed(self._state):
+            if cursor is None:
+                del conn.cursor
+            else:
+                conn.cursor = cursor
+        self._state = []
+
+
+class QueryLog(object):
+    '''Records the queries executed on all connections of the current
+    thread between :meth:`start` and :meth:`stop`.
+
+    Connections are thread-local in Django so a QueryLog must be started
+    and stopped on the same thread.'''
+
+    def __init__(self):
+        '''Initializes an empty log.'''
+        self.queries = []
+        self._state = []
+
+    def start(self):
+        '''Begins capturing queries.'''
+        self.queries = []
+        self._state = []
+        for conn in connections.all():
+            self._state.append(
+                (conn, conn.use_debug_cursor, len(conn.queries))
+                )
+            conn.use_debug_cursor = True
+
+    def stop(self):
+        '''Stops capturing queries and returns the list of queries which
+        were executed. Each query is a dict with the keys 'sql' and 'time'
+        as found in `connection.queries`.'''
+        for conn, debug_cursor, offset in self._state:
+            self.queries.extend(conn.queries[offset:])
+            conn.use_debug_cursor = debug_cursor
+            # if the queries wouldn't have been recorded without us then we
+            # remove them, otherwise long running processes would leak.
+            if not debug_cursor and not settings.DEBUG:
+                del conn.queries[offset:]
+        self._state = []
+        return self.queries
+
+    @property
+    def count(self):
+        '''The number of queries captured.'''
+        return len(self.queries)
+
+    @property
+    def time(self):
+        '''The total time, in seconds, spent executing the captured
+        queries.'''
+        return sum(float(query.get('time', 0)) for query in self.queries)
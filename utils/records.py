@@ -0,0 +1,111 @@
+'''
+Lightweight, read-only records of the entries for the reports.
+
+Reports only read a handful of fields of each entry, but loading them as
+:class:`TrackingEntry` instances builds a model, its state and a dict for
+every row and, unless the query joins the users, fetches the user of
+every entry one at a time for the calculations.
+
+:func:`entry_records` loads the same rows with values_list into
+:class:`EntryRecord` objects which use `__slots__` and share a single
+:class:`EntryPolicy` per user holding what the calculations need to know
+about them. The records have the same calculation API as the entries,
+the methods are those of :class:`TrackingEntry`, so they give the same
+results.
+'''
+
+from timetracker.tracker.models import Tbluser, TrackingEntry
+from timetracker.utils.datemaps import DAYTYPE_CHOICES
+
+DAYTYPES = dict(DAYTYPE_CHOICES)
+
+
+class EntryPolicy(object):
+    '''What the calculations of an entry need to know about its user,
+    shared by all of the user's records.'''
+
+    __slots__ = ('id', 'firstname', 'lastname', 'market', 'shift_minutes',
+                 'break_minutes', 'threshold')
+
+    def __init__(self, user):
+        '''
+        :param user: The :class:`Tbluser` the policy is for.
+        '''
+        self.id = user.id
+        self.firstname = user.firstname
+        self.lastname = user.lastname
+        self.market = user.market
+        self.shift_minutes = user.shift_minutes
+        self.break_minutes = user.break_minutes
+        self.threshold = user.policy.threshold
+
+    @staticmethod
+    def for_users(users):
+        '''The policies of `users` keyed by their ids.'''
+        return dict((user.id, EntryPolicy(user)) for user in users)
+
+for _name in ('name', 'rev_name', 'shiftlength_as_float'):
+    setattr(EntryPolicy, _name, Tbluser.__dict__[_name])
+
+
+class EntryRecord(object):
+    '''A read-only entry.
+
+    :attr:`user` is the :class:`EntryPolicy` of the entry's user.'''
+
+    __slots__ = ('user', 'entry_date', 'start_time', 'end_time', 'breaks',
+                 'daytype', 'comments', 'start_minutes', 'end_minutes',
+                 'break_minutes')
+
+    # the columns the records are loaded from, the user id comes first.
+    FIELDS = ('user_id', 'entry_date', 'start_time', 'end_time', 'breaks',
+              'daytype', 'comments', 'start_minutes', 'end_minutes',
+              'break_minutes')
+
+    def __init__(self, user, entry_date, start_time, end_time, breaks,
+                 daytype, comments, start_minutes, end_minutes,
+                 break_minutes):
+        self.user = user
+        self.entry_date = entry_date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.breaks = breaks
+        self.daytype = daytype
+        self.comments = comments
+        self.start_minutes = start_minutes
+        self.end_minutes = end_minutes
+        self.break_minutes = break_minutes
+
+    def threshold(self):
+        '''Returns the threshold for the associated user.'''
+        return self.user.threshold
+
+    def get_daytype_display(self):
+        '''The name of the daytype.'''
+        return DAYTYPES.get(self.daytype, self.daytype)
+
+# records are calculated and displayed exactly as the entries.
+for _name in ('display_as_csv', 'breaktime', 'totalhours', 'nearest_half',
+              'normalized_break', '_normalized_break_minutes',
+              'total_working_time', 'is_overtime', 'is_undertime',
+              'overtime_class', 'time_difference'):
+    setattr(EntryRecord, _name, TrackingEntry.__dict__[_name])
+del _name
+
+
+def entry_records(queryset, policies=None):
+    '''The entries of `queryset` as :class:`EntryRecord` objects, read a
+    chunk at a time.
+
+    :param queryset: A queryset of :class:`TrackingEntry` or
+                     :class:`ArchivedEntry`.
+    :param policies: A dict of the :class:`EntryPolicy` of the users keyed
+                     by their ids, the policies of any other users are
+                     loaded as they're found and added to it.'''
+    policies = {} if policies is None else policies
+    for row in queryset.values_list(*EntryRecord.FIELDS).iterator():
+        policy = policies.get(row[0])
+        if policy is None:
+            policy = policies[row[0]] = EntryPolicy(
+                Tbluser.objects.get(id=row[0]))
+        yield EntryRecord(policy, *row[1:])
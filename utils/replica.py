@@ -0,0 +1,79 @@
+'''
+Database router which sends the reads of read-only work to a replica.
+
+Reads are only sent to the replica whilst :func:`use_replica` is active on
+the current thread, which is done for the read-only pages by
+:class:`timetracker.middleware.replica.ReplicaMiddleware` and for the
+report commands by :class:`timetracker.tracker.management.base.ProfiledCommand`.
+Everything else, and every write, goes to the default database.
+
+To enable it, add the replica to the DATABASES and::
+
+    DATABASE_ROUTERS = ['timetracker.utils.replica.ReplicaRouter']
+    REPLICA_DATABASE = 'replica'
+
+When REPLICA_DATABASE isn't set the router does nothing.
+'''
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# only the models of these apps are read from the replica, sessions and
+# the like always come from the default database.
+REPLICA_APPS = ('tracker',)
+
+_state = threading.local()
+
+
+def replica_alias():
+    '''The alias of the replica, None if there isn't one.'''
+    return getattr(settings, 'REPLICA_DATABASE', None)
+
+
+def replica_active():
+    '''Whether reads on this thread are currently sent to the replica.'''
+    return getattr(_state, 'depth', 0) > 0
+
+
+@contextmanager
+def use_replica():
+    '''Sends the reads made in the block to the replica.'''
+    _state.depth = getattr(_state, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+
+
+def reset():
+    '''Sends reads on this thread back to the default database.'''
+    _state.depth = 0
+
+
+class ReplicaRouter(object):
+    '''Routes the reads of :data:`REPLICA_APPS` to the replica whilst
+    :func:`use_replica` is active.'''
+
+    def db_for_read(self, model, **hints):
+        '''The replica if it's in use.'''
+        if model._meta.app_label in REPLICA_APPS and replica_active():
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        '''Writes always go to the default database, even for instances
+        which were read from the replica.'''
+        if model._meta.app_label in REPLICA_APPS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        '''The replica holds the same data so relations between the two
+        are fine.'''
+        databases = (DEFAULT_DB_ALIAS, replica_alias())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,195 @@
+'''
+The working time calculations of a :class:`TrackingEntry` as SQL, so that
+totals can be summed by the database rather than by loading every entry.
+
+The expressions work in whole minutes, as the Python methods do, from the
+minutes columns kept alongside the time fields (see
+:class:`timetracker.tracker.models.MinutesField`):
+
+* normalized_break: the shorter of the entry's breaks and the user's
+  breaklength, :meth:`TrackingEntry.normalized_break`.
+* worked: :meth:`TrackingEntry.total_working_time`.
+* total: :meth:`TrackingEntry.totalhours`.
+* delta: :meth:`TrackingEntry.time_difference`, the minutes over or under
+  the user's shiftlength and breaklength.
+* half_hours: :meth:`TrackingEntry.nearest_half`, as a number of half
+  hours.
+* balance: what an entry adds to the balance in
+  :meth:`Tbluser._regular_calculation`, the working days count their
+  time less their breaks and shiftlength and the return for overtime days
+  take off a shiftlength and breaklength.
+* days: the number of entries.
+
+Use :func:`sum_minutes` to total them over a queryset of entries and
+:func:`annotate` to add those which only depend on the entry to each row.
+'''
+
+from django.db import connections
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def time_minutes(vendor, column):
+    '''The minutes since midnight of a time column, which the minutes
+    columns are filled in from. Written for SQLite, PostgreSQL and
+    MySQL, None on other databases, whose minutes are worked out in
+    Python instead.'''
+    if vendor == 'sqlite':
+        # sqlite keeps times as HH:MM:SS text.
+        return ('(CAST(substr(%s, 1, 2) AS INTEGER) * 60 + '
+                'CAST(substr(%s, 4, 2) AS INTEGER))' % (column, column))
+    if vendor == 'postgresql':
+        return ('(CAST(EXTRACT(HOUR FROM %s) AS INTEGER) * 60 + '
+                'CAST(EXTRACT(MINUTE FROM %s) AS INTEGER))' % (column,
+                                                                column))
+    if vendor == 'mysql':
+        return '(HOUR(%s) * 60 + MINUTE(%s))' % (column, column)
+    return None
+
+
+def _divide(vendor, dividend, divisor):
+    '''Integer division, of positive numbers.'''
+    if vendor == 'mysql':
+        return '((%s) DIV %s)' % (dividend, divisor)
+    return '((%s) / %s)' % (dividend, divisor)
+
+
+def _time_of_day(minutes):
+    '''Wraps minutes into a single day, as the seconds of a timedelta
+    are. The modulo is escaped since the query is formatted with its
+    parameters.'''
+    return '(((%s) %%%% %d + %d) %%%% %d)' % (
+        minutes, MINUTES_PER_DAY, MINUTES_PER_DAY, MINUTES_PER_DAY)
+
+
+class Expressions(object):
+    '''The expressions for the entries in the table aliased `entry` with
+    their users in the table aliased `user`.'''
+
+    def __init__(self, vendor, entry, user=None):
+        '''
+        :param vendor: The vendor of the database connection.
+        :param entry: The alias of the entries' table.
+        :param user: The alias of the users' table, if it's joined.
+        '''
+        self.vendor = vendor
+        self.entry = entry
+        self.user = user
+
+    def _column(self, table, name):
+        '''A minutes column.'''
+        if table is None:
+            raise ValueError("This expression needs the user's table.")
+        return '%s.%s' % (table, name)
+
+    def start(self):
+        '''The start of the entry.'''
+        return self._column(self.entry, 'start_minutes')
+
+    def end(self):
+        '''The end of the entry.'''
+        return self._column(self.entry, 'end_minutes')
+
+    def breaks(self):
+        '''The entry's breaks.'''
+        return self._column(self.entry, 'break_minutes')
+
+    def user_break(self):
+        '''The user's breaklength.'''
+        return self._column(self.user, 'break_minutes')
+
+    def user_shift(self):
+        '''The user's shiftlength.'''
+        return self._column(self.user, 'shift_minutes')
+
+    def normalized_break(self):
+        '''The shorter of the breaks and the breaklength.'''
+        return 'CASE WHEN %s > %s THEN %s ELSE %s END' % (
+            self.breaks(), self.user_break(), self.user_break(),
+            self.breaks())
+
+    def worked(self):
+        '''The working time, ignoring breaks over the breaklength.'''
+        return _time_of_day('%s - %s + %s' % (self.end(), self.start(),
+                                              self.normalized_break()))
+
+    def total(self):
+        '''The time from start to end with the breaks.'''
+        return _time_of_day('%s - %s + %s' % (self.end(), self.start(),
+                                              self.breaks()))
+
+    def delta(self):
+        '''The time worked over or under the shift.'''
+        return '(%s - %s - %s)' % (self.worked(), self.user_shift(),
+                                   self.user_break())
+
+    def half_hours(self):
+        '''The total time rounded to half hours.'''
+        # python rounds halves away from zero, and the total is never
+        # negative.
+        return _divide(self.vendor, '%s + 15' % self.total(), 30)
+
+    def balance(self):
+        '''What the entry adds to the balance.'''
+        return ("CASE WHEN %s.daytype = 'ROVER' THEN 0 - %s - %s "
+                "ELSE %s - %s - %s - %s END" % (
+                    self.entry, self.user_shift(), self.user_break(),
+                    self.end(), self.start(), self.breaks(),
+                    self.user_shift()))
+
+    def days(self):
+        '''Counts the entry.'''
+        return '1'
+
+    def get(self, name):
+        '''The expression called `name`.'''
+        if name not in NAMES:
+            raise ValueError("%s isn't a working time expression." % name)
+        return getattr(self, name)()
+
+
+NAMES = ('normalized_break', 'worked', 'total', 'delta', 'half_hours',
+         'balance', 'days')
+
+
+def sum_minutes(queryset, names, by_user=False):
+    '''Sums expressions over the entries in `queryset` in a single query.
+
+    :param queryset: A queryset of :class:`TrackingEntry` or
+                     :class:`ArchivedEntry`.
+    :param names: The names of the expressions to sum.
+    :param by_user: Whether to sum each user's entries separately.
+    :returns: A list of the totals, in the order of `names`, or a dict of
+              those lists keyed by the user id when `by_user` is given.'''
+    model = queryset.model
+    users = model._meta.get_field('user').rel.to
+    connection = connections[queryset.db]
+    quote = connection.ops.quote_name
+    expressions = Expressions(connection.vendor, 'entry', 'person')
+    inner, params = queryset.order_by().values('pk').query.sql_with_params()
+    sql = ('SELECT %s%s FROM %s entry INNER JOIN %s person '
+           'ON person.id = entry.user_id WHERE entry.id IN (%s)' % (
+               'entry.user_id, ' if by_user else '',
+               ', '.join('SUM(%s)' % expressions.get(name)
+                         for name in names),
+               quote(model._meta.db_table), quote(users._meta.db_table),
+               inner))
+    if by_user:
+        sql += ' GROUP BY entry.user_id'
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    if by_user:
+        return {row[0]: [int(total or 0) for total in row[1:]]
+                for row in cursor.fetchall()}
+    return [int(total or 0) for total in cursor.fetchone()]
+
+
+def annotate(queryset, *names):
+    '''Adds the expressions, which mustn't depend on the user, to each of
+    the entries in `queryset`.'''
+    connection = connections[queryset.db]
+    expressions = Expressions(
+        connection.vendor,
+        connection.ops.quote_name(queryset.model._meta.db_table))
+    return queryset.extra(select=dict(
+            (name, expressions.get(name)) for name in names))
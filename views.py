@@ -14,7 +14,8 @@ from django.template import RequestContext
 from django.core.mail import send_mail
 from django.conf import settings
 
-from timetracker.tracker.models import Tbluser, UserForm, TrackingEntry
+from timetracker.tracker.models import (Tbluser, UserForm, TrackingEntry,
+                                        ArchivedEntry, DataVersion)
 from timetracker.tracker.models import Tblauthorization as tblauth
 from timetracker.tracker.forms import EntryForm, AddForm, Login
 
@@ -27,33 +28,53 @@ from timetracker.utils.calendar_utils import (gen_calendar, gen_holiday_list,
                                               profile_edit, gen_datetime_cal,
                                               get_comments, add_comment,
                                               remove_comment,
-                                              get_tracking_entry_data)
+                                              get_tracking_entry_data,
+                                              get_holiday_rows,
+                                              get_holiday_changes)
 
+from timetracker.utils.employee_search import employee_search
+from timetracker.reporting.jobs import submit_report_job, report_job_status
 from timetracker.utils.datemaps import (generate_select,
                                         generate_employee_box,
                                         generate_year_box)
 
-from timetracker.utils.decorators import admin_check, loggedin
+from timetracker.utils.decorators import (admin_check, loggedin,
+                                          data_versioned)
 from timetracker.utils.error_codes import CONNECTION_REFUSED
 from timetracker.loggers import suspicious_log, email_log, error_log
+from timetracker.middleware.metrics import render_metrics
+from timetracker.utils.context import LazyValue, lazy_context
 
 
 def user_context_manager(request):
     '''Context manager which always puts certain variables into the
     template context. This is because all pages require certain
     pieces of data so it's easier to push this work down to middleware
+
+    The values are lazy, neither the user nor their balance are loaded
+    unless the page uses them (see :mod:`timetracker.utils.context`).
     '''
-    try:
-        user = Tbluser.objects.get(id=request.session.get("user_id"))
-    except Tbluser.DoesNotExist:
-        return {}
-    return {
-        "welcome_name": user.firstname,
-        "is_admin": user.super_or_admin(),
-        "is_team_leader": user.is_tl(),
-        "balance": user.get_total_balance(ret="int"),
-        "doculink": settings.DOCUMENTATION_BASE_URL
-        }
+    def load_user():
+        '''The logged in user, None if there isn't one.'''
+        try:
+            return Tbluser.objects.get(id=request.session.get("user_id"))
+        except Tbluser.DoesNotExist:
+            return None
+    user = LazyValue(request, "user", load_user)
+
+    def from_user(function, default=False):
+        '''A value calculated from the user, `default` without one.'''
+        return lambda: function(user()) if user() else default
+
+    return lazy_context(
+        request,
+        welcome_name=from_user(lambda user: user.firstname, ''),
+        is_admin=from_user(lambda user: user.super_or_admin()),
+        is_team_leader=from_user(lambda user: user.is_tl()),
+        balance=from_user(lambda user: user.get_total_balance(ret="int"),
+                          ''),
+        doculink=from_user(lambda user: settings.DOCUMENTATION_BASE_URL, '')
+        )
 
 def index(request):
 
@@ -166,7 +187,29 @@ def logout(request):
     return HttpResponseRedirect("/")
 
 
+def own_stamps(request, *args, **kwargs):
+    '''The pages of a user's own data depend only on their own stamps.'''
+    return DataVersion.of_user(request.session.get('user_id'))
+
+def target_stamps(request, who=None, year=None):
+    '''The year-at-a-glance pages depend on the target's year, the
+    details of the users in the select box and the viewer's balance.'''
+    if not who:
+        return None
+    year = year or datetime.datetime.now().year
+    return (DataVersion.of_user(who, year)
+            | DataVersion.of_details()
+            | DataVersion.of_user(request.session.get('user_id')))
+
+def team_stamps(request, year=None, month=None, *args, **kwargs):
+    '''The holiday pages depend on everybody's entries in the year, as
+    the holiday balances are shown, and the viewer's balance.'''
+    year = year or datetime.datetime.now().year
+    return (DataVersion.of_period(year)
+            | DataVersion.of_user(request.session.get('user_id')))
+
 @loggedin
+@data_versioned(own_stamps)
 def user_view(request, year=None, month=None, day=None):
     """Generates a calendar based on the URL it receives.
     For example: domain.com/calendar/{year}/{month}/{day},
@@ -280,6 +323,11 @@ def ajax(request):
         'add_comment': add_comment,
         'remove_comment': remove_comment,
         'tracking_data': get_tracking_entry_data,
+        'holiday_rows': get_holiday_rows,
+        'holiday_changes': get_holiday_changes,
+        'employee_search': employee_search,
+        'report_job': submit_report_job,
+        'report_job_status': report_job_status,
     }
     try:
         return ajax_funcs.get(
@@ -301,12 +349,9 @@ def view_with_employee_list(request, template=None, get_all=False):
 
     try:
         ees = user.get_subordinates(get_all=get_all)
-        employees_select = generate_employee_box(user, get_all=get_all)
     except tblauth.DoesNotExist:
         ees = []
-        employees_select = """<select id=user_select>
-                                <option id="null">----------</option>
-                              </select>"""
+    employees_select = generate_employee_box(get_all=get_all)
 
     return render_to_response(
         template,
@@ -319,16 +364,22 @@ def view_with_employee_list(request, template=None, get_all=False):
     )
 
 @loggedin
+@data_versioned(team_stamps)
 def view_with_holiday_list(request,
                            year=None,
                            month=None,
                            process=None,
                            template=None,
-                           admin_required=False):
+                           admin_required=False,
+                           paged=False):
     """
     Generates the full holiday table for all employees under a manager
     or a user's teammates if they are a regular user.
 
+    When `paged` is set only the frame of the table is rendered and the
+    rows are fetched by the page, see
+    :func:`timetracker.utils.calendar_utils.gen_holiday_list`.
+
     :param request: Automatically passed contains a map of the httprequest
     :return: HttpResponse object back to the browser.
     """
@@ -352,7 +403,8 @@ def view_with_holiday_list(request,
     holiday_table, comments_list, js_calendar = gen_holiday_list(user,
                                                                  year,
                                                                  month,
-                                                                 process)
+                                                                 process,
+                                                                 paged)
 
     # calculate the days in the month, this is inefficient.
     # It creates a list of datetime objects and gets the len
@@ -365,12 +417,13 @@ def view_with_holiday_list(request,
             'holiday_table': holiday_table,
             'comments_list': comments_list,
             'days_this_month': days_this_month,
-            'employee_select': generate_employee_box(user),
+            'employee_select': generate_employee_box(),
             'js_calendar': js_calendar,
         },
         RequestContext(request))
 
 @admin_check
+@data_versioned(target_stamps)
 def yearview(request, who=None, year=None):
     '''Yearview generates the 'year at a glance' for both Administrators
     and regular users.
@@ -401,7 +454,8 @@ def yearview(request, who=None, year=None):
     # generate our year table.
     yeartable = target_user.yearview(year)
     # interpolate our values into it.
-    yeartable = yeartable.format(employees_select=generate_employee_box(auth_user),
+    yeartable = yeartable.format(employees_select=generate_employee_box(
+                                     selected=target_user),
                                  c="EMPTY",
                                  function="")
     return render_to_response("yearview.html",
@@ -411,6 +465,7 @@ def yearview(request, who=None, year=None):
                                }, RequestContext(request))
 
 @admin_check
+@data_versioned(target_stamps)
 def overtime(request, who=None, year=None):
     auth_user = Tbluser.objects.get(
         id=request.session.get('user_id')
@@ -434,7 +489,8 @@ def overtime(request, who=None, year=None):
     # generate our year table.
     ot_table = target_user.overtime_view(year)
     # interpolate our values into it.
-    ot_table = ot_table.format(employees_select=generate_employee_box(auth_user),
+    ot_table = ot_table.format(employees_select=generate_employee_box(
+                                   selected=target_user),
                                yearbox=generate_year_box(int(year), id="cmb_yearbox"),
                                c="EMPTY",
                                function="")
@@ -491,6 +547,7 @@ def explain(request):
          'shiftlength': "%s:%s" % (user.shiftlength.hour,
                                    user.shiftlength.minute),
          'working_days': TrackingEntry.objects.filter(user=user.id).count()
+                         + ArchivedEntry.objects.filter(user=user.id).count()
          },
         RequestContext(request))
 
@@ -550,3 +607,15 @@ def forgot_pass(request):
         else:
             error_log.critical(str(error))
     return HttpResponseRedirect("/")
+
+@admin_check
+def metrics(request):
+    """Exposes the per-view request metrics gathered by
+    :class:`timetracker.middleware.metrics.MetricsMiddleware` in the
+    Prometheus text format.
+
+    :param request: Automatically passed contains a map of the httprequest
+    :return: HttpResponse object back to the browser.
+    """
+    return HttpResponse(render_metrics(),
+                        mimetype="text/plain; version=0.0.4")